@@ -29,3 +29,18 @@ USDT_RATE = int(os.getenv("USDT_RATE", "25000"))  # Tỷ giá 1 USDT = ? VND
 # - hybrid: chỉ tạo VietQR khi thiếu balance
 # - balance: phải nạp balance trước khi mua
 PAYMENT_MODE = os.getenv("PAYMENT_MODE", "hybrid").lower()
+
+# Telegram transport:
+# - polling (mặc định): getUpdates
+# - webhook: Telegram gọi vào server aiohttp nội bộ (WEBHOOK_LISTEN:WEBHOOK_PORT + WEBHOOK_PATH),
+#   WEBHOOK_URL là địa chỉ public (https://domain) trỏ về server đó qua reverse proxy
+BOT_TRANSPORT = os.getenv("BOT_TRANSPORT", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip().strip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "").strip()
+# false = giữ lại update chờ xử lý khi bot khởi động lại (mặc định bỏ như trước)
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "true").strip().lower() in ("1", "true", "yes")
+# Số update xử lý song song (update của cùng một chat vẫn chạy tuần tự)
+UPDATE_CONCURRENCY = max(1, int(os.getenv("UPDATE_CONCURRENCY", "256")))
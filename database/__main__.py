@@ -0,0 +1,89 @@
+"""
+SQLite schema maintenance.
+
+Usage:
+    python -m database status  [--db data/shop.db]
+    python -m database upgrade [--db data/shop.db]
+    python -m database check-plans [--db data/shop.db]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+import aiosqlite
+
+from .db import DB_PATH
+from .migrations import LATEST_VERSION, get_status, migrate
+from .query_plans import check_query_plans
+
+
+async def _print_status(db, db_path: str) -> int:
+    status = await get_status(db)
+    print(f"Database: {db_path}")
+    print(f"Schema version: {status['current']} (latest {status['latest']})")
+    for row in status["applied"]:
+        print(f"  [x] {row['version']:>3} {row['name']}  ({row['applied_at']})")
+    for row in status["pending"]:
+        print(f"  [ ] {row['version']:>3} {row['name']}")
+    return 0 if not status["pending"] else 2
+
+
+async def cmd_status(db_path: str) -> int:
+    if not os.path.exists(db_path):
+        print(f"{db_path}: database does not exist (version 0, latest {LATEST_VERSION})")
+        return 1
+    async with aiosqlite.connect(db_path) as db:
+        return await _print_status(db, db_path)
+
+
+async def cmd_upgrade(db_path: str) -> int:
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    async with aiosqlite.connect(db_path) as db:
+        applied = await migrate(db)
+        if applied:
+            print(f"Applied migrations: {', '.join(str(v) for v in applied)}")
+        else:
+            print("Schema is up to date.")
+        return await _print_status(db, db_path)
+
+
+async def cmd_check_plans(db_path: str) -> int:
+    """Exit 1 if any hot query no longer uses its index (a missing file is checked against a fresh schema)."""
+    if os.path.exists(db_path):
+        # EXPLAIN never writes; read-only so it is safe against the live bot database.
+        conn = aiosqlite.connect(f"file:{db_path}?mode=ro", uri=True)
+    else:
+        conn = aiosqlite.connect(":memory:")
+    async with conn as db:
+        if db_path and not os.path.exists(db_path):
+            await migrate(db)
+        results = await check_query_plans(db)
+        for row in results:
+            mark = "ok  " if row["ok"] else "FAIL"
+            print(f"[{mark}] {row['name']:<32} expects {row['index']}")
+            if not row["ok"]:
+                for detail in row["plan"]:
+                    print(f"         {detail}")
+        return 0 if all(row["ok"] for row in results) else 1
+
+
+COMMANDS = {
+    "status": cmd_status,
+    "upgrade": cmd_upgrade,
+    "check-plans": cmd_check_plans,
+}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m database", description="SQLite schema maintenance")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("--db", default=DB_PATH, help=f"SQLite file (default: {DB_PATH})")
+    args = parser.parse_args(argv)
+    return asyncio.run(COMMANDS[args.command](args.db))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
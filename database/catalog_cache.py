@@ -0,0 +1,82 @@
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+# Safety net for edits the bot does not see (website dashboard, SQL editor, sepay_checker's own connection).
+CATALOG_CACHE_TTL_SECONDS = max(0.0, _env_float("CATALOG_CACHE_TTL_SECONDS", 15.0))
+
+
+class CatalogCache:
+    """
+    In-memory copy of the visible catalog (get_products() rows: parsed price_tiers,
+    format_data, stock counts), shared by get_products() and get_product().
+
+    `version` only moves forward: every write through this process bumps it via
+    invalidate() (product edits) or adjust_stock() (known stock deltas).
+    Callers get copies, so the cached rows are never mutated from outside.
+    """
+
+    def __init__(
+        self,
+        load_products: Callable[[], Awaitable[List[Dict[str, Any]]]],
+        ttl: float = CATALOG_CACHE_TTL_SECONDS,
+    ):
+        self._load_products = load_products
+        self.ttl = ttl
+        self.version = 0
+        self._products: Optional[List[Dict[str, Any]]] = None
+        self._by_id: Dict[int, Dict[str, Any]] = {}
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self) -> bool:
+        return self._products is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def _snapshot(self) -> List[Dict[str, Any]]:
+        if self._is_fresh():
+            return self._products
+        async with self._lock:
+            if self._is_fresh():
+                return self._products
+            version = self.version
+            products = await self._load_products()
+            if self.version == version:
+                # No write landed while loading: safe to publish.
+                self._products = products
+                self._by_id = {int(p["id"]): p for p in products if p.get("id") is not None}
+                self._loaded_at = time.monotonic()
+            return products
+
+    async def products(self) -> List[Dict[str, Any]]:
+        return [dict(p) for p in await self._snapshot()]
+
+    async def product(self, product_id: int) -> Optional[Dict[str, Any]]:
+        products = await self._snapshot()
+        if products is self._products:
+            row = self._by_id.get(int(product_id))
+        else:
+            row = next((p for p in products if p.get("id") == int(product_id)), None)
+        return dict(row) if row is not None else None
+
+    def invalidate(self):
+        self.version += 1
+        self._products = None
+        self._by_id = {}
+
+    def adjust_stock(self, product_id: int, delta: int):
+        """Apply a known stock change without reloading (falls back to invalidate if not cached)."""
+        self.version += 1
+        row = self._by_id.get(int(product_id)) if self._products is not None else None
+        if row is None:
+            self.invalidate()
+            return
+        row["stock"] = max(0, int(row.get("stock") or 0) + int(delta))
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _env_number(name: str, default, cast=int):
+    try:
+        return cast(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+CHAT_LOG_BATCH_SIZE = max(1, _env_number("CHAT_LOG_BATCH_SIZE", 100))
+CHAT_LOG_FLUSH_SECONDS = max(0.0, _env_number("CHAT_LOG_FLUSH_SECONDS", 1.0, float))
+# Hard cap on buffered rows; beyond it new rows are dropped (and counted) instead of slowing replies.
+CHAT_LOG_QUEUE_SIZE = max(1, _env_number("CHAT_LOG_QUEUE_SIZE", 10000))
+CHAT_LOG_DRAIN_SECONDS = max(0.0, _env_number("CHAT_LOG_DRAIN_SECONDS", 10.0, float))
+
+_STOP = object()
+
+
+class ChatLogWriter:
+    """
+    Background writer for telegram_messages rows.
+
+    `enqueue(row)` never waits: rows go into a bounded asyncio queue and a
+    single task writes them with `write_batch(rows)` once CHAT_LOG_BATCH_SIZE
+    rows are buffered or CHAT_LOG_FLUSH_SECONDS have passed. `stop()` drains
+    what is left (used by close_db on shutdown).
+    """
+
+    def __init__(
+        self,
+        write_batch: Callable[[List[Any]], Awaitable[Any]],
+        batch_size: int = CHAT_LOG_BATCH_SIZE,
+        flush_seconds: float = CHAT_LOG_FLUSH_SECONDS,
+        max_queue: int = CHAT_LOG_QUEUE_SIZE,
+    ):
+        self._write_batch = write_batch
+        self.batch_size = max(1, int(batch_size))
+        self.flush_seconds = max(0.0, float(flush_seconds))
+        self.max_queue = max(1, int(max_queue))
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {
+            "enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0, "max_depth": 0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="chat-log-writer")
+
+    def enqueue(self, row: Any) -> bool:
+        """False if the writer is not running (caller should write inline)."""
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            dropped = self.stats["dropped"]
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.warning("Chat log queue full (%s rows); dropped %s rows so far", self.max_queue, dropped)
+            return True
+        self.stats["enqueued"] += 1
+        depth = self._queue.qsize()
+        if depth > self.stats["max_depth"]:
+            self.stats["max_depth"] = depth
+        return True
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "queued": self._queue.qsize() if self._queue is not None else 0}
+
+    async def _flush(self, batch: List[Any]):
+        try:
+            await self._write_batch(batch)
+        except Exception:
+            self.stats["failed"] += len(batch)
+            logger.exception("Chat log batch write failed (%s rows)", len(batch))
+            return
+        self.stats["written"] += len(batch)
+        self.stats["batches"] += 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def stop(self, timeout: float = CHAT_LOG_DRAIN_SECONDS):
+        """Flush buffered rows, then stop; rows still queued after `timeout` are counted as dropped."""
+        task = self._task
+        if task is None:
+            return
+        if not task.done():
+            try:
+                await asyncio.wait_for(self._queue.put(_STOP), timeout)
+                await asyncio.wait_for(asyncio.shield(task), timeout)
+            except asyncio.TimeoutError:
+                task.cancel()
+                self.stats["dropped"] += self._queue.qsize()
+                logger.warning("Chat log drain timed out; %s rows not written", self._queue.qsize())
+        self._task = None
@@ -1,8 +1,16 @@
-import aiosqlite
 import json
-import os
 from datetime import datetime
 
+from helpers.pricing import get_pricing_snapshot
+
+from .catalog_cache import CatalogCache
+from .chat_log_writer import ChatLogWriter
+from .known_users import KnownUserCache
+from .migrations import migrate
+from .settings_snapshot import SETTINGS_VERSION_KEY, SettingsSnapshot
+from .single_flight import get_single_flight_stats, single_flight
+from .sqlite_pool import SQLitePool
+
 def _parse_bool(value, default=True):
     if value is None:
         return default
@@ -24,200 +32,112 @@ def _parse_json_list(value):
         return data if isinstance(data, list) else []
     except Exception:
         return []
+
+
+def _product_row_to_dict(row):
+    return {
+        "id": row[0],
+        "name": row[1],
+        "price": row[2],
+        "description": row[3],
+        "stock": row[10],
+        "price_usdt": row[4] or 0,
+        "format_data": row[5],
+        "price_tiers": _parse_json_list(row[6]),
+        "promo_buy_quantity": row[7] or 0,
+        "promo_bonus_quantity": row[8] or 0,
+        "sort_position": row[9] if row[9] is not None else None,
+    }
 
 DB_PATH = "data/shop.db"
 
+# Persistent connections (1 writer + read-only pool) instead of connect-per-call.
+_pool = SQLitePool(DB_PATH)
+
+# Hot queries: shared with database/query_plans.py, which checks each one still uses its index.
+SQL_STOCK_TAKE_UNSOLD = "SELECT id, content FROM stock WHERE product_id = ? AND sold = 0 LIMIT ?"
+SQL_STOCK_CHECKOUT_UNSOLD = "SELECT id, content FROM stock WHERE product_id = ? AND sold = 0 ORDER BY id LIMIT ?"
+SQL_STOCK_EXPORT_UNSOLD = "SELECT content FROM stock WHERE product_id = ? AND sold = 0 ORDER BY id"
+SQL_STOCK_BY_PRODUCT = "SELECT id, content, sold FROM stock WHERE product_id = ? ORDER BY sold ASC, id DESC"
+SQL_ORDERS_BY_USER = """SELECT o.id, p.name, o.content, o.price, o.created_at, o.quantity
+               FROM orders o JOIN products p ON o.product_id = p.id
+               WHERE o.user_id = ? ORDER BY o.created_at DESC LIMIT 20"""
+SQL_ORDERS_BY_PRODUCT = """SELECT o.id, o.user_id, o.content, o.price, o.quantity, o.created_at
+               FROM orders o
+               WHERE o.product_id = ?
+               ORDER BY o.created_at DESC
+               LIMIT ?"""
+SQL_DEPOSITS_PENDING = "SELECT id, user_id, amount, code, created_at FROM deposits WHERE status = 'pending'"
+SQL_WITHDRAWALS_PENDING = "SELECT id, user_id, amount, momo_phone, created_at FROM withdrawals WHERE status = 'pending'"
+SQL_WITHDRAWALS_PENDING_SUM = "SELECT SUM(amount) FROM withdrawals WHERE user_id = ? AND status = 'pending'"
+SQL_DIRECT_ORDERS_PENDING = """SELECT id, user_id, product_id, quantity, bonus_quantity, unit_price, amount, code, created_at
+               FROM direct_orders WHERE status = 'pending'"""
+SQL_BINANCE_DEPOSITS_PENDING = (
+    "SELECT id, user_id, usdt_amount, vnd_amount, code, screenshot_file_id, created_at "
+    "FROM binance_deposits WHERE status = 'pending' AND screenshot_file_id IS NOT NULL"
+)
+SQL_BINANCE_DEPOSIT_SET_SCREENSHOT = (
+    "UPDATE binance_deposits SET screenshot_file_id = ? WHERE user_id = ? AND code = ? AND status = 'pending'"
+)
+SQL_BINANCE_DEPOSIT_USER_PENDING = (
+    "SELECT id, usdt_amount, vnd_amount, code FROM binance_deposits "
+    "WHERE user_id = ? AND status = 'pending' ORDER BY id DESC LIMIT 1"
+)
+SQL_USDT_WITHDRAWALS_PENDING = (
+    "SELECT id, user_id, usdt_amount, wallet_address, network, created_at FROM usdt_withdrawals WHERE status = 'pending'"
+)
+SQL_USDT_WITHDRAWALS_PENDING_SUM = "SELECT SUM(usdt_amount) FROM usdt_withdrawals WHERE user_id = ? AND status = 'pending'"
+
+
+async def close_db():
+    """Close pooled connections (call once on shutdown)."""
+    # Drain buffered chat history before the writer connection goes away.
+    await _chat_log.stop()
+    await _pool.close()
+    _settings.invalidate()
+    _known_users.clear()
+    _catalog.invalidate()
+
+
 async def init_db():
-    # Ensure data directory exists
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                balance INTEGER DEFAULT 0,
-                balance_usdt REAL DEFAULT 0,
-                language TEXT DEFAULT 'vi',
-                created_at TEXT
-            )
-        """)
-        # Add balance_usdt column if not exists (migration)
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN balance_usdt REAL DEFAULT 0")
-        except:
-            pass
-        # Add language column if not exists (migration)
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN language TEXT DEFAULT 'vi'")
-        except:
-            pass
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                price_usdt REAL DEFAULT 0,
-                price_tiers TEXT,
-                promo_buy_quantity INTEGER DEFAULT 0,
-                promo_bonus_quantity INTEGER DEFAULT 0,
-                description TEXT,
-                format_data TEXT
-            )
-        """)
-        # Add price_usdt column if not exists (migration)
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN price_usdt REAL DEFAULT 0")
-        except:
-            pass
-        # Add format_data column if not exists (migration)
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN format_data TEXT")
-        except:
-            pass
-        # Add quantity pricing / promotion columns if not exists (migration)
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN price_tiers TEXT")
-        except:
-            pass
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN promo_buy_quantity INTEGER DEFAULT 0")
-        except:
-            pass
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN promo_bonus_quantity INTEGER DEFAULT 0")
-        except:
-            pass
-        # Product visibility / soft-delete columns
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN is_hidden INTEGER DEFAULT 0")
-        except:
-            pass
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN is_deleted INTEGER DEFAULT 0")
-        except:
-            pass
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN deleted_at TEXT")
-        except:
-            pass
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN sort_position INTEGER")
-        except:
-            pass
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS format_templates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                pattern TEXT NOT NULL,
-                created_at TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS stock (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                product_id INTEGER,
-                content TEXT NOT NULL,
-                sold INTEGER DEFAULT 0,
-                FOREIGN KEY (product_id) REFERENCES products(id)
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                product_id INTEGER,
-                content TEXT,
-                price INTEGER,
-                quantity INTEGER DEFAULT 1,
-                order_group TEXT,
-                created_at TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS deposits (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount INTEGER,
-                code TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS withdrawals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount INTEGER,
-                momo_phone TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS telegram_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                message_id INTEGER NOT NULL,
-                direction TEXT NOT NULL,
-                message_type TEXT DEFAULT 'text',
-                text TEXT,
-                payload TEXT,
-                sent_at TEXT,
-                created_at TEXT,
-                UNIQUE(chat_id, message_id)
-            )
-        """)
-        # Binance deposits table
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS binance_deposits (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                usdt_amount REAL,
-                vnd_amount INTEGER,
-                code TEXT,
-                screenshot_file_id TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TEXT
-            )
-        """)
-        # USDT withdrawals table
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS usdt_withdrawals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                usdt_amount REAL,
-                wallet_address TEXT,
-                network TEXT DEFAULT 'TRC20',
-                status TEXT DEFAULT 'pending',
-                created_at TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS direct_orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                product_id INTEGER,
-                quantity INTEGER DEFAULT 1,
-                bonus_quantity INTEGER DEFAULT 0,
-                unit_price INTEGER,
-                amount INTEGER,
-                code TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TEXT
-            )
-        """)
-        try:
-            await db.execute("ALTER TABLE direct_orders ADD COLUMN bonus_quantity INTEGER DEFAULT 0")
-        except:
-            pass
+    # Opening the pool creates the data directory and switches the file to WAL.
+    await _pool.open()
+    async with _pool.write() as db:
+        # No-op (single PRAGMA user_version read) when the schema is current.
+        await migrate(db)
+    _chat_log.start()
+
+
+def _telegram_message_row(chat_id, message_id, direction, message_type, text, payload, sent_at):
+    payload_text = json.dumps(payload, ensure_ascii=False) if payload is not None else None
+    sent_at_text = (
+        sent_at.isoformat()
+        if isinstance(sent_at, datetime)
+        else (str(sent_at) if sent_at else datetime.utcnow().isoformat())
+    )
+    created_at = datetime.utcnow().isoformat()
+    return (chat_id, message_id, str(direction), str(message_type), text, payload_text, sent_at_text, created_at)
+
+async def log_telegram_messages_bulk(rows):
+    """Ghi nhiều dòng telegram_messages trong 1 transaction (rows từ _telegram_message_row)."""
+    if not rows:
+        return
+    async with _pool.write() as db:
+        await db.executemany(
+            """
+            INSERT OR IGNORE INTO telegram_messages
+            (chat_id, message_id, direction, message_type, text, payload, sent_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
         await db.commit()
 
+# Chat history is buffered and written in batches by a background task (started in init_db)
+_chat_log = ChatLogWriter(log_telegram_messages_bulk)
+
+def get_chat_log_stats():
+    return _chat_log.get_stats()
 
 async def log_telegram_message(
     chat_id: int,
@@ -231,36 +151,27 @@ async def log_telegram_message(
     """
     SQLite fallback for chat history logging (used when Supabase is disabled).
     Best-effort: errors are swallowed to avoid breaking the bot.
+    Queued for the background writer when it is running, otherwise written inline.
     """
     if not chat_id or not message_id:
         return
 
     try:
-        payload_text = json.dumps(payload, ensure_ascii=False) if payload is not None else None
-        sent_at_text = (
-            sent_at.isoformat()
-            if isinstance(sent_at, datetime)
-            else (str(sent_at) if sent_at else datetime.utcnow().isoformat())
-        )
-        created_at = datetime.utcnow().isoformat()
-
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                """
-                INSERT OR IGNORE INTO telegram_messages
-                (chat_id, message_id, direction, message_type, text, payload, sent_at, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (chat_id, message_id, str(direction), str(message_type), text, payload_text, sent_at_text, created_at),
-            )
-            await db.commit()
+        row = _telegram_message_row(chat_id, message_id, direction, message_type, text, payload, sent_at)
+        if not _chat_log.enqueue(row):
+            await log_telegram_messages_bulk([row])
     except Exception:
         return
 
 # User functions
+# User ids known to have a row (bounded LRU), so ensure_user() is free for returning users
+_known_users = KnownUserCache()
+
 async def get_or_create_user(user_id: int, username: str = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id, username, balance, balance_usdt, language FROM users WHERE user_id = ?", (user_id,))
+    async with _pool.write() as db:
+        cursor = await db.execute(
+            "SELECT user_id, username, balance, balance_usdt, language, is_blocked FROM users WHERE user_id = ?", (user_id,)
+        )
         user = await cursor.fetchone()
         if not user:
             await db.execute(
@@ -268,109 +179,142 @@ async def get_or_create_user(user_id: int, username: str = None):
                 (user_id, username, datetime.now().isoformat())
             )
             await db.commit()
+            _known_users.add(user_id)
             return {"user_id": user_id, "username": username, "balance": 0, "balance_usdt": 0, "language": None}
+        if user[5]:
+            # /start again after blocking the bot: include them in broadcasts again.
+            await db.execute("UPDATE users SET is_blocked = 0 WHERE user_id = ?", (user_id,))
+            await db.commit()
+        _known_users.add(user_id)
         return {"user_id": user[0], "username": user[1], "balance": user[2], "balance_usdt": user[3] or 0, "language": user[4]}
 
+async def ensure_user(user_id: int, username: str = None):
+    """Hot path (mỗi tin nhắn): user đã biết -> không chạm DB; user mới -> 1 INSERT OR IGNORE."""
+    async def _create():
+        async with _pool.write() as db:
+            await db.execute(
+                "INSERT OR IGNORE INTO users (user_id, username, language, created_at) VALUES (?, ?, NULL, ?)",
+                (user_id, username, datetime.now().isoformat())
+            )
+            await db.commit()
+
+    await _known_users.ensure(user_id, _create)
+
 async def get_user_language(user_id: int) -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
         row = await cursor.fetchone()
         return row[0] if row and row[0] else "vi"
 
+async def get_user_profile(user_id: int):
+    """Ngôn ngữ + số dư VND/USDT trong 1 query (None nếu user chưa có)."""
+    async with _pool.read() as db:
+        cursor = await db.execute("SELECT language, balance, balance_usdt FROM users WHERE user_id = ?", (user_id,))
+        row = await cursor.fetchone()
+    if not row:
+        return None
+    _known_users.add(user_id)
+    return {"language": row[0] or "vi", "balance": row[1] or 0, "balance_usdt": row[2] or 0}
+
 async def set_user_language(user_id: int, language: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET language = ? WHERE user_id = ?", (language, user_id))
         await db.commit()
 
 async def get_balance(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
         row = await cursor.fetchone()
         return row[0] if row else 0
 
 async def get_balance_usdt(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute("SELECT balance_usdt FROM users WHERE user_id = ?", (user_id,))
         row = await cursor.fetchone()
         return row[0] if row and row[0] else 0
 
 async def update_balance(user_id: int, amount: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Cộng/trừ số dư. Returns the new balance."""
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+        cursor = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        row = await cursor.fetchone()
         await db.commit()
+        return row[0] if row else 0
 
 async def update_balance_usdt(user_id: int, amount: float):
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Cộng/trừ số dư USDT. Returns the new balance."""
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET balance_usdt = balance_usdt + ? WHERE user_id = ?", (amount, user_id))
+        cursor = await db.execute("SELECT balance_usdt FROM users WHERE user_id = ?", (user_id,))
+        row = await cursor.fetchone()
         await db.commit()
+        return row[0] if row and row[0] else 0
+
+async def debit_balance(user_id: int, amount: int):
+    """Trừ số dư nếu đủ tiền. Returns the new balance, or None when funds are short."""
+    async with _pool.write() as db:
+        cursor = await db.execute(
+            "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?", (amount, user_id, amount)
+        )
+        if cursor.rowcount == 0:
+            await db.rollback()
+            return None
+        cursor = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        row = await cursor.fetchone()
+        await db.commit()
+        return row[0] if row else 0
+
+async def debit_balance_usdt(user_id: int, amount: float):
+    """Trừ số dư USDT nếu đủ tiền. Returns the new balance, or None when funds are short."""
+    async with _pool.write() as db:
+        cursor = await db.execute(
+            "UPDATE users SET balance_usdt = balance_usdt - ? WHERE user_id = ? AND balance_usdt >= ?",
+            (amount, user_id, amount)
+        )
+        if cursor.rowcount == 0:
+            await db.rollback()
+            return None
+        cursor = await db.execute("SELECT balance_usdt FROM users WHERE user_id = ?", (user_id,))
+        row = await cursor.fetchone()
+        await db.commit()
+        return row[0] if row and row[0] else 0
 
 
 # Product functions
-async def get_products():
-    async with aiosqlite.connect(DB_PATH) as db:
+@single_flight
+async def _load_products():
+    async with _pool.read() as db:
+        # Stock counts come from product_stock_counts (maintained by triggers on stock).
         cursor = await db.execute(
             """
             SELECT
-                id, name, price, description, price_usdt, format_data,
-                price_tiers, promo_buy_quantity, promo_bonus_quantity, sort_position
-            FROM products
-            WHERE COALESCE(is_deleted, 0) = 0 AND COALESCE(is_hidden, 0) = 0
+                p.id, p.name, p.price, p.description, p.price_usdt, p.format_data,
+                p.price_tiers, p.promo_buy_quantity, p.promo_bonus_quantity, p.sort_position,
+                COALESCE(c.available, 0)
+            FROM products p
+            LEFT JOIN product_stock_counts c ON c.product_id = p.id
+            WHERE COALESCE(p.is_deleted, 0) = 0 AND COALESCE(p.is_hidden, 0) = 0
             ORDER BY
-                CASE WHEN sort_position IS NULL THEN 1 ELSE 0 END ASC,
-                sort_position ASC,
-                id ASC
+                CASE WHEN p.sort_position IS NULL THEN 1 ELSE 0 END ASC,
+                p.sort_position ASC,
+                p.id ASC
             """
         )
         rows = await cursor.fetchall()
-        products = []
-        for row in rows:
-            stock_cursor = await db.execute(
-                "SELECT COUNT(*) FROM stock WHERE product_id = ? AND sold = 0", (row[0],)
-            )
-            stock_count = (await stock_cursor.fetchone())[0]
-            products.append({
-                "id": row[0], "name": row[1], "price": row[2],
-                "description": row[3], "stock": stock_count, "price_usdt": row[4] or 0,
-                "format_data": row[5],
-                "price_tiers": _parse_json_list(row[6]),
-                "promo_buy_quantity": row[7] or 0,
-                "promo_bonus_quantity": row[8] or 0,
-                "sort_position": row[9] if row[9] is not None else None,
-            })
-        return products
+        return [_product_row_to_dict(row) for row in rows]
+
+# Catalog is read on every menu/buy step; served from memory, writes below keep it current.
+_catalog = CatalogCache(_load_products)
+
+def get_catalog_version() -> int:
+    return _catalog.version
+
+async def get_products():
+    return await _catalog.products()
 
 async def get_product(product_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            """
-            SELECT
-                id, name, price, description, price_usdt, format_data,
-                price_tiers, promo_buy_quantity, promo_bonus_quantity, sort_position
-            FROM products
-            WHERE id = ? AND COALESCE(is_deleted, 0) = 0 AND COALESCE(is_hidden, 0) = 0
-            """,
-            (product_id,)
-        )
-        row = await cursor.fetchone()
-        if row:
-            stock_cursor = await db.execute(
-                "SELECT COUNT(*) FROM stock WHERE product_id = ? AND sold = 0", (row[0],)
-            )
-            stock_count = (await stock_cursor.fetchone())[0]
-            return {
-                "id": row[0],
-                "name": row[1],
-                "price": row[2],
-                "description": row[3],
-                "stock": stock_count,
-                "price_usdt": row[4] or 0,
-                "format_data": row[5],
-                "price_tiers": _parse_json_list(row[6]),
-                "promo_buy_quantity": row[7] or 0,
-                "promo_bonus_quantity": row[8] or 0,
-                "sort_position": row[9] if row[9] is not None else None,
-            }
-        return None
+    return await _catalog.product(product_id)
 
 async def add_product(
     name: str,
@@ -383,7 +327,7 @@ async def add_product(
     promo_bonus_quantity: int = 0,
     sort_position: int = None,
 ):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         cursor = await db.execute(
             """
             INSERT INTO products
@@ -403,37 +347,42 @@ async def add_product(
             ),
         )
         await db.commit()
-        return cursor.lastrowid
+    _catalog.invalidate()
+    return cursor.lastrowid
 
 async def update_product_price_usdt(product_id: int, price_usdt: float):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE products SET price_usdt = ? WHERE id = ?", (price_usdt, product_id))
         await db.commit()
+    _catalog.invalidate()
 
 async def delete_product(product_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
             "UPDATE products SET is_hidden = 1, is_deleted = 1, deleted_at = ? WHERE id = ?",
             (datetime.now().isoformat(), product_id)
         )
         await db.commit()
+    _catalog.invalidate()
 
 async def add_stock(product_id: int, content: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("INSERT INTO stock (product_id, content) VALUES (?, ?)", (product_id, content))
         await db.commit()
+    _catalog.adjust_stock(product_id, 1)
 
 async def add_stock_bulk(product_id: int, contents: list):
     """Thêm nhiều stock cùng lúc - tối ưu cho vài trăm items"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.executemany(
             "INSERT INTO stock (product_id, content) VALUES (?, ?)",
             [(product_id, content) for content in contents]
         )
         await db.commit()
+    _catalog.adjust_stock(product_id, len(contents))
 
 async def get_available_stock(product_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
             "SELECT id, content FROM stock WHERE product_id = ? AND sold = 0 LIMIT 1", (product_id,)
         )
@@ -441,39 +390,41 @@ async def get_available_stock(product_id: int):
 
 async def get_available_stock_batch(product_id: int, quantity: int):
     """Lấy nhiều stock cùng lúc - tối ưu cho mua số lượng lớn"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            "SELECT id, content FROM stock WHERE product_id = ? AND sold = 0 LIMIT ?",
+            SQL_STOCK_TAKE_UNSOLD,
             (product_id, quantity)
         )
         return await cursor.fetchall()
 
 async def mark_stock_sold(stock_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE stock SET sold = 1 WHERE id = ?", (stock_id,))
         await db.commit()
+    _catalog.invalidate()
 
 async def mark_stock_sold_batch(stock_ids: list):
     """Mark nhiều stock sold cùng lúc"""
     if not stock_ids:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         placeholders = ",".join("?" * len(stock_ids))
         await db.execute(f"UPDATE stock SET sold = 1 WHERE id IN ({placeholders})", stock_ids)
         await db.commit()
+    _catalog.invalidate()
 
 async def get_stock_by_product(product_id: int):
     """Lấy tất cả stock của sản phẩm"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            "SELECT id, content, sold FROM stock WHERE product_id = ? ORDER BY sold ASC, id DESC",
+            SQL_STOCK_BY_PRODUCT,
             (product_id,)
         )
         return await cursor.fetchall()
 
 async def get_stock_detail(stock_id: int):
     """Lấy chi tiết một stock"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
             "SELECT id, product_id, content, sold FROM stock WHERE id = ?",
             (stock_id,)
@@ -482,31 +433,33 @@ async def get_stock_detail(stock_id: int):
 
 async def update_stock_content(stock_id: int, new_content: str):
     """Cập nhật nội dung stock"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE stock SET content = ? WHERE id = ?", (new_content, stock_id))
         await db.commit()
 
 async def delete_stock(stock_id: int):
     """Xóa một stock"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("DELETE FROM stock WHERE id = ?", (stock_id,))
         await db.commit()
+    _catalog.invalidate()
 
 async def delete_all_stock(product_id: int, only_unsold: bool = False):
     """Xóa tất cả stock của sản phẩm"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         if only_unsold:
             await db.execute("DELETE FROM stock WHERE product_id = ? AND sold = 0", (product_id,))
         else:
             await db.execute("DELETE FROM stock WHERE product_id = ?", (product_id,))
         await db.commit()
+    _catalog.invalidate()
 
 async def export_stock(product_id: int, only_unsold: bool = True):
     """Export stock ra list để tải file"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         if only_unsold:
             cursor = await db.execute(
-                "SELECT content FROM stock WHERE product_id = ? AND sold = 0 ORDER BY id",
+                SQL_STOCK_EXPORT_UNSOLD,
                 (product_id,)
             )
         else:
@@ -516,7 +469,6 @@ async def export_stock(product_id: int, only_unsold: bool = True):
             )
         rows = await cursor.fetchall()
         return [row[0] for row in rows]
-        await db.commit()
 
 # Order functions
 async def create_order_bulk(
@@ -529,7 +481,7 @@ async def create_order_bulk(
     quantity: int = None,
 ):
     """Tạo đơn hàng với nhiều items cùng lúc"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         created_at = datetime.now().isoformat()
         final_quantity = quantity if quantity is not None else len(contents)
         final_total = total_price if total_price is not None else price_per_item * len(contents)
@@ -543,27 +495,131 @@ async def create_order_bulk(
 
 async def create_order(user_id: int, product_id: int, content: str, price: int):
     """Legacy - tạo đơn hàng 1 item"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
             "INSERT INTO orders (user_id, product_id, content, price, quantity, created_at) VALUES (?, ?, ?, ?, ?, ?)",
             (user_id, product_id, content, price, 1, datetime.now().isoformat())
         )
         await db.commit()
 
+async def checkout(user_id: int, product_id: int, quantity: int, currency: str = "vnd", usdt_rate: int = 0):
+    """
+    Mua bằng số dư trong 1 transaction (BEGIN IMMEDIATE): lấy stock, trừ tiền, tạo đơn.
+    USDT orders are recorded in VND (`usdt_rate` VND per USDT), like the handlers did.
+    Returns a dict: ok, error (invalid_quantity/product_not_found/out_of_stock/insufficient_balance),
+    items, quantity, bonus_quantity, unit_price, total_price, balance, available, order_group.
+    """
+    result = {
+        "ok": False, "error": None, "items": [], "quantity": int(quantity or 0),
+        "bonus_quantity": 0, "unit_price": 0, "total_price": 0,
+        "balance": 0, "available": 0, "order_group": None,
+    }
+    if result["quantity"] < 1:
+        result["error"] = "invalid_quantity"
+        return result
+    balance_column = "balance_usdt" if currency == "usdt" else "balance"
+
+    async with _pool.write() as db:
+        if db.in_transaction:
+            await db.commit()
+        # Takes the write lock up front so no other connection/process can sell the same rows.
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = await db.execute(
+                """
+                SELECT
+                    p.id, p.name, p.price, p.description, p.price_usdt, p.format_data,
+                    p.price_tiers, p.promo_buy_quantity, p.promo_bonus_quantity, p.sort_position,
+                    COALESCE(c.available, 0)
+                FROM products p
+                LEFT JOIN product_stock_counts c ON c.product_id = p.id
+                WHERE p.id = ? AND COALESCE(p.is_deleted, 0) = 0 AND COALESCE(p.is_hidden, 0) = 0
+                """,
+                (product_id,)
+            )
+            row = await cursor.fetchone()
+            if not row:
+                result["error"] = "product_not_found"
+                await db.rollback()
+                return result
+            product = _product_row_to_dict(row)
+            pricing = get_pricing_snapshot(product, result["quantity"], currency)
+            required_stock = int(pricing["delivered_quantity"])
+            total_price = pricing["total_price"] if currency == "usdt" else int(pricing["total_price"])
+            result.update({
+                "bonus_quantity": int(pricing["bonus_quantity"]),
+                "unit_price": pricing["unit_price"],
+                "total_price": total_price,
+                "available": product["stock"],
+            })
+
+            cursor = await db.execute(f"SELECT {balance_column} FROM users WHERE user_id = ?", (user_id,))
+            row = await cursor.fetchone()
+            balance = (row[0] or 0) if row else 0
+            result["balance"] = balance
+            if balance < total_price:
+                result["error"] = "insufficient_balance"
+                await db.rollback()
+                return result
+
+            cursor = await db.execute(
+                SQL_STOCK_CHECKOUT_UNSOLD,
+                (product_id, required_stock)
+            )
+            stocks = await cursor.fetchall()
+            if len(stocks) < required_stock:
+                result["error"] = "out_of_stock"
+                result["available"] = len(stocks)
+                await db.rollback()
+                # Cached stock was higher than what is really left.
+                _catalog.invalidate()
+                return result
+
+            stock_ids = [s[0] for s in stocks]
+            items = [s[1] for s in stocks]
+            placeholders = ",".join("?" * len(stock_ids))
+            await db.execute(f"UPDATE stock SET sold = 1 WHERE id IN ({placeholders})", stock_ids)
+
+            # Lưu giá theo VNĐ để thống kê
+            total_for_order = int(total_price * usdt_rate) if currency == "usdt" else total_price
+            order_group = f"ORD{user_id}{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            await db.execute(
+                "INSERT INTO orders (user_id, product_id, content, price, quantity, order_group, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, product_id, json.dumps(items), int(total_for_order), len(items), order_group, datetime.now().isoformat())
+            )
+            await db.execute(
+                f"UPDATE users SET {balance_column} = {balance_column} - ? WHERE user_id = ?",
+                (total_price, user_id)
+            )
+            cursor = await db.execute(f"SELECT {balance_column} FROM users WHERE user_id = ?", (user_id,))
+            row = await cursor.fetchone()
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+    _catalog.adjust_stock(product_id, -len(items))
+    result.update({
+        "ok": True,
+        "items": items,
+        "balance": (row[0] or 0) if row else 0,
+        "available": result["available"] - len(items),
+        "order_group": order_group,
+    })
+    return result
+
 async def get_user_orders(user_id: int):
     """Lấy lịch sử đơn hàng - gom theo order_group hoặc từng đơn"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            """SELECT o.id, p.name, o.content, o.price, o.created_at, o.quantity
-               FROM orders o JOIN products p ON o.product_id = p.id 
-               WHERE o.user_id = ? ORDER BY o.created_at DESC LIMIT 20""",
+            SQL_ORDERS_BY_USER,
             (user_id,)
         )
         return await cursor.fetchall()
 
 async def get_order_detail(order_id: int):
     """Lấy chi tiết 1 đơn hàng"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
             """SELECT o.id, p.name, o.content, o.price, o.created_at, o.quantity
                FROM orders o JOIN products p ON o.product_id = p.id 
@@ -574,20 +630,16 @@ async def get_order_detail(order_id: int):
 
 async def get_sold_codes_by_product(product_id: int, limit: int = 100):
     """Lấy danh sách code đã bán theo sản phẩm"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            """SELECT o.id, o.user_id, o.content, o.price, o.quantity, o.created_at
-               FROM orders o
-               WHERE o.product_id = ?
-               ORDER BY o.created_at DESC
-               LIMIT ?""",
+            SQL_ORDERS_BY_PRODUCT,
             (product_id, limit)
         )
         return await cursor.fetchall()
 
 async def get_sold_codes_by_user(user_id: int, limit: int = 50):
     """Lấy danh sách code đã bán cho 1 user"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
             """SELECT o.id, p.name, o.content, o.price, o.quantity, o.created_at
                FROM orders o JOIN products p ON o.product_id = p.id
@@ -600,7 +652,7 @@ async def get_sold_codes_by_user(user_id: int, limit: int = 50):
 
 async def search_user_by_id(user_id: int):
     """Tìm user theo ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
             "SELECT user_id, username, balance, created_at FROM users WHERE user_id = ?",
             (user_id,)
@@ -613,12 +665,12 @@ async def create_deposit_with_settings(user_id: int, amount: int, code: str):
     return await get_bank_settings()
 
 async def create_deposit(user_id: int, amount: int, code: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
             "INSERT INTO deposits (user_id, amount, code, created_at) VALUES (?, ?, ?, ?)",
             (user_id, amount, code, datetime.now().isoformat())
         )
-    await db.commit()
+        await db.commit()
 
 # Direct order functions
 async def create_direct_order_with_settings(
@@ -642,7 +694,7 @@ async def create_direct_order(
     code: str,
     bonus_quantity: int = 0,
 ):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
             """INSERT INTO direct_orders (user_id, product_id, quantity, bonus_quantity, unit_price, amount, code, created_at)
                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
@@ -651,27 +703,44 @@ async def create_direct_order(
         await db.commit()
 
 async def get_pending_direct_orders():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            """SELECT id, user_id, product_id, quantity, bonus_quantity, unit_price, amount, code, created_at
-               FROM direct_orders WHERE status = 'pending'"""
+            SQL_DIRECT_ORDERS_PENDING
         )
         return await cursor.fetchall()
 
 async def set_direct_order_status(order_id: int, status: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE direct_orders SET status = ? WHERE id = ?", (status, order_id))
         await db.commit()
 
+async def cancel_pending_direct_orders(codes: list):
+    """Cancel the direct orders with these codes that are still pending, in one UPDATE.
+    Returns (id, user_id, code) of the rows actually cancelled (paid orders are left alone)."""
+    codes = list(dict.fromkeys(code for code in codes if code))
+    if not codes:
+        return []
+    async with _pool.write() as db:
+        placeholders = ",".join("?" * len(codes))
+        cursor = await db.execute(
+            f"""UPDATE direct_orders SET status = 'cancelled'
+                WHERE status = 'pending' AND code IN ({placeholders})
+                RETURNING id, user_id, code""",
+            codes,
+        )
+        rows = await cursor.fetchall()
+        await db.commit()
+        return [tuple(row) for row in rows]
+
 async def get_pending_deposits():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            "SELECT id, user_id, amount, code, created_at FROM deposits WHERE status = 'pending'"
+            SQL_DEPOSITS_PENDING
         )
         return await cursor.fetchall()
 
 async def confirm_deposit(deposit_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         cursor = await db.execute("SELECT user_id, amount FROM deposits WHERE id = ?", (deposit_id,))
         row = await cursor.fetchone()
         if row:
@@ -682,33 +751,127 @@ async def confirm_deposit(deposit_id: int):
         return None
 
 async def cancel_deposit(deposit_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE deposits SET status = 'cancelled' WHERE id = ?", (deposit_id,))
         await db.commit()
 
 async def set_deposit_status(deposit_id: int, status: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE deposits SET status = ? WHERE id = ?", (status, deposit_id))
         await db.commit()
 
 # Stats
+@single_flight
 async def get_stats():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         users = (await (await db.execute("SELECT COUNT(*) FROM users")).fetchone())[0]
         orders = (await (await db.execute("SELECT COUNT(*) FROM orders")).fetchone())[0]
         revenue = (await (await db.execute("SELECT COALESCE(SUM(price), 0) FROM orders")).fetchone())[0]
         return {"users": users, "orders": orders, "revenue": revenue}
 
+USER_ID_PAGE_SIZE = 1000
+
+async def iter_user_ids(after_user_id: int = 0, page_size: int = USER_ID_PAGE_SIZE, skip_blocked: bool = False):
+    """
+    Duyệt user_id tăng dần theo trang (keyset: user_id > id cuối trang trước).
+    Mỗi trang là một query ngắn, không giữ connection đọc giữa các trang (caller có thể gửi tin lâu).
+    """
+    page_size = max(1, int(page_size))
+    last_id = after_user_id
+    blocked_filter = " AND COALESCE(is_blocked, 0) = 0" if skip_blocked else ""
+    while True:
+        async with _pool.read() as db:
+            cursor = await db.execute(
+                f"SELECT user_id FROM users WHERE user_id > ?{blocked_filter} ORDER BY user_id LIMIT ?",
+                (last_id, page_size)
+            )
+            rows = await cursor.fetchmany(page_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row[0]
+        last_id = rows[-1][0]
+
 async def get_all_user_ids():
-    """Lấy tất cả user_id để gửi thông báo"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id FROM users")
-        rows = await cursor.fetchall()
-        return [row[0] for row in rows]
+    """Lấy tất cả user_id (dùng iter_user_ids() cho danh sách lớn)"""
+    return [user_id async for user_id in iter_user_ids()]
+
+# Broadcast functions
+_BROADCAST_JOB_COLUMNS = (
+    "id, text, status, admin_chat_id, progress_message_id, total, sent, failed, blocked, "
+    "last_user_id, created_at, updated_at, finished_at"
+)
+
+def _broadcast_job_row_to_dict(row):
+    keys = [c.strip() for c in _BROADCAST_JOB_COLUMNS.split(",")]
+    return dict(zip(keys, row))
+
+async def count_broadcast_recipients() -> int:
+    async with _pool.read() as db:
+        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE COALESCE(is_blocked, 0) = 0")
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+async def mark_users_blocked(user_ids: list):
+    if not user_ids:
+        return
+    async with _pool.write() as db:
+        placeholders = ",".join("?" * len(user_ids))
+        await db.execute(f"UPDATE users SET is_blocked = 1 WHERE user_id IN ({placeholders})", list(user_ids))
+        await db.commit()
+
+async def create_broadcast_job(text: str, admin_chat_id: int, total: int):
+    now = datetime.now().isoformat()
+    async with _pool.write() as db:
+        cursor = await db.execute(
+            "INSERT INTO broadcast_jobs (text, status, admin_chat_id, total, created_at, updated_at) VALUES (?, 'running', ?, ?, ?, ?)",
+            (text, admin_chat_id, total, now, now)
+        )
+        await db.commit()
+        return cursor.lastrowid
+
+async def get_broadcast_job(job_id: int):
+    async with _pool.read() as db:
+        cursor = await db.execute(f"SELECT {_BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE id = ?", (job_id,))
+        row = await cursor.fetchone()
+        return _broadcast_job_row_to_dict(row) if row else None
+
+async def get_running_broadcast_jobs():
+    async with _pool.read() as db:
+        cursor = await db.execute(
+            f"SELECT {_BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE status = 'running' ORDER BY id"
+        )
+        return [_broadcast_job_row_to_dict(row) for row in await cursor.fetchall()]
+
+async def set_broadcast_progress_message(job_id: int, message_id: int):
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE broadcast_jobs SET progress_message_id = ?, updated_at = ? WHERE id = ?",
+            (message_id, datetime.now().isoformat(), job_id)
+        )
+        await db.commit()
+
+async def save_broadcast_progress(job_id: int, last_user_id: int, sent: int, failed: int, blocked: int):
+    """Checkpoint sau mỗi trang: khi restart, job chạy tiếp từ user_id > last_user_id."""
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE broadcast_jobs SET last_user_id = ?, sent = ?, failed = ?, blocked = ?, updated_at = ? WHERE id = ?",
+            (last_user_id, sent, failed, blocked, datetime.now().isoformat(), job_id)
+        )
+        await db.commit()
+
+async def finish_broadcast_job(job_id: int, status: str = "done"):
+    now = datetime.now().isoformat()
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE broadcast_jobs SET status = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+            (status, now, now, job_id)
+        )
+        await db.commit()
 
 # Withdrawal functions
 async def create_withdrawal(user_id: int, amount: int, momo_phone: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         # Chỉ tạo yêu cầu, KHÔNG trừ tiền - sẽ trừ khi admin duyệt
         await db.execute(
             "INSERT INTO withdrawals (user_id, amount, momo_phone, created_at) VALUES (?, ?, ?, ?)",
@@ -717,15 +880,15 @@ async def create_withdrawal(user_id: int, amount: int, momo_phone: str):
         await db.commit()
 
 async def get_pending_withdrawals():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            "SELECT id, user_id, amount, momo_phone, created_at FROM withdrawals WHERE status = 'pending'"
+            SQL_WITHDRAWALS_PENDING
         )
         return await cursor.fetchall()
 
 async def get_withdrawal_detail(withdrawal_id: int):
     """Lấy chi tiết một yêu cầu rút tiền"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
             "SELECT id, user_id, amount, momo_phone, status, created_at FROM withdrawals WHERE id = ?",
             (withdrawal_id,)
@@ -734,16 +897,16 @@ async def get_withdrawal_detail(withdrawal_id: int):
 
 async def get_user_pending_withdrawal(user_id: int):
     """Kiểm tra user có yêu cầu rút tiền đang pending không, trả về số tiền pending"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            "SELECT SUM(amount) FROM withdrawals WHERE user_id = ? AND status = 'pending'",
+            SQL_WITHDRAWALS_PENDING_SUM,
             (user_id,)
         )
         row = await cursor.fetchone()
         return row[0] if row and row[0] else 0
 
 async def confirm_withdrawal(withdrawal_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         cursor = await db.execute("SELECT user_id, amount, momo_phone FROM withdrawals WHERE id = ?", (withdrawal_id,))
         row = await cursor.fetchone()
         if row:
@@ -763,7 +926,7 @@ async def confirm_withdrawal(withdrawal_id: int):
         return None
 
 async def cancel_withdrawal(withdrawal_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         cursor = await db.execute("SELECT user_id, amount FROM withdrawals WHERE id = ?", (withdrawal_id,))
         row = await cursor.fetchone()
         if row:
@@ -774,31 +937,46 @@ async def cancel_withdrawal(withdrawal_id: int):
         return None
 
 # Settings functions
-async def get_setting(key: str, default: str = ""):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT value FROM settings WHERE key = ?", (key,))
+@single_flight
+async def _load_all_settings():
+    async with _pool.read() as db:
+        cursor = await db.execute("SELECT key, value FROM settings")
+        return {row[0]: row[1] for row in await cursor.fetchall()}
+
+@single_flight
+async def _load_settings_version():
+    async with _pool.read() as db:
+        cursor = await db.execute("SELECT value FROM settings WHERE key = ?", (SETTINGS_VERSION_KEY,))
         row = await cursor.fetchone()
-        return row[0] if row else default
+        return row[0] if row else None
+
+# Cả bảng settings trong RAM; chỉ đọc lại khi settings_version đổi (trigger, migration 4)
+_settings = SettingsSnapshot(_load_all_settings, _load_settings_version)
+
+async def get_setting(key: str, default: str = ""):
+    return await _settings.get(key, default)
 
 async def set_setting(key: str, value: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
             "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
             (key, value)
         )
         await db.commit()
+    _settings.set_local(key, value)
 
 async def get_bank_settings():
+    settings = await _settings.values()
     return {
-        "bank_name": await get_setting("bank_name", ""),
-        "account_number": await get_setting("account_number", ""),
-        "account_name": await get_setting("account_name", ""),
-        "sepay_token": await get_setting("sepay_token", ""),
+        "bank_name": settings.get("bank_name") or "",
+        "account_number": settings.get("account_number") or "",
+        "account_name": settings.get("account_name") or "",
+        "sepay_token": settings.get("sepay_token") or "",
     }
 
 # Binance deposit functions
 async def create_binance_deposit(user_id: int, usdt_amount: float, vnd_amount: int, code: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
             "INSERT INTO binance_deposits (user_id, usdt_amount, vnd_amount, code, created_at) VALUES (?, ?, ?, ?, ?)",
             (user_id, usdt_amount, vnd_amount, code, datetime.now().isoformat())
@@ -807,22 +985,22 @@ async def create_binance_deposit(user_id: int, usdt_amount: float, vnd_amount: i
 
 async def update_binance_deposit_screenshot(user_id: int, code: str, file_id: str):
     """Cập nhật screenshot cho deposit"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
-            "UPDATE binance_deposits SET screenshot_file_id = ? WHERE user_id = ? AND code = ? AND status = 'pending'",
+            SQL_BINANCE_DEPOSIT_SET_SCREENSHOT,
             (file_id, user_id, code)
         )
         await db.commit()
 
 async def get_pending_binance_deposits():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            "SELECT id, user_id, usdt_amount, vnd_amount, code, screenshot_file_id, created_at FROM binance_deposits WHERE status = 'pending' AND screenshot_file_id IS NOT NULL"
+            SQL_BINANCE_DEPOSITS_PENDING
         )
         return await cursor.fetchall()
 
 async def get_binance_deposit_detail(deposit_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
             "SELECT id, user_id, usdt_amount, vnd_amount, code, screenshot_file_id, status, created_at FROM binance_deposits WHERE id = ?",
             (deposit_id,)
@@ -830,7 +1008,7 @@ async def get_binance_deposit_detail(deposit_id: int):
         return await cursor.fetchone()
 
 async def confirm_binance_deposit(deposit_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         cursor = await db.execute("SELECT user_id, usdt_amount FROM binance_deposits WHERE id = ?", (deposit_id,))
         row = await cursor.fetchone()
         if row:
@@ -841,15 +1019,15 @@ async def confirm_binance_deposit(deposit_id: int):
         return None
 
 async def cancel_binance_deposit(deposit_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE binance_deposits SET status = 'cancelled' WHERE id = ?", (deposit_id,))
         await db.commit()
 
 async def get_user_pending_binance_deposit(user_id: int):
     """Lấy deposit binance đang pending của user"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            "SELECT id, usdt_amount, vnd_amount, code FROM binance_deposits WHERE user_id = ? AND status = 'pending' ORDER BY id DESC LIMIT 1",
+            SQL_BINANCE_DEPOSIT_USER_PENDING,
             (user_id,)
         )
         return await cursor.fetchone()
@@ -857,7 +1035,7 @@ async def get_user_pending_binance_deposit(user_id: int):
 
 # USDT Withdrawal functions
 async def create_usdt_withdrawal(user_id: int, usdt_amount: float, wallet_address: str, network: str = "TRC20"):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
             "INSERT INTO usdt_withdrawals (user_id, usdt_amount, wallet_address, network, created_at) VALUES (?, ?, ?, ?, ?)",
             (user_id, usdt_amount, wallet_address, network, datetime.now().isoformat())
@@ -865,14 +1043,14 @@ async def create_usdt_withdrawal(user_id: int, usdt_amount: float, wallet_addres
         await db.commit()
 
 async def get_pending_usdt_withdrawals():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            "SELECT id, user_id, usdt_amount, wallet_address, network, created_at FROM usdt_withdrawals WHERE status = 'pending'"
+            SQL_USDT_WITHDRAWALS_PENDING
         )
         return await cursor.fetchall()
 
 async def get_usdt_withdrawal_detail(withdrawal_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
             "SELECT id, user_id, usdt_amount, wallet_address, network, status, created_at FROM usdt_withdrawals WHERE id = ?",
             (withdrawal_id,)
@@ -881,16 +1059,16 @@ async def get_usdt_withdrawal_detail(withdrawal_id: int):
 
 async def get_user_pending_usdt_withdrawal(user_id: int):
     """Kiểm tra user có yêu cầu rút USDT đang pending không"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute(
-            "SELECT SUM(usdt_amount) FROM usdt_withdrawals WHERE user_id = ? AND status = 'pending'",
+            SQL_USDT_WITHDRAWALS_PENDING_SUM,
             (user_id,)
         )
         row = await cursor.fetchone()
         return row[0] if row and row[0] else 0
 
 async def confirm_usdt_withdrawal(withdrawal_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         cursor = await db.execute("SELECT user_id, usdt_amount, wallet_address FROM usdt_withdrawals WHERE id = ?", (withdrawal_id,))
         row = await cursor.fetchone()
         if row:
@@ -910,7 +1088,7 @@ async def confirm_usdt_withdrawal(withdrawal_id: int):
         return None
 
 async def cancel_usdt_withdrawal(withdrawal_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         cursor = await db.execute("SELECT user_id, usdt_amount FROM usdt_withdrawals WHERE id = ?", (withdrawal_id,))
         row = await cursor.fetchone()
         if row:
@@ -921,23 +1099,47 @@ async def cancel_usdt_withdrawal(withdrawal_id: int):
 
 # SePay processed transactions
 async def is_processed_transaction(tx_id: str) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.read() as db:
         cursor = await db.execute("SELECT 1 FROM processed_transactions WHERE tx_id = ?", (tx_id,))
         return await cursor.fetchone() is not None
 
 async def mark_processed_transaction(tx_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("INSERT INTO processed_transactions (tx_id) VALUES (?)", (tx_id,))
         await db.commit()
 
+# SQLite caps bound parameters per statement (999 on older builds)
+PROCESSED_TX_QUERY_CHUNK = 500
+
+async def get_processed_transaction_ids(tx_ids: list) -> set:
+    """Which of tx_ids are already processed (one query per PROCESSED_TX_QUERY_CHUNK ids)."""
+    ids = list(dict.fromkeys(str(tx_id) for tx_id in tx_ids if tx_id))
+    found = set()
+    async with _pool.read() as db:
+        for start in range(0, len(ids), PROCESSED_TX_QUERY_CHUNK):
+            chunk = ids[start:start + PROCESSED_TX_QUERY_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            cursor = await db.execute(f"SELECT tx_id FROM processed_transactions WHERE tx_id IN ({placeholders})", chunk)
+            found.update(str(row[0]) for row in await cursor.fetchall())
+    return found
+
+async def get_recent_processed_transaction_ids(limit: int = 5000) -> list:
+    """Newest processed tx ids first (warms the SePay checker's in-memory set)."""
+    async with _pool.read() as db:
+        cursor = await db.execute(
+            "SELECT tx_id FROM processed_transactions ORDER BY processed_at DESC, rowid DESC LIMIT ?", (limit,)
+        )
+        return [str(row[0]) for row in await cursor.fetchall()]
+
 async def get_ui_flags():
+    settings = await _settings.values()
     return {
-        "show_shop": _parse_bool(await get_setting("show_shop", "true")),
-        "show_balance": _parse_bool(await get_setting("show_balance", "true")),
-        "show_deposit": _parse_bool(await get_setting("show_deposit", "true")),
-        "show_withdraw": _parse_bool(await get_setting("show_withdraw", "true")),
-        "show_usdt": _parse_bool(await get_setting("show_usdt", "true")),
-        "show_history": _parse_bool(await get_setting("show_history", "true")),
-        "show_language": _parse_bool(await get_setting("show_language", "true")),
-        "show_support": _parse_bool(await get_setting("show_support", "true")),
+        "show_shop": _parse_bool(settings.get("show_shop", "true")),
+        "show_balance": _parse_bool(settings.get("show_balance", "true")),
+        "show_deposit": _parse_bool(settings.get("show_deposit", "true")),
+        "show_withdraw": _parse_bool(settings.get("show_withdraw", "true")),
+        "show_usdt": _parse_bool(settings.get("show_usdt", "true")),
+        "show_history": _parse_bool(settings.get("show_history", "true")),
+        "show_language": _parse_bool(settings.get("show_language", "true")),
+        "show_support": _parse_bool(settings.get("show_support", "true")),
     }
@@ -0,0 +1,75 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+# ~100 bytes per id; 50k ids is a few MB. Least recently seen ids are dropped first.
+KNOWN_USERS_CACHE_SIZE = max(1, _env_int("KNOWN_USERS_CACHE_SIZE", 50000))
+
+
+class KnownUserCache:
+    """
+    Bounded LRU set of user ids that already have a `users` row.
+
+    `ensure(user_id, create)` is free for cached ids; for unknown ids it runs
+    `create()` once, and concurrent callers for the same id await that same call.
+    """
+
+    def __init__(self, max_size: int = KNOWN_USERS_CACHE_SIZE):
+        self.max_size = max(1, int(max_size))
+        self._ids: "OrderedDict[int, None]" = OrderedDict()
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    def __contains__(self, user_id: int) -> bool:
+        if user_id in self._ids:
+            self._ids.move_to_end(user_id)
+            return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, user_id: int):
+        self._ids[user_id] = None
+        self._ids.move_to_end(user_id)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def discard(self, user_id: int):
+        self._ids.pop(user_id, None)
+
+    def clear(self):
+        self._ids.clear()
+
+    async def ensure(self, user_id: int, create: Callable[[], Awaitable[Any]]):
+        if user_id in self:
+            return
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            await pending
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[user_id] = future
+        try:
+            await create()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()  # mark retrieved: there may be no waiters
+            raise
+        else:
+            self.add(user_id)
+            future.set_result(None)
+        finally:
+            self._pending.pop(user_id, None)
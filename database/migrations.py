@@ -0,0 +1,355 @@
+"""
+Versioned schema migrations for the SQLite backend.
+
+The applied version is stored in `PRAGMA user_version` (one header read on
+boot) and every applied step is recorded in the `schema_version` table.
+
+CLI: `python -m database status|upgrade` (see database/__main__.py).
+"""
+from datetime import datetime
+
+
+async def _table_columns(db, table: str) -> set:
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in await cursor.fetchall()}
+
+
+async def _add_column_if_missing(db, table: str, column: str, definition: str):
+    if column not in await _table_columns(db, table):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+async def _m001_baseline(db):
+    """Tables that init_db()/init_checker_db() used to create on every boot."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            balance INTEGER DEFAULT 0,
+            balance_usdt REAL DEFAULT 0,
+            language TEXT DEFAULT 'vi',
+            created_at TEXT
+        )
+    """)
+    await _add_column_if_missing(db, "users", "balance_usdt", "REAL DEFAULT 0")
+    await _add_column_if_missing(db, "users", "language", "TEXT DEFAULT 'vi'")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            price_usdt REAL DEFAULT 0,
+            price_tiers TEXT,
+            promo_buy_quantity INTEGER DEFAULT 0,
+            promo_bonus_quantity INTEGER DEFAULT 0,
+            description TEXT,
+            format_data TEXT,
+            is_hidden INTEGER DEFAULT 0,
+            is_deleted INTEGER DEFAULT 0,
+            deleted_at TEXT,
+            sort_position INTEGER
+        )
+    """)
+    await _add_column_if_missing(db, "products", "price_usdt", "REAL DEFAULT 0")
+    await _add_column_if_missing(db, "products", "format_data", "TEXT")
+    await _add_column_if_missing(db, "products", "price_tiers", "TEXT")
+    await _add_column_if_missing(db, "products", "promo_buy_quantity", "INTEGER DEFAULT 0")
+    await _add_column_if_missing(db, "products", "promo_bonus_quantity", "INTEGER DEFAULT 0")
+    await _add_column_if_missing(db, "products", "is_hidden", "INTEGER DEFAULT 0")
+    await _add_column_if_missing(db, "products", "is_deleted", "INTEGER DEFAULT 0")
+    await _add_column_if_missing(db, "products", "deleted_at", "TEXT")
+    await _add_column_if_missing(db, "products", "sort_position", "INTEGER")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS format_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            pattern TEXT NOT NULL,
+            created_at TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS stock (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER,
+            content TEXT NOT NULL,
+            sold INTEGER DEFAULT 0,
+            FOREIGN KEY (product_id) REFERENCES products(id)
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            product_id INTEGER,
+            content TEXT,
+            price INTEGER,
+            quantity INTEGER DEFAULT 1,
+            order_group TEXT,
+            created_at TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS deposits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER,
+            code TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER,
+            momo_phone TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS telegram_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            direction TEXT NOT NULL,
+            message_type TEXT DEFAULT 'text',
+            text TEXT,
+            payload TEXT,
+            sent_at TEXT,
+            created_at TEXT,
+            UNIQUE(chat_id, message_id)
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS binance_deposits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            usdt_amount REAL,
+            vnd_amount INTEGER,
+            code TEXT,
+            screenshot_file_id TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS usdt_withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            usdt_amount REAL,
+            wallet_address TEXT,
+            network TEXT DEFAULT 'TRC20',
+            status TEXT DEFAULT 'pending',
+            created_at TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS direct_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            product_id INTEGER,
+            quantity INTEGER DEFAULT 1,
+            bonus_quantity INTEGER DEFAULT 0,
+            unit_price INTEGER,
+            amount INTEGER,
+            code TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TEXT
+        )
+    """)
+    await _add_column_if_missing(db, "direct_orders", "bonus_quantity", "INTEGER DEFAULT 0")
+    # Previously created by sepay_checker.init_checker_db()
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS processed_transactions (
+            tx_id TEXT PRIMARY KEY,
+            processed_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+async def _m002_hot_lookup_indexes(db):
+    """Secondary/partial indexes for the hot lookups (checked by database/query_plans.py)."""
+    # Unsold stock per product (COUNT / LIMIT n / ORDER BY id) and the admin listing by product.
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_stock_product_sold ON stock(product_id, sold, id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_orders_product_created ON orders(product_id, created_at)")
+    # Partial indexes: only pending rows are indexed, so the pending queues stay
+    # cheap to list (and to look up per user) however large the history grows.
+    pending_indexes = {
+        "deposits": "user_id",
+        "withdrawals": "user_id",
+        "direct_orders": "user_id",
+        "usdt_withdrawals": "user_id",
+        "binance_deposits": "user_id, code",
+    }
+    for table, columns in pending_indexes.items():
+        await db.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_pending ON {table}({columns}) WHERE status = 'pending'"
+        )
+
+
+async def _m003_product_stock_counts(db):
+    """Per-product unsold counter kept exact by triggers, so the catalog is one JOIN instead of N COUNT(*)s."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS product_stock_counts (
+            product_id INTEGER PRIMARY KEY,
+            available INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    await db.execute("DELETE FROM product_stock_counts")
+    await db.execute("""
+        INSERT INTO product_stock_counts (product_id, available)
+        SELECT product_id, COUNT(*) FROM stock
+        WHERE sold = 0 AND product_id IS NOT NULL
+        GROUP BY product_id
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stock_count_insert
+        AFTER INSERT ON stock
+        WHEN NEW.sold = 0 AND NEW.product_id IS NOT NULL
+        BEGIN
+            INSERT INTO product_stock_counts (product_id, available) VALUES (NEW.product_id, 1)
+            ON CONFLICT(product_id) DO UPDATE SET available = available + 1;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stock_count_delete
+        AFTER DELETE ON stock
+        WHEN OLD.sold = 0 AND OLD.product_id IS NOT NULL
+        BEGIN
+            UPDATE product_stock_counts SET available = available - 1 WHERE product_id = OLD.product_id;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stock_count_update
+        AFTER UPDATE OF sold, product_id ON stock
+        BEGIN
+            UPDATE product_stock_counts SET available = available - 1
+            WHERE OLD.sold = 0 AND product_id = OLD.product_id;
+            INSERT INTO product_stock_counts (product_id, available)
+            SELECT NEW.product_id, 1 WHERE NEW.sold = 0 AND NEW.product_id IS NOT NULL
+            ON CONFLICT(product_id) DO UPDATE SET available = available + 1;
+        END
+    """)
+
+
+async def _m004_settings_version(db):
+    """Counter row bumped by triggers on every settings change; the bot reloads its snapshot only when it moves."""
+    await db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('settings_version', '1')")
+    for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_settings_version_{event.lower()}
+            AFTER {event} ON settings
+            WHEN {row}.key <> 'settings_version'
+            BEGIN
+                INSERT INTO settings (key, value) VALUES ('settings_version', '1')
+                ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1;
+            END
+        """)
+
+
+async def _m005_broadcast_jobs(db):
+    """Resumable /notification broadcasts; users who blocked the bot are skipped by later broadcasts."""
+    await _add_column_if_missing(db, "users", "is_blocked", "INTEGER DEFAULT 0")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            last_user_id INTEGER DEFAULT 0,
+            created_at TEXT,
+            updated_at TEXT,
+            finished_at TEXT
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+
+
+# Append new steps here; never edit or renumber a step that has shipped.
+MIGRATIONS = [
+    (1, "baseline", _m001_baseline),
+    (2, "hot_lookup_indexes", _m002_hot_lookup_indexes),
+    (3, "product_stock_counts", _m003_product_stock_counts),
+    (4, "settings_version", _m004_settings_version),
+    (5, "broadcast_jobs", _m005_broadcast_jobs),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def get_schema_version(db) -> int:
+    cursor = await db.execute("PRAGMA user_version")
+    row = await cursor.fetchone()
+    return int(row[0]) if row else 0
+
+
+async def _ensure_history_table(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT
+        )
+    """)
+
+
+async def migrate(db) -> list:
+    """
+    Bring the schema up to LATEST_VERSION. Returns the versions applied.
+    When the schema is current this is a single `PRAGMA user_version` read.
+    All pending steps run in one transaction: either all apply or none do.
+    """
+    if await get_schema_version(db) >= LATEST_VERSION:
+        return []
+
+    if db.in_transaction:
+        await db.commit()
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        # Re-check under the write lock in case another process migrated first.
+        current = await get_schema_version(db)
+        await _ensure_history_table(db)
+        applied = []
+        for version, name, step in MIGRATIONS:
+            if version <= current:
+                continue
+            await step(db)
+            await db.execute(
+                "INSERT OR REPLACE INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.now().isoformat()),
+            )
+            applied.append(version)
+        if applied:
+            # user_version is part of the database header, so it commits/rolls back with the DDL.
+            await db.execute(f"PRAGMA user_version = {int(applied[-1])}")
+        await db.commit()
+        return applied
+    except BaseException:
+        await db.rollback()
+        raise
+
+
+async def get_status(db) -> dict:
+    current = await get_schema_version(db)
+    cursor = await db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+    )
+    history = []
+    if await cursor.fetchone():
+        cursor = await db.execute("SELECT version, name, applied_at FROM schema_version ORDER BY version")
+        history = [{"version": r[0], "name": r[1], "applied_at": r[2]} for r in await cursor.fetchall()]
+    pending = [{"version": v, "name": n} for v, n, _ in MIGRATIONS if v > current]
+    return {"current": current, "latest": LATEST_VERSION, "applied": history, "pending": pending}
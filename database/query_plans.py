@@ -0,0 +1,70 @@
+"""
+EXPLAIN QUERY PLAN self-check for the hot SQLite lookups.
+
+The SQL comes from the SQL_* constants database/db.py actually executes, so a
+changed query is checked as written; each entry names the index it must use.
+Run `python -m database check-plans` (exit code 1 on any regression) after
+touching the schema or one of these queries.
+"""
+from typing import Any, Dict, List
+
+from .db import (
+    SQL_BINANCE_DEPOSIT_SET_SCREENSHOT, SQL_BINANCE_DEPOSIT_USER_PENDING, SQL_BINANCE_DEPOSITS_PENDING,
+    SQL_DEPOSITS_PENDING, SQL_DIRECT_ORDERS_PENDING, SQL_ORDERS_BY_PRODUCT, SQL_ORDERS_BY_USER,
+    SQL_STOCK_BY_PRODUCT, SQL_STOCK_CHECKOUT_UNSOLD, SQL_STOCK_EXPORT_UNSOLD, SQL_STOCK_TAKE_UNSOLD,
+    SQL_USDT_WITHDRAWALS_PENDING, SQL_USDT_WITHDRAWALS_PENDING_SUM, SQL_WITHDRAWALS_PENDING,
+    SQL_WITHDRAWALS_PENDING_SUM,
+)
+
+# (name, sql, params, table alias as printed by SQLite, expected index)
+HOT_QUERIES = [
+    ("stock_take_unsold", SQL_STOCK_TAKE_UNSOLD, (1, 10), "stock", "idx_stock_product_sold"),
+    ("stock_checkout_unsold", SQL_STOCK_CHECKOUT_UNSOLD, (1, 10), "stock", "idx_stock_product_sold"),
+    ("stock_export_unsold", SQL_STOCK_EXPORT_UNSOLD, (1,), "stock", "idx_stock_product_sold"),
+    ("stock_by_product", SQL_STOCK_BY_PRODUCT, (1,), "stock", "idx_stock_product_sold"),
+    ("orders_by_user", SQL_ORDERS_BY_USER, (1,), "o", "idx_orders_user_created"),
+    ("orders_by_product", SQL_ORDERS_BY_PRODUCT, (1, 100), "o", "idx_orders_product_created"),
+    ("deposits_pending", SQL_DEPOSITS_PENDING, (), "deposits", "idx_deposits_pending"),
+    ("withdrawals_pending", SQL_WITHDRAWALS_PENDING, (), "withdrawals", "idx_withdrawals_pending"),
+    ("withdrawals_pending_sum", SQL_WITHDRAWALS_PENDING_SUM, (1,), "withdrawals", "idx_withdrawals_pending"),
+    ("direct_orders_pending", SQL_DIRECT_ORDERS_PENDING, (), "direct_orders", "idx_direct_orders_pending"),
+    (
+        "binance_deposits_pending", SQL_BINANCE_DEPOSITS_PENDING, (),
+        "binance_deposits", "idx_binance_deposits_pending",
+    ),
+    (
+        "binance_deposits_user_code", SQL_BINANCE_DEPOSIT_SET_SCREENSHOT, ("x", 1, "c"),
+        "binance_deposits", "idx_binance_deposits_pending",
+    ),
+    (
+        "binance_deposits_user_pending", SQL_BINANCE_DEPOSIT_USER_PENDING, (1,),
+        "binance_deposits", "idx_binance_deposits_pending",
+    ),
+    (
+        "usdt_withdrawals_pending", SQL_USDT_WITHDRAWALS_PENDING, (),
+        "usdt_withdrawals", "idx_usdt_withdrawals_pending",
+    ),
+    (
+        "usdt_withdrawals_pending_sum", SQL_USDT_WITHDRAWALS_PENDING_SUM, (1,),
+        "usdt_withdrawals", "idx_usdt_withdrawals_pending",
+    ),
+]
+
+
+async def explain(db, sql: str, params=()) -> List[str]:
+    cursor = await db.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+    return [row[3] for row in await cursor.fetchall()]
+
+
+def _uses_index(detail: str, table: str, index: str) -> bool:
+    return detail.startswith(("SEARCH ", "SCAN ")) and detail.split(" ")[1] == table and f"INDEX {index}" in detail
+
+
+async def check_query_plans(db) -> List[Dict[str, Any]]:
+    """Return one result per HOT_QUERIES entry; `ok` is False when the query no longer uses its index."""
+    results = []
+    for name, sql, params, table, index in HOT_QUERIES:
+        plan = await explain(db, sql, params)
+        ok = any(_uses_index(detail, table, index) for detail in plan)
+        results.append({"name": name, "ok": ok, "index": index, "plan": plan})
+    return results
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+SETTINGS_VERSION_KEY = "settings_version"
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+# How often a lookup may re-read settings_version (one tiny query); dashboard edits show up within this window.
+SETTINGS_VERSION_CHECK_SECONDS = max(0.0, _env_float("SETTINGS_VERSION_CHECK_SECONDS", 3.0))
+# Full reload interval when the database has no settings_version row (trigger not installed yet).
+SETTINGS_FALLBACK_TTL_SECONDS = max(0.0, _env_float("SETTINGS_FALLBACK_TTL_SECONDS", 60.0))
+
+
+class SettingsSnapshot:
+    """
+    In-memory copy of the whole `settings` table.
+
+    - `load_all()` returns {key: value} for every row (one query).
+    - `load_version()` returns the current settings_version value (or None).
+    Lookups are served from memory; at most every SETTINGS_VERSION_CHECK_SECONDS
+    the version is re-read and the snapshot is reloaded only if it changed.
+    """
+
+    def __init__(
+        self,
+        load_all: Callable[[], Awaitable[Dict[str, Any]]],
+        load_version: Callable[[], Awaitable[Optional[str]]],
+        check_interval: float = SETTINGS_VERSION_CHECK_SECONDS,
+        fallback_ttl: float = SETTINGS_FALLBACK_TTL_SECONDS,
+    ):
+        self._load_all = load_all
+        self._load_version = load_version
+        self.check_interval = check_interval
+        self.fallback_ttl = fallback_ttl
+        self._values: Optional[Dict[str, Any]] = None
+        self._version: Optional[str] = None
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self, now: float) -> bool:
+        if self._values is None:
+            return False
+        if self._version is None:
+            return now - self._loaded_at < self.fallback_ttl
+        return now - self._checked_at < self.check_interval
+
+    async def _reload(self, now: float):
+        values = await self._load_all()
+        self._values = dict(values)
+        version = self._values.get(SETTINGS_VERSION_KEY)
+        self._version = str(version) if version is not None else None
+        self._loaded_at = now
+        self._checked_at = now
+
+    async def _refresh(self):
+        if self._is_fresh(time.monotonic()):
+            return
+        async with self._lock:
+            now = time.monotonic()
+            if self._is_fresh(now):
+                return
+            if self._values is None or self._version is None:
+                await self._reload(now)
+                return
+            try:
+                version = await self._load_version()
+            except Exception:
+                # Keep serving the last snapshot; retry after the next interval.
+                self._checked_at = now
+                return
+            if version is None or str(version) != self._version:
+                await self._reload(now)
+            else:
+                self._checked_at = now
+
+    async def values(self) -> Dict[str, Any]:
+        await self._refresh()
+        return self._values or {}
+
+    async def get(self, key: str, default: Any = "") -> Any:
+        value = (await self.values()).get(key)
+        return default if value is None else value
+
+    def set_local(self, key: str, value: Any):
+        """Apply our own write immediately; the next lookup re-checks the version (our write bumped it)."""
+        if self._values is not None:
+            self._values[key] = value
+        self._checked_at = 0.0
+        self._loaded_at = 0.0
+
+    def invalidate(self):
+        self._values = None
+        self._version = None
@@ -0,0 +1,53 @@
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+# name -> {"calls": total calls, "executed": backend requests actually made, "coalesced": calls served by one already in flight}
+_stats: Dict[str, Dict[str, int]] = {}
+
+
+def single_flight(fn: Callable[..., Awaitable[Any]]):
+    """
+    Deduplicate concurrent calls of `fn` with the same arguments.
+
+    The first caller starts the backend request as a task; callers arriving while
+    it is in flight await that same task instead of sending their own. Nothing is
+    cached: once the task finishes, the next call goes to the backend again.
+    Waiters share the result object, so only use this for reads whose result is
+    not mutated by callers. A cancelled caller does not cancel the shared request.
+    """
+    name = fn.__name__
+    pending: Dict[Tuple, asyncio.Task] = {}
+    stats = _stats.setdefault(name, {"calls": 0, "executed": 0, "coalesced": 0})
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        stats["calls"] += 1
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            task = pending.get(key)
+        except TypeError:
+            # Unhashable arguments: nothing to coalesce on.
+            stats["executed"] += 1
+            return await fn(*args, **kwargs)
+
+        if task is not None:
+            stats["coalesced"] += 1
+        else:
+            stats["executed"] += 1
+            task = asyncio.get_running_loop().create_task(fn(*args, **kwargs))
+            pending[key] = task
+            task.add_done_callback(lambda t: _finish(pending, key, t))
+        return await asyncio.shield(task)
+
+    return wrapper
+
+
+def _finish(pending: Dict[Tuple, asyncio.Task], key: Tuple, task: asyncio.Task):
+    pending.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # mark retrieved: every waiter may have been cancelled
+
+
+def get_single_flight_stats() -> Dict[str, Dict[str, int]]:
+    return {name: dict(counters) for name, counters in _stats.items()}
@@ -0,0 +1,133 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import aiosqlite
+
+
+def _env_int(name: str, default: int) -> int:
+    raw = os.getenv(name, str(default))
+    try:
+        return int(str(raw).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+SQLITE_READ_POOL_SIZE = max(1, _env_int("SQLITE_READ_POOL_SIZE", 4))
+SQLITE_BUSY_TIMEOUT_MS = max(0, _env_int("SQLITE_BUSY_TIMEOUT_MS", 5000))
+# Negative cache_size is in KiB (SQLite convention): -20000 ~= 20MB page cache per connection.
+SQLITE_CACHE_SIZE = _env_int("SQLITE_CACHE_SIZE", -20000)
+SQLITE_MMAP_SIZE = max(0, _env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip().upper() or "NORMAL"
+if SQLITE_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    SQLITE_SYNCHRONOUS = "NORMAL"
+
+
+class SQLitePool:
+    """
+    Long-lived SQLite connections shared by all database functions.
+
+    - One writer connection, serialized by an asyncio lock so a function's
+      statements + commit never interleave with another coroutine's.
+    - A small pool of read-only connections for SELECT-only functions.
+      WAL mode lets them read concurrently with the writer.
+    """
+
+    def __init__(self, db_path: str, read_pool_size: int = SQLITE_READ_POOL_SIZE):
+        self.db_path = db_path
+        self.read_pool_size = max(1, int(read_pool_size))
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle_readers: Optional[asyncio.Queue] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _apply_pragmas(self, conn: aiosqlite.Connection, readonly: bool):
+        await conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        await conn.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+        await conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        await conn.execute("PRAGMA temp_store = MEMORY")
+        if readonly:
+            await conn.execute("PRAGMA query_only = 1")
+        else:
+            await conn.execute("PRAGMA journal_mode = WAL")
+            await conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            # Writer first: it creates the file and switches it to WAL before readers attach.
+            writer = await aiosqlite.connect(self.db_path)
+            await self._apply_pragmas(writer, readonly=False)
+
+            readers: List[aiosqlite.Connection] = []
+            idle: asyncio.Queue = asyncio.Queue()
+            try:
+                for _ in range(self.read_pool_size):
+                    reader = await aiosqlite.connect(f"file:{self.db_path}?mode=ro", uri=True)
+                    await self._apply_pragmas(reader, readonly=True)
+                    readers.append(reader)
+                    idle.put_nowait(reader)
+            except Exception:
+                for reader in readers:
+                    await reader.close()
+                await writer.close()
+                raise
+
+            self._readers = readers
+            self._idle_readers = idle
+            self._writer = writer
+
+    @asynccontextmanager
+    async def write(self):
+        """Exclusive access to the writer connection (use for anything that modifies data)."""
+        await self.open()
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                if self._writer is not None and self._writer.in_transaction:
+                    await self._writer.rollback()
+                raise
+
+    @asynccontextmanager
+    async def read(self):
+        """Borrow a read-only connection from the pool."""
+        await self.open()
+        conn = await self._idle_readers.get()
+        try:
+            yield conn
+        finally:
+            self._idle_readers.put_nowait(conn)
+
+    async def close(self):
+        async with self._open_lock:
+            writer = self._writer
+            readers = self._readers
+            self._writer = None
+            self._readers = []
+            self._idle_readers = None
+            for reader in readers:
+                try:
+                    await reader.close()
+                except Exception:
+                    pass
+            if writer is not None:
+                try:
+                    # Fold the WAL back into the main file so backups of shop.db stay self-contained.
+                    await writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except Exception:
+                    pass
+                await writer.close()
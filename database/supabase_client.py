@@ -1,17 +1,73 @@
 import os
 from typing import Optional, Any
 
+import httpx
+from postgrest import AsyncPostgrestClient
 from supabase import create_client
 
 _client: Optional[Any] = None
+_async_client: Optional[AsyncPostgrestClient] = None
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+# Shared HTTP/2 keep-alive pool for the async data layer (database/supabase_db.py)
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "true").lower() in ("1", "true", "yes")
+SUPABASE_MAX_CONNECTIONS = max(1, int(_env_float("SUPABASE_MAX_CONNECTIONS", 100)))
+SUPABASE_MAX_KEEPALIVE = max(1, int(_env_float("SUPABASE_MAX_KEEPALIVE", 20)))
+SUPABASE_KEEPALIVE_EXPIRY = _env_float("SUPABASE_KEEPALIVE_EXPIRY", 60.0)
+SUPABASE_CONNECT_TIMEOUT = _env_float("SUPABASE_CONNECT_TIMEOUT", 5.0)
+SUPABASE_TIMEOUT = _env_float("SUPABASE_TIMEOUT", 20.0)
+
+
+def _credentials():
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY")
+    if not url or not key:
+        raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY/SUPABASE_ANON_KEY")
+    return url.rstrip("/"), key
 
 
 def get_supabase_client():
     global _client
     if _client is None:
-        url = os.getenv("SUPABASE_URL")
-        key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY")
-        if not url or not key:
-            raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY/SUPABASE_ANON_KEY")
+        url, key = _credentials()
         _client = create_client(url, key)
     return _client
+
+
+def get_async_supabase_client() -> AsyncPostgrestClient:
+    """PostgREST client (table/rpc) on one shared async HTTP/2 connection pool."""
+    global _async_client, _http_client
+    if _async_client is None:
+        url, key = _credentials()
+        headers = {"apikey": key, "Authorization": f"Bearer {key}"}
+        rest_url = f"{url}/rest/v1"
+        _http_client = httpx.AsyncClient(
+            base_url=rest_url,
+            headers=headers,
+            http2=SUPABASE_HTTP2,
+            limits=httpx.Limits(
+                max_connections=SUPABASE_MAX_CONNECTIONS,
+                max_keepalive_connections=SUPABASE_MAX_KEEPALIVE,
+                keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(SUPABASE_TIMEOUT, connect=SUPABASE_CONNECT_TIMEOUT),
+        )
+        _async_client = AsyncPostgrestClient(rest_url, headers=headers, http_client=_http_client)
+    return _async_client
+
+
+async def close_async_supabase_client():
+    global _async_client, _http_client
+    http_client = _http_client
+    _async_client = None
+    _http_client = None
+    if http_client is not None:
+        await http_client.aclose()
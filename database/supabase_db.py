@@ -1,10 +1,18 @@
-import asyncio
 import json
 import time
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional, Tuple
 
-from .supabase_client import get_supabase_client
+from postgrest.types import ReturnMethod
+
+from helpers.pricing import get_pricing_snapshot
+
+from .catalog_cache import CatalogCache
+from .chat_log_writer import ChatLogWriter
+from .known_users import KnownUserCache
+from .settings_snapshot import SETTINGS_VERSION_KEY, SettingsSnapshot
+from .single_flight import get_single_flight_stats, single_flight
+from .supabase_client import close_async_supabase_client, get_async_supabase_client
 
 
 def _now_iso() -> str:
@@ -50,53 +58,33 @@ def _safe_list(value: Any) -> List[Any]:
     return []
 
 
-def _product_sort_key(product: Dict[str, Any]):
-    sort_position = _safe_optional_int(product.get("sort_position"))
-    product_id = _safe_optional_int(product.get("id"))
-    id_fallback = product_id if product_id is not None else 10**12
-    return (
-        1 if sort_position is None else 0,
-        sort_position if sort_position is not None else 10**11,
-        id_fallback,
-    )
-
-
 def _sort_products_by_position(products: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    return sorted(products, key=_product_sort_key)
+    # Catalog RPC / fallback query already return rows ordered by (sort_position NULLS LAST, id)
+    return products
 
 
-async def _fetch_product_positions(product_ids: List[Any]) -> Dict[str, Optional[int]]:
-    ids = [pid for pid in product_ids if pid is not None]
-    if not ids:
-        return {}
-
-    def _fetch():
-        return _get_table("products").select("id, sort_position").in_("id", ids).execute()
+def _get_table(name: str):
+    return get_async_supabase_client().table(name)
 
-    try:
-        resp = await _to_thread(_fetch)
-    except Exception:
-        return {}
 
-    position_map: Dict[str, Optional[int]] = {}
-    for row in resp.data or []:
-        product_id = row.get("id")
-        if product_id is None:
-            continue
-        position_map[str(product_id)] = _safe_optional_int(row.get("sort_position"))
-    return position_map
+def _get_rpc(fn: str, params: Optional[Dict[str, Any]] = None):
+    return get_async_supabase_client().rpc(fn, params or {})
 
 
-async def _to_thread(func, *args, **kwargs):
-    return await asyncio.to_thread(func, *args, **kwargs)
+def _is_missing_rpc(exc: Exception) -> bool:
+    # PostgREST: PGRST202 = function not found in schema cache; 42883 = undefined_function
+    code = str(getattr(exc, "code", "") or "")
+    return code in ("PGRST202", "42883") or "Could not find the function" in str(exc)
 
 
-def _get_table(name: str):
-    supabase = get_supabase_client()
-    return supabase.table(name)
+def _rpc_scalar(data: Any) -> Any:
+    # Scalar-returning functions come back as a bare value (older PostgREST: [{"fn": value}])
+    if isinstance(data, list):
+        data = data[0] if data else None
+    if isinstance(data, dict):
+        data = next(iter(data.values()), None)
+    return data
 
-_settings_cache: Dict[str, Dict[str, Any]] = {"values": {}, "ts": 0.0}
-_SETTINGS_TTL_SECONDS = 60
 _USER_CACHE_TTL_SECONDS = 30
 _user_lang_cache: Dict[int, Tuple[str, float]] = {}
 
@@ -127,7 +115,17 @@ def _parse_bool(value: Any, default: bool = True) -> bool:
 
 async def init_db():
     # Ensure Supabase client can be created
-    await _to_thread(get_supabase_client)
+    get_async_supabase_client()
+    _chat_log.start()
+
+
+async def close_db():
+    # Drain buffered chat history, then close the shared HTTP/2 connection pool.
+    await _chat_log.stop()
+    await close_async_supabase_client()
+    _settings.invalidate()
+    _known_users.clear()
+    _catalog.invalidate()
 
 
 def _dt_to_utc_iso(value: Optional[datetime]) -> str:
@@ -138,29 +136,22 @@ def _dt_to_utc_iso(value: Optional[datetime]) -> str:
     return value.astimezone(timezone.utc).isoformat()
 
 
-async def log_telegram_message(
+def _telegram_message_row(
     chat_id: int,
     message_id: int,
     direction: str,
-    message_type: str = "text",
-    text: Optional[str] = None,
-    payload: Any = None,
-    sent_at: Optional[datetime] = None,
-):
-    """
-    Best-effort chat history logging for the admin dashboard.
-    Logging must never break the bot flow, so errors are swallowed.
-    """
-    if not chat_id or not message_id:
-        return
-
+    message_type: str,
+    text: Optional[str],
+    payload: Any,
+    sent_at: Optional[datetime],
+) -> Dict[str, Any]:
     direction_clean = str(direction).strip().lower()
     if direction_clean not in ("in", "out"):
         direction_clean = "out"
 
     message_type_clean = str(message_type or "text").strip().lower() or "text"
 
-    row = {
+    return {
         "chat_id": int(chat_id),
         "message_id": int(message_id),
         "direction": direction_clean,
@@ -170,43 +161,89 @@ async def log_telegram_message(
         "sent_at": _dt_to_utc_iso(sent_at),
     }
 
-    def _write():
-        table = _get_table("telegram_messages")
-        try:
-            # Some versions support explicit conflict targets; fall back to plain insert otherwise.
-            return table.upsert(row, on_conflict="chat_id,message_id").execute()
-        except TypeError:
-            return table.insert(row).execute()
 
+async def log_telegram_messages_bulk(rows: List[Dict[str, Any]]):
+    """Upsert many telegram_messages rows in one request (rows from _telegram_message_row)."""
+    if not rows:
+        return
+    # ON CONFLICT cannot touch the same row twice in one statement: keep the last copy per message.
+    unique = list({(row["chat_id"], row["message_id"]): row for row in rows}.values())
+
+    table = _get_table("telegram_messages")
     try:
-        await _to_thread(_write)
+        # Some versions support explicit conflict targets; fall back to plain insert otherwise.
+        await table.upsert(
+            unique, on_conflict="chat_id,message_id", returning=ReturnMethod.minimal
+        ).execute()
+    except TypeError:
+        await table.insert(unique).execute()
+
+
+# Chat history is buffered and written in batches by a background task (started in init_db)
+_chat_log = ChatLogWriter(log_telegram_messages_bulk)
+
+
+def get_chat_log_stats() -> Dict[str, int]:
+    return _chat_log.get_stats()
+
+
+async def log_telegram_message(
+    chat_id: int,
+    message_id: int,
+    direction: str,
+    message_type: str = "text",
+    text: Optional[str] = None,
+    payload: Any = None,
+    sent_at: Optional[datetime] = None,
+):
+    """
+    Best-effort chat history logging for the admin dashboard.
+    Logging must never break the bot flow, so errors are swallowed.
+    Queued for the background writer when it is running, otherwise written inline.
+    """
+    if not chat_id or not message_id:
+        return
+
+    try:
+        row = _telegram_message_row(chat_id, message_id, direction, message_type, text, payload, sent_at)
+        if not _chat_log.enqueue(row):
+            await log_telegram_messages_bulk([row])
     except Exception:
         return
 
 
 # User functions
+# User ids known to have a row (bounded LRU), so ensure_user() is free for returning users
+_known_users = KnownUserCache()
+
+
 async def get_or_create_user(user_id: int, username: str = None):
-    def _fetch():
-        return _get_table("users").select("user_id, username, balance, balance_usdt, language").eq(
+    try:
+        resp = await _get_table("users").select("user_id, username, balance, balance_usdt, language, is_blocked").eq(
+            "user_id", user_id
+        ).limit(1).execute()
+    except Exception:
+        # supabase_schema_broadcast.sql not applied yet
+        resp = await _get_table("users").select("user_id, username, balance, balance_usdt, language").eq(
             "user_id", user_id
         ).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
     data = resp.data or []
     if not data:
-        def _insert():
-            return _get_table("users").insert({
-                "user_id": user_id,
-                "username": username,
-                "language": None,
-                "created_at": _now_iso(),
-            }).execute()
-
-        await _to_thread(_insert)
+        await _get_table("users").insert({
+            "user_id": user_id,
+            "username": username,
+            "language": None,
+            "created_at": _now_iso(),
+        }).execute()
+        _known_users.add(user_id)
         _cache_set(_user_lang_cache, user_id, "vi")
         return {"user_id": user_id, "username": username, "balance": 0, "balance_usdt": 0, "language": None}
 
     row = data[0]
+    if row.get("is_blocked"):
+        # /start again after blocking the bot: include them in broadcasts again.
+        await _get_table("users").update({"is_blocked": False}).eq("user_id", user_id).execute()
+    _known_users.add(user_id)
     balance = _safe_int(row.get("balance"))
     balance_usdt = _safe_float(row.get("balance_usdt"))
     language = row.get("language")
@@ -221,15 +258,30 @@ async def get_or_create_user(user_id: int, username: str = None):
     }
 
 
+async def ensure_user(user_id: int, username: str = None):
+    """Hot path (every message): known user -> no request; new user -> one insert-or-ignore."""
+    async def _create():
+        return await _get_table("users").upsert(
+            {
+                "user_id": user_id,
+                "username": username,
+                "language": None,
+                "created_at": _now_iso(),
+            },
+            on_conflict="user_id",
+            ignore_duplicates=True,
+            returning=ReturnMethod.minimal,
+        ).execute()
+
+    await _known_users.ensure(user_id, _create)
+
+
 async def get_user_language(user_id: int) -> str:
     cached = _cache_get(_user_lang_cache, user_id, _USER_CACHE_TTL_SECONDS)
     if cached is not None:
         return cached
 
-    def _fetch():
-        return _get_table("users").select("language").eq("user_id", user_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("users").select("language").eq("user_id", user_id).limit(1).execute()
     data = resp.data or []
     if not data or not data[0].get("language"):
         _cache_set(_user_lang_cache, user_id, "vi")
@@ -239,65 +291,124 @@ async def get_user_language(user_id: int) -> str:
     return lang
 
 
-async def set_user_language(user_id: int, language: str):
-    def _update():
-        return _get_table("users").update({"language": language}).eq("user_id", user_id).execute()
+async def get_user_profile(user_id: int) -> Optional[Dict[str, Any]]:
+    """Language + both balances in one request (None if the user has no row)."""
+    resp = await _get_table("users").select("language, balance, balance_usdt").eq(
+        "user_id", user_id
+    ).limit(1).execute()
+    data = resp.data or []
+    if not data:
+        return None
+    row = data[0]
+    language = row.get("language") or "vi"
+    _cache_set(_user_lang_cache, user_id, language)
+    _known_users.add(user_id)
+    return {
+        "language": language,
+        "balance": _safe_int(row.get("balance")),
+        "balance_usdt": _safe_float(row.get("balance_usdt")),
+    }
 
-    await _to_thread(_update)
+
+async def set_user_language(user_id: int, language: str):
+    await _get_table("users").update({"language": language}).eq("user_id", user_id).execute()
     _cache_set(_user_lang_cache, user_id, language)
 
 
 async def get_balance(user_id: int):
-    def _fetch():
-        return _get_table("users").select("balance").eq("user_id", user_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("users").select("balance").eq("user_id", user_id).limit(1).execute()
     data = resp.data or []
     return _safe_int(data[0].get("balance")) if data else 0
 
 
 async def get_balance_usdt(user_id: int):
-    def _fetch():
-        return _get_table("users").select("balance_usdt").eq("user_id", user_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("users").select("balance_usdt").eq("user_id", user_id).limit(1).execute()
     data = resp.data or []
     return _safe_float(data[0].get("balance_usdt")) if data else 0
 
 
 async def _set_balance(user_id: int, new_balance: int):
-    def _update():
-        return _get_table("users").update({"balance": new_balance}).eq("user_id", user_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("users").update({"balance": new_balance}).eq("user_id", user_id).execute()
 
 
 async def _set_balance_usdt(user_id: int, new_balance: float):
-    def _update():
-        return _get_table("users").update({"balance_usdt": new_balance}).eq("user_id", user_id).execute()
+    await _get_table("users").update({"balance_usdt": new_balance}).eq("user_id", user_id).execute()
 
-    await _to_thread(_update)
+
+async def _balance_rpc(fn: str, user_id: int, amount: Any, currency: str):
+    """Run increment_user_balance / debit_user_balance; raises if the RPC is not deployed."""
+    resp = await _get_rpc(fn, {"p_user_id": user_id, "p_amount": amount, "p_currency": currency}).execute()
+    return _rpc_scalar(resp.data)
 
 
 async def update_balance(user_id: int, amount: int):
+    """Cộng/trừ số dư (atomic, server-side). Returns the new balance."""
+    try:
+        return _safe_int(await _balance_rpc("increment_user_balance", user_id, int(amount), "vnd"))
+    except Exception as exc:
+        if not _is_missing_rpc(exc):
+            raise
     current = await get_balance(user_id)
     await _set_balance(user_id, current + amount)
+    return current + amount
 
 
 async def update_balance_usdt(user_id: int, amount: float):
+    """Cộng/trừ số dư USDT (atomic, server-side). Returns the new balance."""
+    try:
+        return _safe_float(await _balance_rpc("increment_user_balance", user_id, amount, "usdt"))
+    except Exception as exc:
+        if not _is_missing_rpc(exc):
+            raise
     current = await get_balance_usdt(user_id)
     await _set_balance_usdt(user_id, current + amount)
+    return current + amount
+
+
+async def debit_balance(user_id: int, amount: int) -> Optional[int]:
+    """Trừ số dư nếu đủ tiền. Returns the new balance, or None when funds are short."""
+    try:
+        new_balance = await _balance_rpc("debit_user_balance", user_id, int(amount), "vnd")
+        return None if new_balance is None else _safe_int(new_balance)
+    except Exception as exc:
+        if not _is_missing_rpc(exc):
+            raise
+    current = await get_balance(user_id)
+    if current < amount:
+        return None
+    await _set_balance(user_id, current - amount)
+    return current - amount
+
+
+async def debit_balance_usdt(user_id: int, amount: float) -> Optional[float]:
+    """Trừ số dư USDT nếu đủ tiền. Returns the new balance, or None when funds are short."""
+    try:
+        new_balance = await _balance_rpc("debit_user_balance", user_id, amount, "usdt")
+        return None if new_balance is None else _safe_float(new_balance)
+    except Exception as exc:
+        if not _is_missing_rpc(exc):
+            raise
+    current = await get_balance_usdt(user_id)
+    if current < amount:
+        return None
+    await _set_balance_usdt(user_id, current - amount)
+    return current - amount
 
 
 # Product functions
-async def get_products():
-    def _rpc():
-        return get_supabase_client().rpc("get_products_with_stock").execute()
+async def _count_unsold_stock(product_id: int) -> int:
+    # HEAD + count=exact: PostgREST only returns Content-Range, never the stock rows
+    resp = await _get_table("stock").select("id", count="exact", head=True).eq(
+        "product_id", product_id
+    ).eq("sold", False).execute()
+    return _safe_int(resp.count)
+
 
+@single_flight
+async def _load_products():
     try:
-        resp = await _to_thread(_rpc)
+        resp = await _get_rpc("get_products_with_stock").execute()
         rows = resp.data or []
-        position_map = await _fetch_product_positions([row.get("id") for row in rows])
         products = []
         for row in rows:
             product_id = row.get("id")
@@ -312,32 +423,27 @@ async def get_products():
                 "price_tiers": _safe_list(row.get("price_tiers")),
                 "promo_buy_quantity": _safe_int(row.get("promo_buy_quantity")),
                 "promo_bonus_quantity": _safe_int(row.get("promo_bonus_quantity")),
-                "sort_position": position_map.get(str(product_id), _safe_optional_int(row.get("sort_position"))),
+                "sort_position": _safe_optional_int(row.get("sort_position")),
             })
         return _sort_products_by_position(products)
     except Exception:
         # Fallback to per-product counting if RPC not available
-        def _fetch():
-            try:
-                return _get_table("products").select(
-                    "id, name, price, description, price_usdt, format_data, price_tiers, promo_buy_quantity, promo_bonus_quantity, sort_position"
-                ).eq("is_deleted", False).eq("is_hidden", False).order("id").execute()
-            except Exception:
-                return _get_table("products").select(
-                    "id, name, price, description, price_usdt, format_data"
-                ).order("id").execute()
-
-        resp = await _to_thread(_fetch)
+        try:
+            resp = await _get_table("products").select(
+                "id, name, price, description, price_usdt, format_data, price_tiers, promo_buy_quantity, promo_bonus_quantity, sort_position"
+            ).eq("is_deleted", False).eq("is_hidden", False).order(
+                "sort_position", nullsfirst=False
+            ).order("id").execute()
+        except Exception:
+            resp = await _get_table("products").select(
+                "id, name, price, description, price_usdt, format_data"
+            ).order("id").execute()
         rows = resp.data or []
         products = []
         for row in rows:
             product_id = row.get("id")
 
-            def _stock():
-                return _get_table("stock").select("id").eq("product_id", product_id).eq("sold", False).execute()
-
-            stock_resp = await _to_thread(_stock)
-            stock_count = len(stock_resp.data or [])
+            stock_count = await _count_unsold_stock(product_id)
             products.append({
                 "id": product_id,
                 "name": row.get("name"),
@@ -354,70 +460,20 @@ async def get_products():
         return _sort_products_by_position(products)
 
 
-async def get_product(product_id: int):
-    def _rpc():
-        return get_supabase_client().rpc("get_product_with_stock", {"p_id": product_id}).execute()
+# Catalog is read on every menu/buy step; served from memory, writes below keep it current.
+_catalog = CatalogCache(_load_products)
+
+
+def get_catalog_version() -> int:
+    return _catalog.version
+
+
+async def get_products():
+    return await _catalog.products()
 
-    try:
-        resp = await _to_thread(_rpc)
-        data = resp.data or []
-        if not data:
-            return None
-        row = data[0]
-        return {
-            "id": row.get("id"),
-            "name": row.get("name"),
-            "price": _safe_int(row.get("price")),
-            "description": row.get("description"),
-            "stock": _safe_int(row.get("stock")),
-            "price_usdt": _safe_float(row.get("price_usdt")),
-            "format_data": row.get("format_data"),
-            "price_tiers": _safe_list(row.get("price_tiers")),
-            "promo_buy_quantity": _safe_int(row.get("promo_buy_quantity")),
-            "promo_bonus_quantity": _safe_int(row.get("promo_bonus_quantity")),
-            "sort_position": _safe_optional_int(row.get("sort_position")),
-        }
-    except Exception:
-        def _fetch():
-            try:
-                return _get_table("products").select(
-                    "id, name, price, description, price_usdt, format_data, price_tiers, promo_buy_quantity, promo_bonus_quantity, sort_position"
-                ).eq(
-                    "id", product_id
-                ).eq(
-                    "is_deleted", False
-                ).eq(
-                    "is_hidden", False
-                ).limit(1).execute()
-            except Exception:
-                return _get_table("products").select(
-                    "id, name, price, description, price_usdt, format_data"
-                ).eq("id", product_id).limit(1).execute()
-
-        resp = await _to_thread(_fetch)
-        data = resp.data or []
-        if not data:
-            return None
-        row = data[0]
-
-        def _stock():
-            return _get_table("stock").select("id").eq("product_id", product_id).eq("sold", False).execute()
-
-        stock_resp = await _to_thread(_stock)
-        stock_count = len(stock_resp.data or [])
-        return {
-            "id": row.get("id"),
-            "name": row.get("name"),
-            "price": _safe_int(row.get("price")),
-            "description": row.get("description"),
-            "stock": stock_count,
-            "price_usdt": _safe_float(row.get("price_usdt")),
-            "format_data": row.get("format_data"),
-            "price_tiers": _safe_list(row.get("price_tiers")),
-            "promo_buy_quantity": _safe_int(row.get("promo_buy_quantity")),
-            "promo_bonus_quantity": _safe_int(row.get("promo_bonus_quantity")),
-            "sort_position": _safe_optional_int(row.get("sort_position")),
-        }
+
+async def get_product(product_id: int):
+    return await _catalog.product(product_id)
 
 
 async def add_product(
@@ -431,76 +487,63 @@ async def add_product(
     promo_bonus_quantity: int = 0,
     sort_position: Optional[int] = None,
 ):
-    def _insert():
-        payload = {
+    payload = {
+        "name": name,
+        "price": price,
+        "description": description,
+        "price_usdt": price_usdt,
+        "format_data": format_data,
+        "price_tiers": price_tiers if price_tiers else None,
+        "promo_buy_quantity": promo_buy_quantity,
+        "promo_bonus_quantity": promo_bonus_quantity,
+        "sort_position": sort_position,
+    }
+    try:
+        resp = await _get_table("products").insert(payload).execute()
+    except Exception:
+        legacy_payload = {
             "name": name,
             "price": price,
             "description": description,
             "price_usdt": price_usdt,
             "format_data": format_data,
-            "price_tiers": price_tiers if price_tiers else None,
-            "promo_buy_quantity": promo_buy_quantity,
-            "promo_bonus_quantity": promo_bonus_quantity,
-            "sort_position": sort_position,
         }
-        try:
-            return _get_table("products").insert(payload).execute()
-        except Exception:
-            legacy_payload = {
-                "name": name,
-                "price": price,
-                "description": description,
-                "price_usdt": price_usdt,
-                "format_data": format_data,
-            }
-            return _get_table("products").insert(legacy_payload).execute()
-
-    resp = await _to_thread(_insert)
+        resp = await _get_table("products").insert(legacy_payload).execute()
+    _catalog.invalidate()
     data = resp.data or []
     return data[0].get("id") if data else None
 
 
 async def update_product_price_usdt(product_id: int, price_usdt: float):
-    def _update():
-        return _get_table("products").update({"price_usdt": price_usdt}).eq("id", product_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("products").update({"price_usdt": price_usdt}).eq("id", product_id).execute()
+    _catalog.invalidate()
 
 
 async def delete_product(product_id: int):
-    def _soft_delete():
-        return _get_table("products").update({
-            "is_hidden": True,
-            "is_deleted": True,
-            "deleted_at": _now_iso()
-        }).eq("id", product_id).execute()
-
-    await _to_thread(_soft_delete)
+    await _get_table("products").update({
+        "is_hidden": True,
+        "is_deleted": True,
+        "deleted_at": _now_iso()
+    }).eq("id", product_id).execute()
+    _catalog.invalidate()
 
 
 async def add_stock(product_id: int, content: str):
-    def _insert():
-        return _get_table("stock").insert({"product_id": product_id, "content": content}).execute()
-
-    await _to_thread(_insert)
+    await _get_table("stock").insert({"product_id": product_id, "content": content}).execute()
+    _catalog.adjust_stock(product_id, 1)
 
 
 async def add_stock_bulk(product_id: int, contents: list):
     payload = [{"product_id": product_id, "content": content} for content in contents]
 
-    def _insert():
-        return _get_table("stock").insert(payload).execute()
-
-    await _to_thread(_insert)
+    await _get_table("stock").insert(payload).execute()
+    _catalog.adjust_stock(product_id, len(payload))
 
 
 async def get_available_stock(product_id: int):
-    def _fetch():
-        return _get_table("stock").select("id, content").eq("product_id", product_id).eq(
-            "sold", False
-        ).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("stock").select("id, content").eq("product_id", product_id).eq(
+        "sold", False
+    ).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -509,51 +552,38 @@ async def get_available_stock(product_id: int):
 
 
 async def get_available_stock_batch(product_id: int, quantity: int):
-    def _fetch():
-        return _get_table("stock").select("id, content").eq("product_id", product_id).eq(
-            "sold", False
-        ).limit(quantity).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("stock").select("id, content").eq("product_id", product_id).eq(
+        "sold", False
+    ).limit(quantity).execute()
     rows = resp.data or []
     return [(row.get("id"), row.get("content")) for row in rows]
 
 
 async def mark_stock_sold(stock_id: int):
-    def _update():
-        return _get_table("stock").update({"sold": True}).eq("id", stock_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("stock").update({"sold": True}).eq("id", stock_id).execute()
+    _catalog.invalidate()
 
 
 async def mark_stock_sold_batch(stock_ids: list):
     if not stock_ids:
         return
 
-    def _update():
-        return _get_table("stock").update({"sold": True}).in_("id", stock_ids).execute()
-
-    await _to_thread(_update)
+    await _get_table("stock").update({"sold": True}).in_("id", stock_ids).execute()
+    _catalog.invalidate()
 
 
 async def get_stock_by_product(product_id: int):
-    def _fetch():
-        return _get_table("stock").select("id, content, sold").eq("product_id", product_id).order(
-            "sold", desc=False
-        ).order("id", desc=True).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("stock").select("id, content, sold").eq("product_id", product_id).order(
+        "sold", desc=False
+    ).order("id", desc=True).execute()
     rows = resp.data or []
     return [(row.get("id"), row.get("content"), row.get("sold")) for row in rows]
 
 
 async def get_stock_detail(stock_id: int):
-    def _fetch():
-        return _get_table("stock").select("id, product_id, content, sold").eq(
-            "id", stock_id
-        ).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("stock").select("id, product_id, content, sold").eq(
+        "id", stock_id
+    ).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -562,37 +592,27 @@ async def get_stock_detail(stock_id: int):
 
 
 async def update_stock_content(stock_id: int, new_content: str):
-    def _update():
-        return _get_table("stock").update({"content": new_content}).eq("id", stock_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("stock").update({"content": new_content}).eq("id", stock_id).execute()
 
 
 async def delete_stock(stock_id: int):
-    def _delete():
-        return _get_table("stock").delete().eq("id", stock_id).execute()
-
-    await _to_thread(_delete)
+    await _get_table("stock").delete().eq("id", stock_id).execute()
+    _catalog.invalidate()
 
 
 async def delete_all_stock(product_id: int, only_unsold: bool = False):
-    def _delete():
-        query = _get_table("stock").delete().eq("product_id", product_id)
-        if only_unsold:
-            query = query.eq("sold", False)
-        return query.execute()
-
-    await _to_thread(_delete)
+    query = _get_table("stock").delete().eq("product_id", product_id)
+    if only_unsold:
+        query = query.eq("sold", False)
+    await query.execute()
+    _catalog.invalidate()
 
 
 async def export_stock(product_id: int, only_unsold: bool = True):
-    def _fetch():
-        query = _get_table("stock").select("content").eq("product_id", product_id)
-        if only_unsold:
-            query = query.eq("sold", False)
-        return query.order("id").execute()
-
-    resp = await _to_thread(_fetch)
+    query = _get_table("stock").select("content").eq("product_id", product_id)
+    if only_unsold:
+        query = query.eq("sold", False)
+    resp = await query.order("id").execute()
     rows = resp.data or []
     return [row.get("content") for row in rows]
 
@@ -610,53 +630,150 @@ async def create_order_bulk(
     final_quantity = quantity if quantity is not None else len(contents)
     final_total = total_price if total_price is not None else price_per_item * len(contents)
 
-    def _insert():
-        return _get_table("orders").insert({
-            "user_id": user_id,
-            "product_id": product_id,
-            "content": json.dumps(contents),
-            "price": int(final_total),
-            "quantity": int(final_quantity),
-            "order_group": order_group,
-            "created_at": _now_iso(),
-        }).execute()
-
-    await _to_thread(_insert)
+    await _get_table("orders").insert({
+        "user_id": user_id,
+        "product_id": product_id,
+        "content": json.dumps(contents),
+        "price": int(final_total),
+        "quantity": int(final_quantity),
+        "order_group": order_group,
+        "created_at": _now_iso(),
+    }).execute()
 
 
 async def create_order(user_id: int, product_id: int, content: str, price: int):
-    def _insert():
-        return _get_table("orders").insert({
-            "user_id": user_id,
-            "product_id": product_id,
-            "content": content,
-            "price": price,
-            "quantity": 1,
-            "created_at": _now_iso(),
-        }).execute()
+    await _get_table("orders").insert({
+        "user_id": user_id,
+        "product_id": product_id,
+        "content": content,
+        "price": price,
+        "quantity": 1,
+        "created_at": _now_iso(),
+    }).execute()
+
+
+def _checkout_result(quantity: int) -> Dict[str, Any]:
+    return {
+        "ok": False, "error": None, "items": [], "quantity": _safe_int(quantity),
+        "bonus_quantity": 0, "unit_price": 0, "total_price": 0,
+        "balance": 0, "available": 0, "order_group": None,
+    }
+
 
-    await _to_thread(_insert)
+async def checkout(user_id: int, product_id: int, quantity: int, currency: str = "vnd", usdt_rate: int = 0):
+    """
+    Balance purchase in one RPC (checkout_with_balance): claim stock, debit, create order.
+    Same result dict as the SQLite backend.
+    """
+    try:
+        resp = await _get_rpc(
+            "checkout_with_balance",
+            {
+                "p_user_id": user_id,
+                "p_product_id": product_id,
+                "p_quantity": int(quantity),
+                "p_currency": currency,
+                "p_usdt_rate": usdt_rate,
+            },
+        ).execute()
+    except Exception as exc:
+        # Only fall back when the RPC is not deployed; any other error may have committed.
+        if not _is_missing_rpc(exc):
+            raise
+        return await _checkout_legacy(user_id, product_id, quantity, currency, usdt_rate)
+
+    data = resp.data
+    row = data[0] if isinstance(data, list) and data else data
+    result = _checkout_result(quantity)
+    if isinstance(row, dict):
+        result.update(row)
+    result["items"] = _safe_list(result.get("items"))
+    result["bonus_quantity"] = _safe_int(result.get("bonus_quantity"))
+    result["available"] = _safe_int(result.get("available"))
+    if currency == "usdt":
+        result["unit_price"] = _safe_float(result.get("unit_price"))
+        result["total_price"] = _safe_float(result.get("total_price"))
+        result["balance"] = _safe_float(result.get("balance"))
+    else:
+        result["unit_price"] = _safe_int(result.get("unit_price"))
+        result["total_price"] = _safe_int(result.get("total_price"))
+        result["balance"] = _safe_int(result.get("balance"))
+    if result.get("ok"):
+        _catalog.adjust_stock(product_id, -len(result["items"]))
+    elif result.get("error") == "out_of_stock":
+        # Cached stock was higher than what is really left.
+        _catalog.invalidate()
+    return result
+
+
+async def _checkout_legacy(user_id: int, product_id: int, quantity: int, currency: str, usdt_rate: int):
+    """Multi-call fallback for databases without supabase_schema_checkout.sql (not atomic)."""
+    result = _checkout_result(quantity)
+    if result["quantity"] < 1:
+        result["error"] = "invalid_quantity"
+        return result
+    product = await get_product(product_id)
+    if not product:
+        result["error"] = "product_not_found"
+        return result
+
+    pricing = get_pricing_snapshot(product, result["quantity"], currency)
+    required_stock = int(pricing["delivered_quantity"])
+    total_price = float(pricing["total_price"]) if currency == "usdt" else int(pricing["total_price"])
+    balance = await (get_balance_usdt(user_id) if currency == "usdt" else get_balance(user_id))
+    result.update({
+        "bonus_quantity": int(pricing["bonus_quantity"]),
+        "unit_price": pricing["unit_price"],
+        "total_price": total_price,
+        "balance": balance,
+        "available": product["stock"],
+    })
+    if balance < total_price:
+        result["error"] = "insufficient_balance"
+        return result
+
+    stocks = await get_available_stock_batch(product_id, required_stock)
+    if len(stocks) < required_stock:
+        result["error"] = "out_of_stock"
+        result["available"] = len(stocks)
+        _catalog.invalidate()
+        return result
+    items = [s[1] for s in stocks]
+    await mark_stock_sold_batch([s[0] for s in stocks])
+
+    total_for_order = int(total_price * usdt_rate) if currency == "usdt" else total_price
+    order_group = f"ORD{user_id}{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    await create_order_bulk(
+        user_id, product_id, items, int(total_for_order), order_group,
+        total_price=int(total_for_order), quantity=len(items),
+    )
+    if currency == "usdt":
+        new_balance = await update_balance_usdt(user_id, -total_price)
+    else:
+        new_balance = await update_balance(user_id, -total_price)
+    result.update({
+        "ok": True,
+        "items": items,
+        "balance": new_balance,
+        "available": product["stock"] - len(items),
+        "order_group": order_group,
+    })
+    return result
 
 
 async def _get_product_names(product_ids: List[int]) -> Dict[int, str]:
     if not product_ids:
         return {}
 
-    def _fetch():
-        return _get_table("products").select("id, name").in_("id", list(set(product_ids))).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("products").select("id, name").in_("id", list(set(product_ids))).execute()
     rows = resp.data or []
     return {row.get("id"): row.get("name") for row in rows}
 
 
 async def get_user_orders(user_id: int):
-    def _fetch():
-        return _get_table("orders").select(
-            "id, product_id, content, price, created_at, quantity, products(name)"
-        ).eq("user_id", user_id).order("created_at", desc=True).limit(20).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("orders").select(
+        "id, product_id, content, price, created_at, quantity, products(name)"
+    ).eq("user_id", user_id).order("created_at", desc=True).limit(20).execute()
     rows = resp.data or []
     results = []
     for row in rows:
@@ -673,12 +790,9 @@ async def get_user_orders(user_id: int):
 
 
 async def get_order_detail(order_id: int):
-    def _fetch():
-        return _get_table("orders").select(
-            "id, product_id, content, price, created_at, quantity, products(name)"
-        ).eq("id", order_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("orders").select(
+        "id, product_id, content, price, created_at, quantity, products(name)"
+    ).eq("id", order_id).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -695,12 +809,9 @@ async def get_order_detail(order_id: int):
 
 
 async def get_sold_codes_by_product(product_id: int, limit: int = 100):
-    def _fetch():
-        return _get_table("orders").select(
-            "id, user_id, content, price, quantity, created_at"
-        ).eq("product_id", product_id).order("created_at", desc=True).limit(limit).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("orders").select(
+        "id, user_id, content, price, quantity, created_at"
+    ).eq("product_id", product_id).order("created_at", desc=True).limit(limit).execute()
     rows = resp.data or []
     return [
         (
@@ -716,12 +827,9 @@ async def get_sold_codes_by_product(product_id: int, limit: int = 100):
 
 
 async def get_sold_codes_by_user(user_id: int, limit: int = 50):
-    def _fetch():
-        return _get_table("orders").select(
-            "id, product_id, content, price, quantity, created_at, products(name)"
-        ).eq("user_id", user_id).order("created_at", desc=True).limit(limit).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("orders").select(
+        "id, product_id, content, price, quantity, created_at, products(name)"
+    ).eq("user_id", user_id).order("created_at", desc=True).limit(limit).execute()
     rows = resp.data or []
     return [
         (
@@ -737,12 +845,9 @@ async def get_sold_codes_by_user(user_id: int, limit: int = 50):
 
 
 async def search_user_by_id(user_id: int):
-    def _fetch():
-        return _get_table("users").select("user_id, username, balance, created_at").eq(
-            "user_id", user_id
-        ).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("users").select("user_id, username, balance, created_at").eq(
+        "user_id", user_id
+    ).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -752,14 +857,11 @@ async def search_user_by_id(user_id: int):
 
 # Deposit functions
 async def create_deposit_with_settings(user_id: int, amount: int, code: str):
-    def _rpc():
-        return get_supabase_client().rpc(
+    try:
+        resp = await _get_rpc(
             "create_deposit_and_get_bank_settings",
             {"p_user_id": user_id, "p_amount": amount, "p_code": code},
         ).execute()
-
-    try:
-        resp = await _to_thread(_rpc)
         data = resp.data or []
         row = data[0] if isinstance(data, list) and data else data
         if row:
@@ -778,15 +880,12 @@ async def create_deposit_with_settings(user_id: int, amount: int, code: str):
 
 
 async def create_deposit(user_id: int, amount: int, code: str):
-    def _insert():
-        return _get_table("deposits").insert({
-            "user_id": user_id,
-            "amount": amount,
-            "code": code,
-            "created_at": _now_iso(),
-        }).execute()
-
-    await _to_thread(_insert)
+    await _get_table("deposits").insert({
+        "user_id": user_id,
+        "amount": amount,
+        "code": code,
+        "created_at": _now_iso(),
+    }).execute()
 
 
 # Direct order functions
@@ -799,8 +898,8 @@ async def create_direct_order_with_settings(
     code: str,
     bonus_quantity: int = 0,
 ):
-    def _rpc():
-        return get_supabase_client().rpc(
+    try:
+        resp = await _get_rpc(
             "create_direct_order_and_get_bank_settings",
             {
                 "p_user_id": user_id,
@@ -812,9 +911,6 @@ async def create_direct_order_with_settings(
                 "p_code": code,
             },
         ).execute()
-
-    try:
-        resp = await _to_thread(_rpc)
         data = resp.data or []
         row = data[0] if isinstance(data, list) and data else data
         if row:
@@ -848,46 +944,40 @@ async def create_direct_order(
     code: str,
     bonus_quantity: int = 0,
 ):
-    def _insert():
-        payload = {
+    payload = {
+        "user_id": user_id,
+        "product_id": product_id,
+        "quantity": quantity,
+        "bonus_quantity": bonus_quantity,
+        "unit_price": unit_price,
+        "amount": amount,
+        "code": code,
+        "created_at": _now_iso(),
+    }
+    try:
+        await _get_table("direct_orders").insert(payload).execute()
+    except Exception:
+        legacy_payload = {
             "user_id": user_id,
             "product_id": product_id,
             "quantity": quantity,
-            "bonus_quantity": bonus_quantity,
             "unit_price": unit_price,
             "amount": amount,
             "code": code,
             "created_at": _now_iso(),
         }
-        try:
-            return _get_table("direct_orders").insert(payload).execute()
-        except Exception:
-            legacy_payload = {
-                "user_id": user_id,
-                "product_id": product_id,
-                "quantity": quantity,
-                "unit_price": unit_price,
-                "amount": amount,
-                "code": code,
-                "created_at": _now_iso(),
-            }
-            return _get_table("direct_orders").insert(legacy_payload).execute()
-
-    await _to_thread(_insert)
+        await _get_table("direct_orders").insert(legacy_payload).execute()
 
 
 async def get_pending_direct_orders():
-    def _fetch():
-        try:
-            return _get_table("direct_orders").select(
-                "id, user_id, product_id, quantity, bonus_quantity, unit_price, amount, code, created_at"
-            ).eq("status", "pending").execute()
-        except Exception:
-            return _get_table("direct_orders").select(
-                "id, user_id, product_id, quantity, unit_price, amount, code, created_at"
-            ).eq("status", "pending").execute()
-
-    resp = await _to_thread(_fetch)
+    try:
+        resp = await _get_table("direct_orders").select(
+            "id, user_id, product_id, quantity, bonus_quantity, unit_price, amount, code, created_at"
+        ).eq("status", "pending").execute()
+    except Exception:
+        resp = await _get_table("direct_orders").select(
+            "id, user_id, product_id, quantity, unit_price, amount, code, created_at"
+        ).eq("status", "pending").execute()
     rows = resp.data or []
     return [
         (
@@ -906,20 +996,27 @@ async def get_pending_direct_orders():
 
 
 async def set_direct_order_status(order_id: int, status: str):
-    def _update():
-        return _get_table("direct_orders").update({"status": status}).eq("id", order_id).execute()
+    await _get_table("direct_orders").update({"status": status}).eq("id", order_id).execute()
 
-    await _to_thread(_update)
+
+async def cancel_pending_direct_orders(codes: list):
+    """Cancel the direct orders with these codes that are still pending, in one request.
+    Returns (id, user_id, code) of the rows actually cancelled (paid orders are left alone)."""
+    codes = list(dict.fromkeys(code for code in codes if code))
+    if not codes:
+        return []
+
+    resp = await _get_table("direct_orders").update({"status": "cancelled"}).in_(
+        "code", codes
+    ).eq("status", "pending").execute()
+    return [(row.get("id"), row.get("user_id"), row.get("code")) for row in resp.data or []]
 
 
 async def get_pending_website_direct_orders():
-    def _fetch():
-        return _get_table("website_direct_orders").select(
+    try:
+        resp = await _get_table("website_direct_orders").select(
             "id, auth_user_id, user_email, product_id, quantity, bonus_quantity, unit_price, amount, code, created_at"
         ).eq("status", "pending").execute()
-
-    try:
-        resp = await _to_thread(_fetch)
     except Exception:
         return []
 
@@ -955,8 +1052,21 @@ async def create_website_order_bulk(
     final_quantity = quantity if quantity is not None else len(contents)
     final_total = total_price if total_price is not None else price_per_item * len(contents)
 
-    def _insert():
-        payload = {
+    payload = {
+        "auth_user_id": auth_user_id,
+        "user_email": user_email,
+        "product_id": product_id,
+        "content": json.dumps(contents),
+        "price": int(final_total),
+        "quantity": int(final_quantity),
+        "order_group": order_group,
+        "source_direct_code": source_direct_code,
+        "created_at": _now_iso(),
+    }
+    try:
+        resp = await _get_table("website_orders").insert(payload).execute()
+    except Exception:
+        legacy_payload = {
             "auth_user_id": auth_user_id,
             "user_email": user_email,
             "product_id": product_id,
@@ -964,25 +1074,9 @@ async def create_website_order_bulk(
             "price": int(final_total),
             "quantity": int(final_quantity),
             "order_group": order_group,
-            "source_direct_code": source_direct_code,
             "created_at": _now_iso(),
         }
-        try:
-            return _get_table("website_orders").insert(payload).execute()
-        except Exception:
-            legacy_payload = {
-                "auth_user_id": auth_user_id,
-                "user_email": user_email,
-                "product_id": product_id,
-                "content": json.dumps(contents),
-                "price": int(final_total),
-                "quantity": int(final_quantity),
-                "order_group": order_group,
-                "created_at": _now_iso(),
-            }
-            return _get_table("website_orders").insert(legacy_payload).execute()
-
-    resp = await _to_thread(_insert)
+        resp = await _get_table("website_orders").insert(legacy_payload).execute()
     rows = resp.data or []
     if isinstance(rows, list) and rows:
         return _safe_int(rows[0].get("id"), 0) or None
@@ -996,31 +1090,25 @@ async def set_website_direct_order_status(
     status: str,
     fulfilled_order_id: Optional[int] = None,
 ):
-    def _update():
-        payload: Dict[str, Any] = {
-            "status": status,
-            "updated_at": _now_iso(),
-        }
-        if status == "confirmed":
-            payload["confirmed_at"] = _now_iso()
-        if fulfilled_order_id is not None:
-            payload["fulfilled_order_id"] = fulfilled_order_id
-        return _get_table("website_direct_orders").update(payload).eq("id", order_id).execute()
-
+    payload: Dict[str, Any] = {
+        "status": status,
+        "updated_at": _now_iso(),
+    }
+    if status == "confirmed":
+        payload["confirmed_at"] = _now_iso()
+    if fulfilled_order_id is not None:
+        payload["fulfilled_order_id"] = fulfilled_order_id
     try:
-        await _to_thread(_update)
+        await _get_table("website_direct_orders").update(payload).eq("id", order_id).execute()
     except Exception:
         # Website-specific tables may not exist yet on some environments.
         return
 
 
 async def get_pending_deposits():
-    def _fetch():
-        return _get_table("deposits").select("id, user_id, amount, code, created_at").eq(
-            "status", "pending"
-        ).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("deposits").select("id, user_id, amount, code, created_at").eq(
+        "status", "pending"
+    ).execute()
     rows = resp.data or []
     return [
         (
@@ -1035,10 +1123,7 @@ async def get_pending_deposits():
 
 
 async def confirm_deposit(deposit_id: int):
-    def _fetch():
-        return _get_table("deposits").select("user_id, amount").eq("id", deposit_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("deposits").select("user_id, amount").eq("id", deposit_id).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -1046,35 +1131,24 @@ async def confirm_deposit(deposit_id: int):
     user_id = row.get("user_id")
     amount = _safe_int(row.get("amount"))
 
-    def _update_deposit():
-        return _get_table("deposits").update({"status": "confirmed"}).eq("id", deposit_id).execute()
-
-    await _to_thread(_update_deposit)
+    await _get_table("deposits").update({"status": "confirmed"}).eq("id", deposit_id).execute()
     await update_balance(user_id, amount)
     return (user_id, amount)
 
 
 async def cancel_deposit(deposit_id: int):
-    def _update():
-        return _get_table("deposits").update({"status": "cancelled"}).eq("id", deposit_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("deposits").update({"status": "cancelled"}).eq("id", deposit_id).execute()
 
 
 async def set_deposit_status(deposit_id: int, status: str):
-    def _update():
-        return _get_table("deposits").update({"status": status}).eq("id", deposit_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("deposits").update({"status": status}).eq("id", deposit_id).execute()
 
 
 # Stats
+@single_flight
 async def get_stats():
-    def _rpc():
-        return get_supabase_client().rpc("get_stats").execute()
-
     try:
-        resp = await _to_thread(_rpc)
+        resp = await _get_rpc("get_stats").execute()
         data = resp.data or []
         row = data[0] if isinstance(data, list) and data else data
         if row:
@@ -1087,49 +1161,140 @@ async def get_stats():
         pass
 
     # Fallback to manual counts
-    def _count_users():
-        return _get_table("users").select("user_id").execute()
-
-    def _count_orders():
-        return _get_table("orders").select("id, price").execute()
-
-    users_resp = await _to_thread(_count_users)
-    orders_resp = await _to_thread(_count_orders)
+    users_resp = await _get_table("users").select("user_id").execute()
+    orders_resp = await _get_table("orders").select("id, price").execute()
     users = len(users_resp.data or [])
     orders = len(orders_resp.data or [])
     revenue = sum(_safe_int(row.get("price")) for row in (orders_resp.data or []))
     return {"users": users, "orders": orders, "revenue": revenue}
 
 
+# PostgREST caps every response at the project's max-rows (1000 by default); keep pages at or below it.
+USER_ID_PAGE_SIZE = 1000
+
+
+async def iter_user_ids(after_user_id: int = 0, page_size: int = USER_ID_PAGE_SIZE, skip_blocked: bool = False):
+    """
+    Stream user ids in ascending order, one keyset page (user_id > last seen id) per request.
+    Pages are requested lazily, so only one page is held in memory. Stops on an empty page
+    (a short page may just be the max-rows cap, not the end).
+    """
+    page_size = max(1, int(page_size))
+    last_id = after_user_id
+    while True:
+        query = _get_table("users").select("user_id").gt("user_id", last_id)
+        if skip_blocked:
+            query = query.eq("is_blocked", False)
+        resp = await query.order("user_id").limit(page_size).execute()
+        ids = [row.get("user_id") for row in resp.data or [] if row.get("user_id") is not None]
+        if not ids:
+            return
+        for user_id in ids:
+            yield user_id
+        last_id = ids[-1]
+
+
 async def get_all_user_ids():
-    def _fetch():
-        return _get_table("users").select("user_id").execute()
+    """Every user id (paged, so not truncated at max-rows); prefer iter_user_ids() for large audiences."""
+    return [user_id async for user_id in iter_user_ids()]
+
+
+# Broadcast functions
+_BROADCAST_JOB_COLUMNS = (
+    "id, text, status, admin_chat_id, progress_message_id, total, sent, failed, blocked, "
+    "last_user_id, created_at, updated_at, finished_at"
+)
+
+
+def _broadcast_job_row_to_dict(row: Dict[str, Any]) -> Dict[str, Any]:
+    job = {key.strip(): row.get(key.strip()) for key in _BROADCAST_JOB_COLUMNS.split(",")}
+    for key in ("total", "sent", "failed", "blocked", "last_user_id"):
+        job[key] = _safe_int(job.get(key))
+    return job
 
-    resp = await _to_thread(_fetch)
-    rows = resp.data or []
-    return [row.get("user_id") for row in rows if row.get("user_id") is not None]
+
+async def count_broadcast_recipients() -> int:
+    resp = await _get_table("users").select("user_id", count="exact", head=True).eq(
+        "is_blocked", False
+    ).execute()
+    return _safe_int(resp.count)
+
+
+async def mark_users_blocked(user_ids: list):
+    if not user_ids:
+        return
+
+    await _get_table("users").update({"is_blocked": True}).in_(
+        "user_id", list(user_ids)
+    ).execute()
+
+
+async def create_broadcast_job(text: str, admin_chat_id: int, total: int):
+    resp = await _get_table("broadcast_jobs").insert({
+        "text": text,
+        "status": "running",
+        "admin_chat_id": admin_chat_id,
+        "total": total,
+        "created_at": _now_iso(),
+        "updated_at": _now_iso(),
+    }).execute()
+    data = resp.data or []
+    return data[0].get("id") if data else None
+
+
+async def get_broadcast_job(job_id: int) -> Optional[Dict[str, Any]]:
+    resp = await _get_table("broadcast_jobs").select(_BROADCAST_JOB_COLUMNS).eq("id", job_id).limit(1).execute()
+    data = resp.data or []
+    return _broadcast_job_row_to_dict(data[0]) if data else None
+
+
+async def get_running_broadcast_jobs() -> List[Dict[str, Any]]:
+    resp = await _get_table("broadcast_jobs").select(_BROADCAST_JOB_COLUMNS).eq(
+        "status", "running"
+    ).order("id").execute()
+    return [_broadcast_job_row_to_dict(row) for row in resp.data or []]
+
+
+async def set_broadcast_progress_message(job_id: int, message_id: int):
+    await _get_table("broadcast_jobs").update({
+        "progress_message_id": message_id,
+        "updated_at": _now_iso(),
+    }).eq("id", job_id).execute()
+
+
+async def save_broadcast_progress(job_id: int, last_user_id: int, sent: int, failed: int, blocked: int):
+    """Checkpoint after each page: on restart the job continues from user_id > last_user_id."""
+    await _get_table("broadcast_jobs").update({
+        "last_user_id": last_user_id,
+        "sent": sent,
+        "failed": failed,
+        "blocked": blocked,
+        "updated_at": _now_iso(),
+    }).eq("id", job_id).execute()
+
+
+async def finish_broadcast_job(job_id: int, status: str = "done"):
+    await _get_table("broadcast_jobs").update({
+        "status": status,
+        "updated_at": _now_iso(),
+        "finished_at": _now_iso(),
+    }).eq("id", job_id).execute()
 
 
 # Withdrawal functions
 async def create_withdrawal(user_id: int, amount: int, momo_phone: str):
-    def _insert():
-        return _get_table("withdrawals").insert({
-            "user_id": user_id,
-            "amount": amount,
-            "momo_phone": momo_phone,
-            "created_at": _now_iso(),
-        }).execute()
-
-    await _to_thread(_insert)
+    await _get_table("withdrawals").insert({
+        "user_id": user_id,
+        "amount": amount,
+        "momo_phone": momo_phone,
+        "created_at": _now_iso(),
+    }).execute()
 
 
 async def get_pending_withdrawals():
-    def _fetch():
-        return _get_table("withdrawals").select(
-            "id, user_id, amount, momo_phone, created_at"
-        ).eq("status", "pending").execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("withdrawals").select(
+        "id, user_id, amount, momo_phone, created_at"
+    ).eq("status", "pending").execute()
     rows = resp.data or []
     return [
         (
@@ -1144,12 +1309,9 @@ async def get_pending_withdrawals():
 
 
 async def get_withdrawal_detail(withdrawal_id: int):
-    def _fetch():
-        return _get_table("withdrawals").select(
-            "id, user_id, amount, momo_phone, status, created_at"
-        ).eq("id", withdrawal_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("withdrawals").select(
+        "id, user_id, amount, momo_phone, status, created_at"
+    ).eq("id", withdrawal_id).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -1165,23 +1327,17 @@ async def get_withdrawal_detail(withdrawal_id: int):
 
 
 async def get_user_pending_withdrawal(user_id: int):
-    def _fetch():
-        return _get_table("withdrawals").select("amount").eq("user_id", user_id).eq(
-            "status", "pending"
-        ).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("withdrawals").select("amount").eq("user_id", user_id).eq(
+        "status", "pending"
+    ).execute()
     rows = resp.data or []
     return sum(_safe_int(row.get("amount")) for row in rows)
 
 
 async def confirm_withdrawal(withdrawal_id: int):
-    def _fetch():
-        return _get_table("withdrawals").select("user_id, amount, momo_phone").eq(
-            "id", withdrawal_id
-        ).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("withdrawals").select("user_id, amount, momo_phone").eq(
+        "id", withdrawal_id
+    ).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -1190,115 +1346,97 @@ async def confirm_withdrawal(withdrawal_id: int):
     amount = _safe_int(row.get("amount"))
     momo_phone = row.get("momo_phone")
 
-    balance = await get_balance(user_id)
-    if balance < amount:
+    if await debit_balance(user_id, amount) is None:
         return None
 
-    await _set_balance(user_id, balance - amount)
-
-    def _update():
-        return _get_table("withdrawals").update({"status": "confirmed"}).eq("id", withdrawal_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("withdrawals").update({"status": "confirmed"}).eq("id", withdrawal_id).execute()
     return (user_id, amount, momo_phone)
 
 
 async def cancel_withdrawal(withdrawal_id: int):
-    def _fetch():
-        return _get_table("withdrawals").select("user_id, amount").eq("id", withdrawal_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("withdrawals").select("user_id, amount").eq("id", withdrawal_id).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
     row = data[0]
 
-    def _update():
-        return _get_table("withdrawals").update({"status": "cancelled"}).eq("id", withdrawal_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("withdrawals").update({"status": "cancelled"}).eq("id", withdrawal_id).execute()
     return (row.get("user_id"), _safe_int(row.get("amount")))
 
 
 # Settings functions
-async def get_setting(key: str, default: str = ""):
-    now = time.time()
-    cached = _settings_cache["values"].get(key)
-    if cached is not None and (now - _settings_cache["ts"] <= _SETTINGS_TTL_SECONDS):
-        return cached
+@single_flight
+async def _load_all_settings() -> Dict[str, Any]:
+    resp = await _get_table("settings").select("key, value").execute()
+    return {row.get("key"): row.get("value") for row in resp.data or [] if row.get("key") is not None}
 
-    def _fetch():
-        return _get_table("settings").select("value").eq("key", key).limit(1).execute()
 
-    resp = await _to_thread(_fetch)
+@single_flight
+async def _load_settings_version() -> Optional[str]:
+    resp = await _get_table("settings").select("value").eq("key", SETTINGS_VERSION_KEY).limit(1).execute()
     data = resp.data or []
-    value = data[0].get("value") if data else default
-    _settings_cache["values"][key] = value
-    _settings_cache["ts"] = now
-    return value
+    return data[0].get("value") if data else None
 
 
-async def set_setting(key: str, value: str):
-    def _upsert():
-        return _get_table("settings").upsert({"key": key, "value": value}).execute()
+# Whole settings table in memory; reloaded only when settings_version moves
+# (trigger in supabase_schema_settings_version.sql), so dashboard edits apply within seconds.
+_settings = SettingsSnapshot(_load_all_settings, _load_settings_version)
+
+
+async def get_setting(key: str, default: str = ""):
+    return await _settings.get(key, default)
+
 
-    await _to_thread(_upsert)
-    _settings_cache["values"][key] = value
-    _settings_cache["ts"] = time.time()
+async def set_setting(key: str, value: str):
+    await _get_table("settings").upsert({"key": key, "value": value}).execute()
+    _settings.set_local(key, value)
 
 
 async def get_ui_flags() -> Dict[str, bool]:
+    settings = await _settings.values()
     return {
-        "show_shop": _parse_bool(await get_setting("show_shop", "true")),
-        "show_balance": _parse_bool(await get_setting("show_balance", "true")),
-        "show_deposit": _parse_bool(await get_setting("show_deposit", "true")),
-        "show_withdraw": _parse_bool(await get_setting("show_withdraw", "true")),
-        "show_usdt": _parse_bool(await get_setting("show_usdt", "true")),
-        "show_history": _parse_bool(await get_setting("show_history", "true")),
-        "show_language": _parse_bool(await get_setting("show_language", "true")),
-        "show_support": _parse_bool(await get_setting("show_support", "true")),
+        "show_shop": _parse_bool(settings.get("show_shop", "true")),
+        "show_balance": _parse_bool(settings.get("show_balance", "true")),
+        "show_deposit": _parse_bool(settings.get("show_deposit", "true")),
+        "show_withdraw": _parse_bool(settings.get("show_withdraw", "true")),
+        "show_usdt": _parse_bool(settings.get("show_usdt", "true")),
+        "show_history": _parse_bool(settings.get("show_history", "true")),
+        "show_language": _parse_bool(settings.get("show_language", "true")),
+        "show_support": _parse_bool(settings.get("show_support", "true")),
     }
 
 
 async def get_bank_settings():
+    settings = await _settings.values()
     return {
-        "bank_name": await get_setting("bank_name", ""),
-        "account_number": await get_setting("account_number", ""),
-        "account_name": await get_setting("account_name", ""),
-        "sepay_token": await get_setting("sepay_token", ""),
+        "bank_name": settings.get("bank_name") or "",
+        "account_number": settings.get("account_number") or "",
+        "account_name": settings.get("account_name") or "",
+        "sepay_token": settings.get("sepay_token") or "",
     }
 
 
 # Binance deposit functions
 async def create_binance_deposit(user_id: int, usdt_amount: float, vnd_amount: int, code: str):
-    def _insert():
-        return _get_table("binance_deposits").insert({
-            "user_id": user_id,
-            "usdt_amount": usdt_amount,
-            "vnd_amount": vnd_amount,
-            "code": code,
-            "created_at": _now_iso(),
-        }).execute()
-
-    await _to_thread(_insert)
+    await _get_table("binance_deposits").insert({
+        "user_id": user_id,
+        "usdt_amount": usdt_amount,
+        "vnd_amount": vnd_amount,
+        "code": code,
+        "created_at": _now_iso(),
+    }).execute()
 
 
 async def update_binance_deposit_screenshot(user_id: int, code: str, file_id: str):
-    def _update():
-        return _get_table("binance_deposits").update(
-            {"screenshot_file_id": file_id}
-        ).eq("user_id", user_id).eq("code", code).eq("status", "pending").execute()
-
-    await _to_thread(_update)
+    await _get_table("binance_deposits").update(
+        {"screenshot_file_id": file_id}
+    ).eq("user_id", user_id).eq("code", code).eq("status", "pending").execute()
 
 
 async def get_pending_binance_deposits():
-    def _fetch():
-        return _get_table("binance_deposits").select(
-            "id, user_id, usdt_amount, vnd_amount, code, screenshot_file_id, created_at"
-        ).eq("status", "pending").not_.is_("screenshot_file_id", "null").execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("binance_deposits").select(
+        "id, user_id, usdt_amount, vnd_amount, code, screenshot_file_id, created_at"
+    ).eq("status", "pending").not_.is_("screenshot_file_id", "null").execute()
     rows = resp.data or []
     return [
         (
@@ -1315,12 +1453,9 @@ async def get_pending_binance_deposits():
 
 
 async def get_binance_deposit_detail(deposit_id: int):
-    def _fetch():
-        return _get_table("binance_deposits").select(
-            "id, user_id, usdt_amount, vnd_amount, code, screenshot_file_id, status, created_at"
-        ).eq("id", deposit_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("binance_deposits").select(
+        "id, user_id, usdt_amount, vnd_amount, code, screenshot_file_id, status, created_at"
+    ).eq("id", deposit_id).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -1338,12 +1473,9 @@ async def get_binance_deposit_detail(deposit_id: int):
 
 
 async def confirm_binance_deposit(deposit_id: int):
-    def _fetch():
-        return _get_table("binance_deposits").select("user_id, usdt_amount").eq(
-            "id", deposit_id
-        ).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("binance_deposits").select("user_id, usdt_amount").eq(
+        "id", deposit_id
+    ).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -1351,30 +1483,21 @@ async def confirm_binance_deposit(deposit_id: int):
     user_id = row.get("user_id")
     usdt_amount = _safe_float(row.get("usdt_amount"))
 
-    def _update_deposit():
-        return _get_table("binance_deposits").update({"status": "confirmed"}).eq(
-            "id", deposit_id
-        ).execute()
-
-    await _to_thread(_update_deposit)
+    await _get_table("binance_deposits").update({"status": "confirmed"}).eq(
+        "id", deposit_id
+    ).execute()
     await update_balance_usdt(user_id, usdt_amount)
     return (user_id, usdt_amount)
 
 
 async def cancel_binance_deposit(deposit_id: int):
-    def _update():
-        return _get_table("binance_deposits").update({"status": "cancelled"}).eq("id", deposit_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("binance_deposits").update({"status": "cancelled"}).eq("id", deposit_id).execute()
 
 
 async def get_user_pending_binance_deposit(user_id: int):
-    def _fetch():
-        return _get_table("binance_deposits").select(
-            "id, usdt_amount, vnd_amount, code"
-        ).eq("user_id", user_id).eq("status", "pending").order("id", desc=True).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("binance_deposits").select(
+        "id, usdt_amount, vnd_amount, code"
+    ).eq("user_id", user_id).eq("status", "pending").order("id", desc=True).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -1389,25 +1512,19 @@ async def get_user_pending_binance_deposit(user_id: int):
 
 # USDT Withdrawal functions
 async def create_usdt_withdrawal(user_id: int, usdt_amount: float, wallet_address: str, network: str = "TRC20"):
-    def _insert():
-        return _get_table("usdt_withdrawals").insert({
-            "user_id": user_id,
-            "usdt_amount": usdt_amount,
-            "wallet_address": wallet_address,
-            "network": network,
-            "created_at": _now_iso(),
-        }).execute()
-
-    await _to_thread(_insert)
+    await _get_table("usdt_withdrawals").insert({
+        "user_id": user_id,
+        "usdt_amount": usdt_amount,
+        "wallet_address": wallet_address,
+        "network": network,
+        "created_at": _now_iso(),
+    }).execute()
 
 
 async def get_pending_usdt_withdrawals():
-    def _fetch():
-        return _get_table("usdt_withdrawals").select(
-            "id, user_id, usdt_amount, wallet_address, network, created_at"
-        ).eq("status", "pending").execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("usdt_withdrawals").select(
+        "id, user_id, usdt_amount, wallet_address, network, created_at"
+    ).eq("status", "pending").execute()
     rows = resp.data or []
     return [
         (
@@ -1423,12 +1540,9 @@ async def get_pending_usdt_withdrawals():
 
 
 async def get_usdt_withdrawal_detail(withdrawal_id: int):
-    def _fetch():
-        return _get_table("usdt_withdrawals").select(
-            "id, user_id, usdt_amount, wallet_address, network, status, created_at"
-        ).eq("id", withdrawal_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("usdt_withdrawals").select(
+        "id, user_id, usdt_amount, wallet_address, network, status, created_at"
+    ).eq("id", withdrawal_id).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -1445,23 +1559,17 @@ async def get_usdt_withdrawal_detail(withdrawal_id: int):
 
 
 async def get_user_pending_usdt_withdrawal(user_id: int):
-    def _fetch():
-        return _get_table("usdt_withdrawals").select("usdt_amount").eq("user_id", user_id).eq(
-            "status", "pending"
-        ).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("usdt_withdrawals").select("usdt_amount").eq("user_id", user_id).eq(
+        "status", "pending"
+    ).execute()
     rows = resp.data or []
     return sum(_safe_float(row.get("usdt_amount")) for row in rows)
 
 
 async def confirm_usdt_withdrawal(withdrawal_id: int):
-    def _fetch():
-        return _get_table("usdt_withdrawals").select(
-            "user_id, usdt_amount, wallet_address"
-        ).eq("id", withdrawal_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("usdt_withdrawals").select(
+        "user_id, usdt_amount, wallet_address"
+    ).eq("id", withdrawal_id).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
@@ -1470,50 +1578,69 @@ async def confirm_usdt_withdrawal(withdrawal_id: int):
     usdt_amount = _safe_float(row.get("usdt_amount"))
     wallet_address = row.get("wallet_address")
 
-    balance = await get_balance_usdt(user_id)
-    if balance < usdt_amount:
+    if await debit_balance_usdt(user_id, usdt_amount) is None:
         return None
 
-    await _set_balance_usdt(user_id, balance - usdt_amount)
-
-    def _update():
-        return _get_table("usdt_withdrawals").update({"status": "confirmed"}).eq("id", withdrawal_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("usdt_withdrawals").update({"status": "confirmed"}).eq("id", withdrawal_id).execute()
     return (user_id, usdt_amount, wallet_address)
 
 
 async def cancel_usdt_withdrawal(withdrawal_id: int):
-    def _fetch():
-        return _get_table("usdt_withdrawals").select("user_id, usdt_amount").eq(
-            "id", withdrawal_id
-        ).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("usdt_withdrawals").select("user_id, usdt_amount").eq(
+        "id", withdrawal_id
+    ).limit(1).execute()
     data = resp.data or []
     if not data:
         return None
     row = data[0]
 
-    def _update():
-        return _get_table("usdt_withdrawals").update({"status": "cancelled"}).eq("id", withdrawal_id).execute()
-
-    await _to_thread(_update)
+    await _get_table("usdt_withdrawals").update({"status": "cancelled"}).eq("id", withdrawal_id).execute()
     return (row.get("user_id"), _safe_float(row.get("usdt_amount")))
 
 
 # SePay processed transactions
 async def is_processed_transaction(tx_id: str) -> bool:
-    def _fetch():
-        return _get_table("processed_transactions").select("tx_id").eq("tx_id", tx_id).limit(1).execute()
-
-    resp = await _to_thread(_fetch)
+    resp = await _get_table("processed_transactions").select("tx_id").eq("tx_id", tx_id).limit(1).execute()
     data = resp.data or []
     return bool(data)
 
 
 async def mark_processed_transaction(tx_id: str):
-    def _insert():
-        return _get_table("processed_transactions").insert({"tx_id": tx_id}).execute()
+    await _get_table("processed_transactions").insert({"tx_id": tx_id}).execute()
+
+
+# ids per `tx_id=in.(...)` filter, keeps the request URL short
+PROCESSED_TX_QUERY_CHUNK = 200
+
+
+async def get_processed_transaction_ids(tx_ids: list) -> set:
+    """Which of tx_ids are already processed (one request per PROCESSED_TX_QUERY_CHUNK ids)."""
+    ids = list(dict.fromkeys(str(tx_id) for tx_id in tx_ids if tx_id))
+    found = set()
+    for start in range(0, len(ids), PROCESSED_TX_QUERY_CHUNK):
+        chunk = ids[start:start + PROCESSED_TX_QUERY_CHUNK]
 
-    await _to_thread(_insert)
+        resp = await _get_table("processed_transactions").select("tx_id").in_("tx_id", chunk).execute()
+        found.update(str(row.get("tx_id")) for row in resp.data or [])
+    return found
+
+
+async def get_recent_processed_transaction_ids(limit: int = 5000, page_size: int = USER_ID_PAGE_SIZE) -> list:
+    """
+    Newest processed tx ids first (warms the SePay checker's in-memory set).
+    Paged with range(): one .limit(limit) request would be cut at PostgREST's max-rows
+    (1000 by default). Advances by rows actually returned, in case max-rows is lower still.
+    """
+    tx_ids: List[str] = []
+    page_size = max(1, int(page_size))
+    while len(tx_ids) < limit:
+        start = len(tx_ids)
+        end = min(limit, start + page_size) - 1
+        resp = await _get_table("processed_transactions").select("tx_id").order(
+            "processed_at", desc=True
+        ).order("tx_id", desc=True).range(start, end).execute()
+        rows = resp.data or []
+        if not rows:
+            break
+        tx_ids.extend(str(row.get("tx_id")) for row in rows)
+    return tx_ids[:limit]
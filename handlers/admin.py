@@ -4,10 +4,11 @@ from database import (
     get_products, add_product, delete_product, add_stock_bulk,
     get_pending_deposits, confirm_deposit, cancel_deposit, get_stats,
     get_pending_withdrawals, confirm_withdrawal, cancel_withdrawal,
-    get_bank_settings, set_setting, get_setting, get_all_user_ids,
+    get_bank_settings, set_setting, get_setting,
     get_stock_by_product, get_stock_detail, update_stock_content, delete_stock, get_product,
     delete_all_stock, export_stock, get_sold_codes_by_product, get_sold_codes_by_user, search_user_by_id,
-    get_user_language
+    get_user_language, get_chat_log_stats, get_catalog_version,
+    get_single_flight_stats
 )
 from keyboards import (
     admin_menu_keyboard, admin_products_keyboard, admin_stock_keyboard,
@@ -17,6 +18,8 @@ from keyboards import (
 )
 import io
 from config import ADMIN_IDS
+from helpers.broadcast import start_broadcast
+from helpers.outbound import get_outbound_stats
 from helpers.ui import get_user_keyboard
 
 # States
@@ -313,6 +316,28 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """
     for p in products:
         text += f"• {p['name']}: còn {p['stock']} stock\n"
+
+    chat_log = get_chat_log_stats()
+    text += "\n⚙️ Vận hành:\n"
+    text += (
+        f"💬 Chat log: đã ghi {chat_log['written']}, chờ {chat_log['queued']}, "
+        f"bỏ {chat_log['dropped']}, lỗi {chat_log['failed']}\n"
+    )
+    text += f"🗂 Catalog cache: phiên bản {get_catalog_version()}\n"
+    for name, counters in get_single_flight_stats().items():
+        if counters["calls"]:
+            text += (
+                f"🔁 {name}: {counters['executed']}/{counters['calls']} truy vấn DB "
+                f"(gộp {counters['coalesced']})\n"
+            )
+    outbound = get_outbound_stats()
+    text += f"📤 Hàng đợi gửi: {outbound.pop('queued')} tin chờ\n"
+    for name, counters in outbound.items():
+        if counters["sent"] or counters["failed"]:
+            text += (
+                f"  • {name}: gửi {counters['sent']}, lỗi {counters['failed']}, thử lại {counters['retried']}, "
+                f"trễ TB {counters['avg_latency_ms']}ms (max {counters['max_latency_ms']}ms)\n"
+            )
     
     await query.edit_message_text(text, reply_markup=back_keyboard("admin"))
 
@@ -629,36 +654,16 @@ async def notification_command(update: Update, context: ContextTypes.DEFAULT_TYP
     return NOTIFICATION_MESSAGE
 
 async def notification_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Gửi thông báo đến tất cả user"""
+    """Gửi thông báo đến tất cả user (chạy nền, xem helpers/broadcast.py)"""
     message_content = update.message.text
     
-    # Lấy tất cả user
-    user_ids = await get_all_user_ids()
-    
-    if not user_ids:
-        await update.message.reply_text("❌ Chưa có user nào trong hệ thống!")
-        return ConversationHandler.END
-    
     # Format thông báo
     notification_text = f"📢 Thông báo từ Admin:\n\n{message_content}"
     
-    await update.message.reply_text(f"⏳ Đang gửi thông báo đến {len(user_ids)} user...")
-    
-    success = 0
-    failed = 0
-    
-    for uid in user_ids:
-        try:
-            await context.bot.send_message(chat_id=uid, text=notification_text)
-            success += 1
-        except Exception:
-            failed += 1
-    
-    await update.message.reply_text(
-        f"✅ Đã gửi thông báo!\n\n"
-        f"📤 Thành công: {success}\n"
-        f"❌ Thất bại: {failed} (user đã block bot)"
-    )
+    # Job chạy nền và tự cập nhật tiến độ cho admin; handler trả về ngay.
+    job = await start_broadcast(context.bot, update.effective_chat.id, notification_text)
+    if not job:
+        await update.message.reply_text("❌ Chưa có user nào trong hệ thống!")
     return ConversationHandler.END
 
 # Stock management
@@ -3,7 +3,7 @@ from typing import Any, Dict, Optional, Tuple
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from database import get_or_create_user, log_telegram_message
+from database import ensure_user, log_telegram_message
 
 
 def _extract_content(update: Update) -> Tuple[str, Optional[str], Optional[Dict[str, Any]]]:
@@ -65,7 +65,8 @@ async def log_incoming_message(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     try:
-        await get_or_create_user(user.id, getattr(user, "username", None))
+        # Known users are served from an in-process cache (no DB round-trip).
+        await ensure_user(user.id, getattr(user, "username", None))
     except Exception:
         # User creation is best-effort; logging can still proceed.
         pass
@@ -2,21 +2,23 @@ import random
 import string
 import io
 from telegram import Update, InputFile, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes, ConversationHandler
+from telegram.ext import ConversationHandler
 from database import (
-    get_products, get_product, get_balance, update_balance,
-    get_available_stock, mark_stock_sold, create_order, create_order_bulk,
+    get_products, get_product, get_balance,
+    get_available_stock, mark_stock_sold, create_order,
     get_user_orders, create_deposit_with_settings, get_or_create_user,
     create_direct_order_with_settings,
-    get_available_stock_batch, mark_stock_sold_batch,
-    get_user_language, get_balance_usdt, update_balance_usdt
+    checkout,
 )
 from keyboards import (
     products_keyboard, confirm_buy_keyboard,
     main_menu_keyboard, delete_keyboard
 )
-from helpers.ui import get_shop_page_size, get_user_keyboard, is_feature_enabled
+from helpers.request_context import BotContext
+from helpers.ui import get_shop_page_size
 from helpers.menu import delete_last_menu_message, set_last_menu_message, clear_last_menu_message
+from helpers.order_expiry import schedule_direct_order_expiry
+from helpers.outbound import PRIORITY_ADMIN, send_priority
 from helpers.sepay_state import mark_vietqr_message, mark_bot_message
 from helpers.formatting import format_stock_items
 from helpers.pricing import (
@@ -122,20 +124,7 @@ def generate_vietqr_url(bank_name: str, account_number: str, account_name: str,
     return qr_url
 
 
-async def get_payment_mode() -> str:
-    mode = PAYMENT_MODE or "hybrid"
-    try:
-        from database import get_setting
-        mode = await get_setting("payment_mode", PAYMENT_MODE)
-    except Exception:
-        pass
-    mode = (mode or "hybrid").lower()
-    if mode not in ("direct", "hybrid", "balance"):
-        mode = "hybrid"
-    return mode
-
-
-async def send_direct_payment(context: ContextTypes.DEFAULT_TYPE, chat_id: int, lang: str, user_id: int,
+async def send_direct_payment(context: BotContext, chat_id: int, lang: str, user_id: int,
                               product_id: int, product_name: str, quantity: int, unit_price: int, total_price: int,
                               bonus_quantity: int = 0):
     pay_code = f"SEBUY {user_id}{random.randint(1000, 9999)}"
@@ -148,6 +137,8 @@ async def send_direct_payment(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
         code=pay_code,
         bonus_quantity=bonus_quantity,
     )
+    # Tự huỷ sau DIRECT_ORDER_PENDING_EXPIRE_MINUTES nếu chưa thanh toán
+    schedule_direct_order_expiry(pay_code)
     bank_name = bank_settings['bank_name'] or SEPAY_BANK_NAME
     account_number = bank_settings['account_number'] or SEPAY_ACCOUNT_NUMBER
     account_name = bank_settings['account_name'] or SEPAY_ACCOUNT_NAME
@@ -175,7 +166,7 @@ async def send_direct_payment(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
             photo=qr_url,
             caption=text,
             parse_mode="HTML",
-            reply_markup=await get_user_keyboard(lang)
+            reply_markup=await context.user_keyboard(lang)
         )
         mark_vietqr_message(chat_id, photo_msg.message_id)
     else:
@@ -189,7 +180,7 @@ async def send_direct_payment(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
         msg = await context.bot.send_message(
             chat_id=chat_id,
             text=text,
-            reply_markup=await get_user_keyboard(lang)
+            reply_markup=await context.user_keyboard(lang)
         )
         mark_bot_message(chat_id, msg.message_id)
 
@@ -207,11 +198,11 @@ WAITING_USDT_WITHDRAW_AMOUNT = 7
 WAITING_USDT_WITHDRAW_WALLET = 8
 
 # Text handlers for reply keyboard
-async def handle_shop_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_shop_text(update: Update, context: BotContext):
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_shop"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_shop"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return
     await delete_last_menu_message(context, update.effective_chat.id)
     products = await get_products()
@@ -223,7 +214,7 @@ async def handle_shop_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     set_last_menu_message(context, menu_msg)
 
-async def handle_buy_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_buy_quantity(update: Update, context: BotContext):
     """Xử lý khi user nhập số lượng muốn mua"""
     product_id = context.user_data.get('buying_product_id')
     max_can_buy = context.user_data.get('buying_max', 0)
@@ -233,7 +224,7 @@ async def handle_buy_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE
         return  # Không trong trạng thái mua hàng
     
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
+    lang = await context.user_lang()
     
     try:
         quantity = int(update.message.text.strip())
@@ -248,7 +239,7 @@ async def handle_buy_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE
     if quantity > max_can_buy:
         await update.message.reply_text(
             get_text(lang, "max_quantity").format(max=max_can_buy),
-            reply_markup=await get_user_keyboard(lang)
+            reply_markup=await context.user_keyboard(lang)
         )
         return
     
@@ -274,34 +265,16 @@ async def handle_buy_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE
     if currency == 'usdt':
         unit_price = float(pricing["unit_price"])
         total_price = float(pricing["total_price"])
-        balance = await get_balance_usdt(user_id)
     else:
         unit_price = int(pricing["unit_price"])
         total_price = int(pricing["total_price"])
-        balance = await get_balance(user_id)
     
     # Determine payment mode for VND orders
-    payment_mode = PAYMENT_MODE
-    if currency != 'usdt':
-        try:
-            from database import get_setting
-            payment_mode = (await get_setting("payment_mode", PAYMENT_MODE)).lower()
-        except Exception:
-            payment_mode = PAYMENT_MODE
-
-    if currency == 'usdt':
-        if balance < total_price:
-            await update.message.reply_text(
-                get_text(lang, "not_enough_balance").format(balance=f"{balance:.2f} USDT", need=f"{total_price:.2f} USDT")
-            )
-            return
-    else:
-        if payment_mode == 'balance' and balance < total_price:
-            await update.message.reply_text(
-                get_text(lang, "not_enough_balance").format(balance=f"{balance:,}đ", need=f"{total_price:,}đ")
-            )
-            return
+    payment_mode = await context.payment_mode() if currency != 'usdt' else PAYMENT_MODE
 
+    # Balance purchases are checked by checkout(); only hybrid needs the balance up front
+    if currency != 'usdt':
+        balance = await context.balance() if payment_mode == 'hybrid' else 0
         should_direct = payment_mode == 'direct' or (payment_mode == 'hybrid' and balance < total_price)
         if should_direct:
             await send_direct_payment(
@@ -322,51 +295,32 @@ async def handle_buy_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE
             context.user_data.pop('buying_currency', None)
             return
     
-    # Lấy stock batch
-    stocks = await get_available_stock_batch(product_id, required_stock)
-    
-    if not stocks or len(stocks) < required_stock:
+    # Lấy stock + trừ tiền + tạo đơn trong 1 transaction / 1 RPC
+    result = await checkout(user_id, product_id, quantity, currency, usdt_rate=USDT_RATE)
+    if not result["ok"]:
+        if result["error"] == "insufficient_balance":
+            if currency == 'usdt':
+                balance_text = f"{result['balance']:.2f} USDT"
+                need_text = f"{result['total_price']:.2f} USDT"
+            else:
+                balance_text = f"{result['balance']:,}đ"
+                need_text = f"{result['total_price']:,}đ"
+            await update.message.reply_text(
+                get_text(lang, "not_enough_balance").format(balance=balance_text, need=need_text)
+            )
+            return
         await update.message.reply_text(get_text(lang, "out_of_stock").format(name=product['name']))
         context.user_data.pop('buying_product_id', None)
         return
-    
-    # Mark sold batch
-    stock_ids = [s[0] for s in stocks]
-    purchased_items = [s[1] for s in stocks]
-    await mark_stock_sold_batch(stock_ids)
-    
-    # Tạo đơn hàng
-    from datetime import datetime
-    order_group = f"ORD{user_id}{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    
-    # Lưu giá theo VNĐ để thống kê
-    if currency == 'usdt':
-        price_for_order = int(float(unit_price) * USDT_RATE)
-        total_for_order = int(total_price * USDT_RATE)
-    else:
-        price_for_order = int(unit_price)
-        total_for_order = int(total_price)
-
-    await create_order_bulk(
-        user_id,
-        product_id,
-        purchased_items,
-        price_for_order,
-        order_group,
-        total_price=total_for_order,
-        quantity=len(purchased_items),
-    )
-    
-    # Trừ tiền
-    actual_total = total_price
+
+    purchased_items = result["items"]
+    bonus_quantity = result["bonus_quantity"]
+    actual_total = result["total_price"]
+    new_balance = result["balance"]
     if currency == 'usdt':
-        await update_balance_usdt(user_id, -actual_total)
-        new_balance = await get_balance_usdt(user_id)
         balance_text = f"{new_balance:.2f} USDT"
         total_text = f"{actual_total:.2f} USDT"
     else:
-        await update_balance(user_id, -int(actual_total))
-        new_balance = await get_balance(user_id)
         balance_text = f"{new_balance:,}đ"
         total_text = f"{int(actual_total):,}đ"
     
@@ -400,23 +354,23 @@ async def handle_buy_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE
             document=file_buf,
             filename=filename,
             caption=success_text,
-            reply_markup=await get_user_keyboard(lang)
+            reply_markup=await context.user_keyboard(lang)
         )
     else:
         items_formatted = "\n\n".join(format_stock_items(purchased_items, format_data, html=True))
         text = f"{success_text}\n\n{description_block}🔐 Account:\n{items_formatted}"
-        await update.message.reply_text(text, parse_mode="HTML", reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(text, parse_mode="HTML", reply_markup=await context.user_keyboard(lang))
     
     # Clear trạng thái mua
     context.user_data.pop('buying_product_id', None)
     context.user_data.pop('buying_max', None)
     context.user_data.pop('buying_currency', None)
 
-async def handle_deposit_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_deposit_text(update: Update, context: BotContext):
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_deposit"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_deposit"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     await delete_last_menu_message(context, update.effective_chat.id)
     context.user_data['waiting_deposit'] = True
@@ -431,18 +385,18 @@ async def handle_deposit_text(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
     return WAITING_DEPOSIT_AMOUNT
 
-async def process_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def process_deposit_amount(update: Update, context: BotContext):
     """Xử lý khi user nhập số tiền nạp"""
     text_input = update.message.text.strip()
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_deposit"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_deposit"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     # Xử lý nút Hủy
     if text_input in ["❌ Hủy", "❌ Cancel"]:
-        await update.message.reply_text(get_text(lang, "deposit_cancelled"), reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(get_text(lang, "deposit_cancelled"), reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     try:
@@ -475,12 +429,12 @@ async def process_deposit_amount(update: Update, context: ContextTypes.DEFAULT_T
                 photo=qr_url,
                 caption=text,
                 parse_mode="HTML",
-                reply_markup=await get_user_keyboard(lang)
+                reply_markup=await context.user_keyboard(lang)
             )
             mark_vietqr_message(update.effective_chat.id, photo_msg.message_id)
         else:
             text = f"📱 MoMo: {MOMO_PHONE}\n👤 {MOMO_NAME}\n💰 {amount:,}đ\n📝 {code}"
-            msg = await update.message.reply_text(text, reply_markup=await get_user_keyboard(lang))
+            msg = await update.message.reply_text(text, reply_markup=await context.user_keyboard(lang))
             mark_bot_message(update.effective_chat.id, msg.message_id)
         
         context.user_data['waiting_deposit'] = False
@@ -490,14 +444,14 @@ async def process_deposit_amount(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text(get_text(lang, "invalid_amount"))
         return WAITING_DEPOSIT_AMOUNT
 
-async def handle_withdraw_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_withdraw_text(update: Update, context: BotContext):
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_withdraw"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_withdraw"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     await delete_last_menu_message(context, update.effective_chat.id)
-    balance = await get_balance(user_id)
+    balance = await context.balance()
     
     from database import get_user_pending_withdrawal
     pending = await get_user_pending_withdrawal(user_id)
@@ -517,17 +471,17 @@ async def handle_withdraw_text(update: Update, context: ContextTypes.DEFAULT_TYP
     await update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
     return WAITING_WITHDRAW_AMOUNT
 
-async def process_withdraw_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def process_withdraw_amount(update: Update, context: BotContext):
     """Xử lý khi user nhập số tiền rút"""
     text_input = update.message.text.strip()
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_withdraw"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_withdraw"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     if text_input in ["❌ Hủy", "❌ Cancel"]:
-        await update.message.reply_text(get_text(lang, "withdraw_cancelled"), reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(get_text(lang, "withdraw_cancelled"), reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     try:
@@ -561,17 +515,17 @@ async def process_withdraw_amount(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text(get_text(lang, "invalid_amount"))
         return WAITING_WITHDRAW_AMOUNT
 
-async def process_withdraw_bank(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def process_withdraw_bank(update: Update, context: BotContext):
     """Xử lý khi user chọn ngân hàng"""
     text_input = update.message.text.strip()
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_withdraw"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_withdraw"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     if text_input in ["❌ Hủy", "❌ Cancel"]:
-        await update.message.reply_text(get_text(lang, "withdraw_cancelled"), reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(get_text(lang, "withdraw_cancelled"), reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     valid_banks = ["MoMo", "MBBank", "Vietcombank", "VietinBank", "BIDV", "Techcombank", "ACB", "TPBank"]
@@ -591,17 +545,17 @@ async def process_withdraw_bank(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text(get_text(lang, "withdraw_enter_account"), reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
     return WAITING_WITHDRAW_ACCOUNT
 
-async def process_withdraw_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def process_withdraw_account(update: Update, context: BotContext):
     """Xử lý khi user nhập số tài khoản"""
     text_input = update.message.text.strip()
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_withdraw"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_withdraw"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     if text_input in ["❌ Hủy", "❌ Cancel"]:
-        await update.message.reply_text(get_text(lang, "withdraw_cancelled"), reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(get_text(lang, "withdraw_cancelled"), reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     account_number = text_input
@@ -617,14 +571,14 @@ async def process_withdraw_account(update: Update, context: ContextTypes.DEFAULT
     text = get_text(lang, "withdraw_submitted").format(
         amount=f"{amount:,}", bank=bank_name, account=account_number, balance=f"{balance:,}"
     )
-    await update.message.reply_text(text, reply_markup=await get_user_keyboard(lang))
+    await update.message.reply_text(text, reply_markup=await context.user_keyboard(lang))
     return ConversationHandler.END
 
-async def show_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_shop(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
 
-    if not await is_feature_enabled("show_shop"):
+    if not await context.feature_enabled("show_shop"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
 
@@ -638,7 +592,7 @@ async def show_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     products = await get_products()
     page_size = await get_shop_page_size()
-    lang = await get_user_language(query.from_user.id)
+    lang = await context.user_lang()
     text = "👉 CHỌN SẢN PHẨM BÊN DƯỚI:"
     await query.edit_message_text(
         text,
@@ -646,16 +600,16 @@ async def show_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     set_last_menu_message(context, query.message)
 
-async def show_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_product(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
 
     product_id = int(query.data.split("_")[1])
     product = await get_product(product_id)
     user_id = query.from_user.id
-    lang = await get_user_language(user_id)
+    lang = await context.user_lang()
 
-    if not await is_feature_enabled("show_shop"):
+    if not await context.feature_enabled("show_shop"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
     
@@ -670,9 +624,9 @@ async def show_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    user_balance = await get_balance(user_id)
-    user_balance_usdt = await get_balance_usdt(user_id)
-    payment_mode = await get_payment_mode()
+    user_balance = await context.balance()
+    user_balance_usdt = await context.balance_usdt()
+    payment_mode = await context.payment_mode()
     
     pricing_rules = format_pricing_rules(product)
     max_by_stock = get_max_quantity_by_stock(product, product["stock"])
@@ -747,20 +701,20 @@ async def show_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
         set_last_menu_message(context, query.message)
 
-async def select_payment_vnd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def select_payment_vnd(update: Update, context: BotContext):
     """User chọn thanh toán bằng VNĐ"""
     query = update.callback_query
     await query.answer()
-    if not await is_feature_enabled("show_shop"):
+    if not await context.feature_enabled("show_shop"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
     
     product_id = int(query.data.split("_")[2])
     product = await get_product(product_id)
     user_id = query.from_user.id
-    lang = await get_user_language(user_id)
-    user_balance = await get_balance(user_id)
-    payment_mode = await get_payment_mode()
+    lang = await context.user_lang()
+    user_balance = await context.balance()
+    payment_mode = await context.payment_mode()
     max_by_stock = get_max_quantity_by_stock(product, product["stock"])
 
     if payment_mode == "balance":
@@ -790,19 +744,19 @@ async def select_payment_vnd(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.edit_message_text(text, reply_markup=delete_keyboard())
     set_last_menu_message(context, query.message)
 
-async def select_payment_usdt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def select_payment_usdt(update: Update, context: BotContext):
     """User chọn thanh toán bằng USDT"""
     query = update.callback_query
     await query.answer()
-    if not await is_feature_enabled("show_shop"):
+    if not await context.feature_enabled("show_shop"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
     
     product_id = int(query.data.split("_")[2])
     product = await get_product(product_id)
     user_id = query.from_user.id
-    lang = await get_user_language(user_id)
-    user_balance_usdt = await get_balance_usdt(user_id)
+    lang = await context.user_lang()
+    user_balance_usdt = await context.balance_usdt()
     
     max_can_buy = (
         get_max_affordable_quantity(product, user_balance_usdt, product["stock"], currency="usdt")
@@ -821,11 +775,11 @@ async def select_payment_usdt(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.edit_message_text(text, reply_markup=delete_keyboard())
     set_last_menu_message(context, query.message)
 
-async def confirm_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def confirm_buy(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
     clear_last_menu_message(context, query.message)
-    if not await is_feature_enabled("show_shop"):
+    if not await context.feature_enabled("show_shop"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
     
@@ -854,20 +808,15 @@ async def confirm_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     total_price = int(pricing["total_price"])
     unit_price = int(pricing["unit_price"])
-    balance = await get_balance(user_id)
-    payment_mode = await get_payment_mode()
-    if payment_mode == "balance" and balance < total_price:
-        await query.edit_message_text(
-            f"❌ Số dư không đủ!\n\n💰 Số dư: {balance:,}đ\n💵 Cần: {total_price:,}đ ({quantity}x {product['price']:,}đ)\n\nVui lòng nạp thêm tiền.",
-            reply_markup=delete_keyboard()
-        )
-        return
+    payment_mode = await context.payment_mode()
+    # "balance" mode is enforced by checkout(); direct/hybrid need the balance to pick VietQR
+    balance = await context.balance() if payment_mode in ("direct", "hybrid") else 0
 
     if payment_mode in ("direct", "hybrid") and balance < total_price:
         await send_direct_payment(
             context=context,
             chat_id=query.message.chat_id,
-            lang=await get_user_language(user_id),
+            lang=await context.user_lang(),
             user_id=user_id,
             product_id=product_id,
             product_name=product['name'],
@@ -882,35 +831,22 @@ async def confirm_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Lấy stock batch (1 query thay vì N queries)
-    stocks = await get_available_stock_batch(product_id, required_stock)
-    
-    if not stocks or len(stocks) < required_stock:
+    # Lấy stock + trừ tiền + tạo đơn trong 1 transaction / 1 RPC
+    result = await checkout(user_id, product_id, quantity, "vnd")
+    if not result["ok"]:
+        if result["error"] == "insufficient_balance":
+            await query.edit_message_text(
+                f"❌ Số dư không đủ!\n\n💰 Số dư: {result['balance']:,}đ\n💵 Cần: {result['total_price']:,}đ ({quantity}x {product['price']:,}đ)\n\nVui lòng nạp thêm tiền.",
+                reply_markup=delete_keyboard()
+            )
+            return
         await query.edit_message_text("❌ Sản phẩm đã hết hàng!", reply_markup=delete_keyboard())
         return
-    
-    # Mark sold batch (1 query thay vì N queries)
-    stock_ids = [s[0] for s in stocks]
-    purchased_items = [s[1] for s in stocks]
-    await mark_stock_sold_batch(stock_ids)
-    
-    # Tạo 1 đơn hàng duy nhất cho tất cả items
-    from datetime import datetime
-    order_group = f"ORD{user_id}{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    await create_order_bulk(
-        user_id,
-        product_id,
-        purchased_items,
-        unit_price,
-        order_group,
-        total_price=total_price,
-        quantity=len(purchased_items),
-    )
-    
-    # Trừ tiền theo số lượng thực tế mua được
-    actual_total = total_price
-    await update_balance(user_id, -actual_total)
-    new_balance = await get_balance(user_id)
+
+    purchased_items = result["items"]
+    bonus_quantity = result["bonus_quantity"]
+    actual_total = result["total_price"]
+    new_balance = result["balance"]
     
     format_data = product.get("format_data") if product else None
     formatted_items_plain = format_stock_items(purchased_items, format_data, html=False)
@@ -956,10 +892,10 @@ async def confirm_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
 {items_formatted}"""
         await query.edit_message_text(text, parse_mode="HTML", reply_markup=delete_keyboard())
 
-async def show_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_account(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
-    if not await is_feature_enabled("show_balance"):
+    if not await context.feature_enabled("show_balance"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
     
@@ -974,10 +910,10 @@ async def show_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """
     await query.edit_message_text(text, reply_markup=delete_keyboard())
 
-async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_history(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
-    if not await is_feature_enabled("show_history"):
+    if not await context.feature_enabled("show_history"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
     
@@ -1013,11 +949,11 @@ async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
     set_last_menu_message(context, query.message)
 
-async def show_order_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_order_detail(update: Update, context: BotContext):
     """Xem chi tiết đơn hàng - gửi file nếu nhiều items"""
     query = update.callback_query
     clear_last_menu_message(context, query.message)
-    if not await is_feature_enabled("show_history"):
+    if not await context.feature_enabled("show_history"):
         await query.answer()
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
@@ -1077,10 +1013,10 @@ async def show_order_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # Deposit handlers
-async def show_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_deposit(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
-    if not await is_feature_enabled("show_deposit"):
+    if not await context.feature_enabled("show_deposit"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
     
@@ -1092,10 +1028,10 @@ Chọn số tiền muốn nạp:
     await query.edit_message_text(text, reply_markup=deposit_amounts_keyboard())
     set_last_menu_message(context, query.message)
 
-async def process_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def process_deposit(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
-    if not await is_feature_enabled("show_deposit"):
+    if not await context.feature_enabled("show_deposit"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=delete_keyboard())
         return
     clear_last_menu_message(context, query.message)
@@ -1151,12 +1087,12 @@ async def process_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ============ BINANCE PAY DEPOSIT ============
 
-async def handle_binance_deposit_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_binance_deposit_text(update: Update, context: BotContext):
     """Handler khi user bấm nút Nạp Binance"""
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_usdt"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_usdt"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     await delete_last_menu_message(context, update.effective_chat.id)
     
@@ -1178,17 +1114,17 @@ async def handle_binance_deposit_text(update: Update, context: ContextTypes.DEFA
     await update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
     return WAITING_BINANCE_AMOUNT
 
-async def process_binance_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def process_binance_amount(update: Update, context: BotContext):
     """Xử lý khi user nhập số USDT"""
     text_input = update.message.text.strip()
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_usdt"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_usdt"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     if text_input in ["❌ Hủy", "❌ Cancel"]:
-        await update.message.reply_text(get_text(lang, "deposit_cancelled"), reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(get_text(lang, "deposit_cancelled"), reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     try:
@@ -1226,16 +1162,16 @@ async def process_binance_amount(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text(get_text(lang, "invalid_amount"))
         return WAITING_BINANCE_AMOUNT
 
-async def process_binance_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def process_binance_screenshot(update: Update, context: BotContext):
     """Xử lý khi user gửi screenshot"""
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_usdt"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_usdt"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     if update.message.text and update.message.text.strip() in ["❌ Hủy", "❌ Cancel"]:
-        await update.message.reply_text(get_text(lang, "deposit_cancelled"), reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(get_text(lang, "deposit_cancelled"), reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     if not update.message.photo:
@@ -1250,32 +1186,33 @@ async def process_binance_screenshot(update: Update, context: ContextTypes.DEFAU
     vnd_amount = context.user_data.get('binance_vnd')
     
     if not code:
-        await update.message.reply_text(get_text(lang, "error"), reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(get_text(lang, "error"), reply_markup=await context.user_keyboard(lang))
         return ConversationHandler.END
     
     from database import update_binance_deposit_screenshot
     await update_binance_deposit_screenshot(user_id, code, file_id)
     
     # Thông báo cho admin (tiếng Việt) - không gửi cho chính user đang nạp
-    for admin_id in ADMIN_IDS:
-        if admin_id == user_id:
-            continue  # Không gửi thông báo cho chính mình
-        try:
-            await context.bot.send_photo(
-                chat_id=admin_id,
-                photo=file_id,
-                caption=f"🔔 YÊU CẦU NẠP USDT MỚI!\n\n"
-                        f"👤 User: {user_id}\n"
-                        f"💵 Số tiền: {usdt_amount} USDT\n"
-                        f"📝 Code: {code}\n\n"
-                        f"Vào Admin → 🔶 Duyệt Binance để xử lý."
-            )
-        except:
-            pass
+    with send_priority(PRIORITY_ADMIN):
+        for admin_id in ADMIN_IDS:
+            if admin_id == user_id:
+                continue  # Không gửi thông báo cho chính mình
+            try:
+                await context.bot.send_photo(
+                    chat_id=admin_id,
+                    photo=file_id,
+                    caption=f"🔔 YÊU CẦU NẠP USDT MỚI!\n\n"
+                            f"👤 User: {user_id}\n"
+                            f"💵 Số tiền: {usdt_amount} USDT\n"
+                            f"📝 Code: {code}\n\n"
+                            f"Vào Admin → 🔶 Duyệt Binance để xử lý."
+                )
+            except:
+                pass
     
     await update.message.reply_text(
         get_text(lang, "binance_submitted").format(amount=usdt_amount, code=code),
-        reply_markup=await get_user_keyboard(lang)
+        reply_markup=await context.user_keyboard(lang)
     )
     
     context.user_data.pop('binance_deposit_code', None)
@@ -1286,12 +1223,12 @@ async def process_binance_screenshot(update: Update, context: ContextTypes.DEFAU
 
 # ============ RÚT USDT ============
 
-async def handle_usdt_withdraw_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_usdt_withdraw_text(update: Update, context: BotContext):
     """Handler cho nút Rút USDT - hiện thông báo liên hệ admin"""
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
+    lang = await context.user_lang()
     
-    balance_usdt = await get_balance_usdt(user_id)
+    balance_usdt = await context.balance_usdt()
     
     from database import get_setting
     admin_contact = await get_setting("admin_contact", "")
@@ -1310,4 +1247,4 @@ async def handle_usdt_withdraw_text(update: Update, context: ContextTypes.DEFAUL
                 f"⚠️ Tối thiểu: 10 USDT\n"
                 f"🌐 Network: TRC20 / BEP20")
     
-    await update.message.reply_text(text, reply_markup=await get_user_keyboard(lang))
+    await update.message.reply_text(text, reply_markup=await context.user_keyboard(lang))
@@ -1,17 +1,15 @@
 import re
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes
 from database import (
     get_or_create_user,
-    get_balance,
     get_products,
     get_setting,
     get_user_orders,
-    get_user_language,
     set_user_language,
 )
 from keyboards import products_keyboard
-from helpers.ui import get_shop_page_size, get_user_keyboard, is_feature_enabled
+from helpers.request_context import BotContext
+from helpers.ui import get_shop_page_size
 from helpers.menu import delete_last_menu_message, set_last_menu_message, clear_last_menu_message
 from locales import get_text
 
@@ -134,7 +132,7 @@ def _parse_support_contacts(raw_value: str, admin_contact: str) -> list[tuple[st
 
     return contacts
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def start_command(update: Update, context: BotContext):
     user = update.effective_user
     db_user = await get_or_create_user(user.id, user.username)
     lang = db_user.get('language', 'vi')
@@ -155,8 +153,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     welcome_text = get_text(lang, "welcome").format(name=user.first_name)
     select_text = get_text(lang, "select_product")
     
-    await update.message.reply_text(welcome_text, reply_markup=await get_user_keyboard(lang))
-    if not await is_feature_enabled("show_shop"):
+    await update.message.reply_text(welcome_text, reply_markup=await context.user_keyboard(lang))
+    if not await context.feature_enabled("show_shop"):
         await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.")
         return
 
@@ -168,9 +166,9 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     set_last_menu_message(context, menu_msg)
 
-async def handle_change_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_change_language(update: Update, context: BotContext):
     """Hiện menu đổi ngôn ngữ"""
-    if not await is_feature_enabled("show_language"):
+    if not await context.feature_enabled("show_language"):
         await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.")
         return
     await delete_last_menu_message(context, update.effective_chat.id)
@@ -184,7 +182,7 @@ async def handle_change_language(update: Update, context: ContextTypes.DEFAULT_T
     )
     set_last_menu_message(context, menu_msg)
 
-async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def set_language(update: Update, context: BotContext):
     """Xử lý khi user chọn ngôn ngữ"""
     query = update.callback_query
     await query.answer()
@@ -205,9 +203,9 @@ async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=query.message.chat_id,
         text=select_text,
-        reply_markup=await get_user_keyboard(lang)
+        reply_markup=await context.user_keyboard(lang)
     )
-    if not await is_feature_enabled("show_shop"):
+    if not await context.feature_enabled("show_shop"):
         await context.bot.send_message(
             chat_id=query.message.chat_id,
             text="⚠️ Tính năng này đang tạm tắt."
@@ -222,12 +220,12 @@ async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     set_last_menu_message(context, menu_msg)
 
-async def handle_history_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_history_text(update: Update, context: BotContext):
     """Xử lý khi user bấm nút Lịch sử từ reply keyboard"""
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_history"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_history"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return
     await delete_last_menu_message(context, update.effective_chat.id)
     orders = await get_user_orders(user_id)
@@ -260,21 +258,20 @@ async def handle_history_text(update: Update, context: ContextTypes.DEFAULT_TYPE
     menu_msg = await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
     set_last_menu_message(context, menu_msg)
 
-async def handle_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_user_id(update: Update, context: BotContext):
     """Xử lý khi user bấm nút User ID từ reply keyboard"""
     user_id = update.effective_user.id
     await update.message.reply_text(f"🆔 User ID: `{user_id}`", parse_mode="Markdown")
 
-async def handle_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_balance(update: Update, context: BotContext):
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_balance"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_balance"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return
     await delete_last_menu_message(context, update.effective_chat.id)
-    balance = await get_balance(user_id)
-    from database import get_balance_usdt
-    balance_usdt = await get_balance_usdt(user_id)
+    balance = await context.balance()
+    balance_usdt = await context.balance_usdt()
     admin_contact = await get_setting("admin_contact", "")
     
     text = get_text(lang, "balance_vnd").format(amount=f"{balance:,}")
@@ -290,11 +287,11 @@ async def handle_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 
 
-async def handle_support_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_support_text(update: Update, context: BotContext):
     user_id = update.effective_user.id
-    lang = await get_user_language(user_id)
-    if not await is_feature_enabled("show_support"):
-        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await get_user_keyboard(lang))
+    lang = await context.user_lang()
+    if not await context.feature_enabled("show_support"):
+        await update.message.reply_text("⚠️ Tính năng này đang tạm tắt.", reply_markup=await context.user_keyboard(lang))
         return
     pressed_text = (update.message.text or "").strip()
     pressed_legacy_icon = pressed_text.startswith("🆘")
@@ -307,7 +304,7 @@ async def handle_support_text(update: Update, context: ContextTypes.DEFAULT_TYPE
             if lang != "en"
             else "❌ Support contact is not configured. Please ask admin to set Support contacts in Dashboard settings."
         )
-        await update.message.reply_text(text, reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(text, reply_markup=await context.user_keyboard(lang))
         return
 
     text = (
@@ -326,16 +323,16 @@ async def handle_support_text(update: Update, context: ContextTypes.DEFAULT_TYPE
     # If user pressed the legacy icon, push the refreshed keyboard once.
     if pressed_legacy_icon:
         refresh_text = "✅ Đã cập nhật icon Hỗ trợ mới." if lang != "en" else "✅ Support icon updated."
-        await update.message.reply_text(refresh_text, reply_markup=await get_user_keyboard(lang))
+        await update.message.reply_text(refresh_text, reply_markup=await context.user_keyboard(lang))
 
-async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def back_to_main(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
     
     user_id = query.from_user.id
-    lang = await get_user_language(user_id)
+    lang = await context.user_lang()
     
-    if not await is_feature_enabled("show_shop"):
+    if not await context.feature_enabled("show_shop"):
         await query.edit_message_text("⚠️ Tính năng này đang tạm tắt.")
         return
     products = await get_products()
@@ -346,7 +343,7 @@ async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     set_last_menu_message(context, query.message)
 
-async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def delete_message(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
     try:
@@ -0,0 +1,247 @@
+"""
+Background /notification broadcasts.
+
+A job walks the users table in keyset pages (user_id > last_user_id), sends each
+page with a few concurrent workers paced by one bot-wide limiter, and
+checkpoints last_user_id + counters in broadcast_jobs after every page. Jobs
+left 'running' by a restart are resumed from that checkpoint (at most one page
+is re-sent). Users answering 403 are marked is_blocked and skipped next time.
+
+Each recipient gets one message per job, so Telegram's per-chat limit (~1 msg/s)
+only matters for the admin's progress message, which is edited at most every
+BROADCAST_PROGRESS_SECONDS. Sends are queued at PRIORITY_BROADCAST in the outbound
+dispatcher, so payment deliveries and replies go first; the limiter below only
+caps the broadcast's share of the bot's rate.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from database import (
+    count_broadcast_recipients, create_broadcast_job, finish_broadcast_job, get_broadcast_job,
+    get_running_broadcast_jobs, iter_user_ids, mark_users_blocked,
+    save_broadcast_progress, set_broadcast_progress_message,
+)
+from helpers.outbound import PRIORITY_BROADCAST, set_send_priority
+
+logger = logging.getLogger(__name__)
+
+
+def _env_number(name: str, default, cast=int):
+    try:
+        return cast(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+# Telegram allows ~30 messages/s per bot; stay below it so interactive replies still get through.
+BROADCAST_MESSAGES_PER_SECOND = max(1.0, _env_number("BROADCAST_MESSAGES_PER_SECOND", 25.0, float))
+BROADCAST_CONCURRENCY = max(1, _env_number("BROADCAST_CONCURRENCY", 8))
+BROADCAST_PAGE_SIZE = max(1, _env_number("BROADCAST_PAGE_SIZE", 200))
+BROADCAST_PROGRESS_SECONDS = max(3.0, _env_number("BROADCAST_PROGRESS_SECONDS", 5.0, float))
+BROADCAST_MAX_RETRIES = max(0, _env_number("BROADCAST_MAX_RETRIES", 3))
+
+
+class _RateLimiter:
+    """Hands out evenly spaced send slots; RetryAfter pushes every slot back (flood limits are per bot)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            delay = self._next - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next = max(self._next, time.monotonic()) + self.interval
+
+    def pause(self, seconds: float):
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+_limiter: Optional[_RateLimiter] = None
+_jobs: Dict[int, asyncio.Task] = {}
+
+
+def _get_limiter() -> _RateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = _RateLimiter(BROADCAST_MESSAGES_PER_SECOND)
+    return _limiter
+
+
+def _seconds(value: Any) -> float:
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 1.0
+
+
+async def _send_one(bot, user_id: int, text: str) -> str:
+    """'sent', 'blocked' (403 / chat gone) or 'failed'."""
+    limiter = _get_limiter()
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await limiter.wait()
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            return "sent"
+        except RetryAfter as e:
+            wait = _seconds(e.retry_after)
+            logger.warning("Broadcast flood control: pausing %.1fs", wait)
+            limiter.pause(wait)
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            return "blocked" if "chat not found" in str(e).lower() else "failed"
+        except NetworkError:
+            if attempt < BROADCAST_MAX_RETRIES:
+                await asyncio.sleep(1 + attempt)
+        except Exception:
+            logger.exception("Broadcast send to %s failed", user_id)
+            return "failed"
+    return "failed"
+
+
+async def _send_page(bot, text: str, user_ids: List[int]) -> Dict[str, List[int]]:
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def _worker(uid: int) -> str:
+        async with semaphore:
+            return await _send_one(bot, uid, text)
+
+    outcomes = await asyncio.gather(*[_worker(uid) for uid in user_ids])
+    result: Dict[str, List[int]] = {"sent": [], "blocked": [], "failed": []}
+    for uid, outcome in zip(user_ids, outcomes):
+        result[outcome].append(uid)
+    return result
+
+
+def _progress_text(job: Dict[str, Any], counts: Dict[str, int], status: str) -> str:
+    done = counts["sent"] + counts["failed"] + counts["blocked"]
+    if status == "running":
+        header = f"⏳ Đang gửi thông báo #{job['id']}: {done}/{job['total']}"
+    elif status == "done":
+        header = f"✅ Đã gửi thông báo #{job['id']}!"
+    else:
+        header = f"⚠️ Thông báo #{job['id']} bị dừng do lỗi ({done}/{job['total']})"
+    return (
+        f"{header}\n\n"
+        f"📤 Thành công: {counts['sent']}\n"
+        f"❌ Thất bại: {counts['failed']}\n"
+        f"🚫 Đã chặn bot: {counts['blocked']}"
+    )
+
+
+async def _report(bot, job: Dict[str, Any], counts: Dict[str, int], status: str):
+    chat_id = job.get("admin_chat_id")
+    if not chat_id:
+        return
+    text = _progress_text(job, counts, status)
+    try:
+        if job.get("progress_message_id"):
+            await bot.edit_message_text(chat_id=chat_id, message_id=job["progress_message_id"], text=text)
+            return
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return
+    except Exception:
+        logger.exception("Broadcast #%s: cannot edit progress message", job["id"])
+        return
+    try:
+        message = await bot.send_message(chat_id=chat_id, text=text)
+        job["progress_message_id"] = message.message_id
+        await set_broadcast_progress_message(job["id"], message.message_id)
+    except Exception:
+        logger.exception("Broadcast #%s: cannot send progress message", job["id"])
+
+
+async def _run_job(bot, job: Dict[str, Any], resumed: bool = False):
+    set_send_priority(PRIORITY_BROADCAST)
+    job_id = job["id"]
+    counts = {"sent": job.get("sent") or 0, "failed": job.get("failed") or 0, "blocked": job.get("blocked") or 0}
+    cursor = job.get("last_user_id") or 0
+    if resumed:
+        # Old progress message is probably far up the admin chat; post a fresh one.
+        job["progress_message_id"] = None
+    await _report(bot, job, counts, "running")
+    reported_at = time.monotonic()
+
+    async def _flush(user_ids: List[int]):
+        nonlocal reported_at
+        result = await _send_page(bot, job["text"], user_ids)
+        if result["blocked"]:
+            await mark_users_blocked(result["blocked"])
+        for key in counts:
+            counts[key] += len(result[key])
+        await save_broadcast_progress(job_id, user_ids[-1], counts["sent"], counts["failed"], counts["blocked"])
+        if time.monotonic() - reported_at >= BROADCAST_PROGRESS_SECONDS:
+            await _report(bot, job, counts, "running")
+            reported_at = time.monotonic()
+
+    try:
+        page: List[int] = []
+        async for user_id in iter_user_ids(cursor, BROADCAST_PAGE_SIZE, skip_blocked=True):
+            page.append(user_id)
+            if len(page) >= BROADCAST_PAGE_SIZE:
+                await _flush(page)
+                page = []
+        if page:
+            await _flush(page)
+    except asyncio.CancelledError:
+        # Shutdown: job stays 'running' and resumes from the last checkpoint.
+        raise
+    except Exception:
+        logger.exception("Broadcast #%s failed", job_id)
+        await finish_broadcast_job(job_id, "failed")
+        await _report(bot, job, counts, "failed")
+        return
+
+    await finish_broadcast_job(job_id, "done")
+    await _report(bot, job, counts, "done")
+    logger.info("Broadcast #%s done: %s", job_id, counts)
+
+
+def _spawn(bot, job: Dict[str, Any], resumed: bool = False):
+    job_id = job["id"]
+    task = asyncio.get_running_loop().create_task(_run_job(bot, job, resumed), name=f"broadcast-{job_id}")
+    _jobs[job_id] = task
+    task.add_done_callback(lambda _t: _jobs.pop(job_id, None))
+
+
+async def start_broadcast(bot, admin_chat_id: int, text: str) -> Optional[Dict[str, Any]]:
+    """Create a job and send it in the background; None if there is nobody to send to."""
+    total = await count_broadcast_recipients()
+    if not total:
+        return None
+    job_id = await create_broadcast_job(text, admin_chat_id, total)
+    job = await get_broadcast_job(job_id)
+    _spawn(bot, job)
+    return job
+
+
+async def resume_broadcasts(bot) -> int:
+    """Restart jobs interrupted by a restart (call once the bot is running)."""
+    resumed = 0
+    for job in await get_running_broadcast_jobs():
+        if job["id"] not in _jobs:
+            _spawn(bot, job, resumed=True)
+            resumed += 1
+    return resumed
+
+
+async def stop_broadcasts():
+    """Cancel running jobs on shutdown; their checkpoints stay in broadcast_jobs."""
+    tasks = list(_jobs.values())
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
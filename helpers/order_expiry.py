@@ -0,0 +1,158 @@
+"""
+Timer-driven expiry for pending direct orders.
+
+Each pending order (keyed by its payment code) sits in a min-heap by deadline
+= created_at + DIRECT_ORDER_PENDING_EXPIRE_MINUTES. One background task sleeps
+until the earliest deadline and hands every code due by then to the expire
+callback in one batch (sepay_checker cancels them with a single UPDATE). The
+heap is filled once at startup and then updated as orders are created
+(send_direct_payment) or settled, so the SePay poll loop no longer loads and
+parses every pending order each tick. Orders created outside the bot (website,
+Supabase) are picked up by sepay_checker's DIRECT_ORDER_EXPIRY_REFRESH_SECONDS
+sweep. A batch whose callback raises is re-queued after a short backoff.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _env_positive_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(str(os.getenv(name, default)).strip()))
+    except (TypeError, ValueError):
+        return default
+
+
+DIRECT_ORDER_PENDING_EXPIRE_MINUTES = _env_positive_int("DIRECT_ORDER_PENDING_EXPIRE_MINUTES", 10)
+DIRECT_ORDER_PENDING_EXPIRE_SECONDS = DIRECT_ORDER_PENDING_EXPIRE_MINUTES * 60
+# A batch whose expire callback raised (DB down...) is retried this much later.
+DIRECT_ORDER_EXPIRY_RETRY_SECONDS = _env_positive_int("DIRECT_ORDER_EXPIRY_RETRY_SECONDS", 30)
+
+
+class ExpiryScheduler:
+    def __init__(self):
+        self._heap: List[Tuple[float, str]] = []
+        # code -> deadline; heap entries whose deadline no longer matches are stale and skipped
+        self._deadlines: Dict[str, float] = {}
+        # codes of the batch the expire callback is running on; discard() removes settled ones
+        self._expiring: Set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, code: str) -> bool:
+        return code in self._deadlines
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def schedule(self, code: str, deadline: float):
+        """deadline: unix timestamp. Re-scheduling a code replaces its deadline."""
+        if not code:
+            return
+        self._deadlines[code] = deadline
+        heapq.heappush(self._heap, (deadline, code))
+        if self._wakeup is not None and self._heap[0] == (deadline, code):
+            self._wakeup.set()
+
+    def discard(self, code: str):
+        self._deadlines.pop(code, None)
+        self._expiring.discard(code)
+
+    def _pop_due(self, now: float) -> List[str]:
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, code = heapq.heappop(heap)
+            if self._deadlines.get(code) == deadline:
+                del self._deadlines[code]
+                due.append(code)
+        # Drop stale entries at the top so the next sleep targets a live deadline.
+        while heap and self._deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return due
+
+    def start(self, on_expire: Callable[[List[str]], Awaitable[None]]):
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(on_expire), name="direct-order-expiry")
+
+    async def _run(self, on_expire: Callable[[List[str]], Awaitable[None]]):
+        while True:
+            due = self._pop_due(time.time())
+            if due:
+                self._expiring = set(due)
+                try:
+                    await on_expire(due)
+                except Exception:
+                    logger.exception(
+                        "Direct order expiry failed for %s order(s); retrying in %ss",
+                        len(due), DIRECT_ORDER_EXPIRY_RETRY_SECONDS,
+                    )
+                    retry_at = time.time() + DIRECT_ORDER_EXPIRY_RETRY_SECONDS
+                    for code in due:
+                        # skip codes settled (discarded) or re-scheduled while the callback ran
+                        if code in self._expiring and code not in self._deadlines:
+                            self.schedule(code, retry_at)
+                finally:
+                    self._expiring = set()
+                continue
+            self._wakeup.clear()
+            timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        task = self._task
+        if task is None:
+            return
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self._task = None
+
+
+_scheduler = ExpiryScheduler()
+
+
+def schedule_direct_order_expiry(code: str, created_at: Optional[float] = None):
+    """Call when a direct order is created (created_at: unix timestamp, default now)."""
+    created = time.time() if created_at is None else created_at
+    _scheduler.schedule(str(code or "").strip(), created + DIRECT_ORDER_PENDING_EXPIRE_SECONDS)
+
+
+def discard_direct_order_expiry(code: str):
+    """The order was paid / failed: its timer is no longer needed."""
+    _scheduler.discard(str(code or "").strip())
+
+
+def is_direct_order_expiry_scheduled(code: str) -> bool:
+    return str(code or "").strip() in _scheduler
+
+
+def schedule_direct_orders(rows: Iterable[Tuple[str, float]]) -> int:
+    """(code, created_at) pairs, e.g. every pending order at startup; returns how many were added."""
+    added = 0
+    for code, created_at in rows:
+        if not is_direct_order_expiry_scheduled(code):
+            schedule_direct_order_expiry(code, created_at)
+            added += 1
+    return added
+
+
+def start_direct_order_expiry(on_expire: Callable[[List[str]], Awaitable[None]]):
+    _scheduler.start(on_expire)
+
+
+async def stop_direct_order_expiry():
+    await _scheduler.stop()
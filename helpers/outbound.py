@@ -0,0 +1,297 @@
+"""
+Outbound Bot API dispatcher.
+
+install_outbound_dispatcher(bot) (called from post_init) routes bot.send_message /
+send_document / send_photo / edit_message_text through one priority queue, so
+every existing `bot.send_*` / `reply_text` call is paced by a shared token bucket
+and a paid delivery never waits behind broadcast traffic:
+
+    PRIORITY_PAYMENT > PRIORITY_INTERACTIVE (default) > PRIORITY_ADMIN > PRIORITY_BROADCAST
+
+The class is taken from a context variable: long-running tasks call
+set_send_priority() once (sepay checker, broadcast jobs); single blocks use
+`with send_priority(...)`. RetryAfter pauses the whole bucket (flood limits are
+per bot) and the call is retried in its original queue position.
+"""
+import asyncio
+import functools
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+def _env_number(name: str, default, cast=int):
+    try:
+        return cast(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+PRIORITY_PAYMENT = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_ADMIN = 2
+PRIORITY_BROADCAST = 3
+PRIORITY_NAMES = {
+    PRIORITY_PAYMENT: "payment",
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_ADMIN: "admin",
+    PRIORITY_BROADCAST: "broadcast",
+}
+
+# Telegram: ~30 messages/s per bot overall; short bursts are tolerated.
+OUTBOUND_MESSAGES_PER_SECOND = max(1.0, _env_number("OUTBOUND_MESSAGES_PER_SECOND", 28.0, float))
+OUTBOUND_BURST = max(1, _env_number("OUTBOUND_BURST", 10))
+OUTBOUND_CONCURRENCY = max(1, _env_number("OUTBOUND_CONCURRENCY", 16))
+OUTBOUND_MAX_RETRIES = max(0, _env_number("OUTBOUND_MAX_RETRIES", 3))
+OUTBOUND_METHODS = ("send_message", "send_document", "send_photo", "edit_message_text")
+
+_send_priority: ContextVar[int] = ContextVar("outbound_send_priority", default=PRIORITY_INTERACTIVE)
+
+
+def set_send_priority(priority: int):
+    """Priority for every send made from the current task (and tasks it creates)."""
+    return _send_priority.set(priority)
+
+
+@contextmanager
+def send_priority(priority: int):
+    token = _send_priority.set(priority)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+
+def _seconds(value: Any) -> float:
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def _file_positions(args, kwargs) -> List[Tuple[Any, int]]:
+    """Seekable streams among the call arguments (document=BytesIO(...)) and where they start."""
+    positions = []
+    for value in itertools.chain(args, kwargs.values()):
+        try:
+            if value.seekable():
+                positions.append((value, value.tell()))
+        except (AttributeError, OSError, ValueError):
+            continue
+    return positions
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+
+class _Call:
+    __slots__ = ("priority", "seq", "call", "future", "enqueued_at", "attempts")
+
+    def __init__(self, priority: int, seq: int, call: Callable[[], Awaitable[Any]], future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.call = call
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+    def __lt__(self, other: "_Call") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundDispatcher:
+    def __init__(
+        self,
+        rate: float = OUTBOUND_MESSAGES_PER_SECOND,
+        burst: int = OUTBOUND_BURST,
+        concurrency: int = OUTBOUND_CONCURRENCY,
+        max_retries: int = OUTBOUND_MAX_RETRIES,
+    ):
+        self._bucket = _TokenBucket(rate, burst)
+        self.concurrency = max(1, int(concurrency))
+        self.max_retries = max(0, int(max_retries))
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self._seq = itertools.count()
+        self.stats: Dict[str, Dict[str, float]] = {
+            name: {"sent": 0, "failed": 0, "retried": 0, "latency_total": 0.0, "latency_max": 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="outbound-dispatcher")
+
+    async def submit(self, call: Callable[[], Awaitable[Any]], priority: Optional[int] = None):
+        if not self.running:
+            return await call()
+        if priority is None:
+            priority = _send_priority.get()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Call(priority, next(self._seq), call, future))
+        return await future
+
+    async def _run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        queue = self._queue
+        while True:
+            item = await queue.get()
+            if item.future.done():
+                continue  # caller gave up while queued
+            try:
+                await slots.acquire()
+                await self._bucket.acquire()
+            except asyncio.CancelledError:
+                # stop() while waiting (e.g. a long RetryAfter pause): put the call back so stop() sends it.
+                queue.put_nowait(item)
+                raise
+            # Something more urgent may have arrived while we waited for a token.
+            queue.put_nowait(item)
+            item = queue.get_nowait()
+            if item.future.done():
+                slots.release()
+                continue
+            task = asyncio.get_running_loop().create_task(self._execute(item, slots))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _execute(self, item: _Call, slots: asyncio.Semaphore):
+        stats = self.stats[PRIORITY_NAMES.get(item.priority, "interactive")]
+        try:
+            result = await item.call()
+        except RetryAfter as e:
+            wait = _seconds(e.retry_after)
+            self._bucket.pause(wait)
+            item.attempts += 1
+            if item.attempts <= self.max_retries and not item.future.done():
+                stats["retried"] += 1
+                logger.warning("Flood control: pausing outbound sends %.1fs", wait)
+                self._queue.put_nowait(item)  # same (priority, seq): keeps its place in line
+            elif not item.future.done():
+                stats["failed"] += 1
+                item.future.set_exception(e)
+        except Exception as e:
+            stats["failed"] += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            latency = time.monotonic() - item.enqueued_at
+            stats["sent"] += 1
+            stats["latency_total"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            slots.release()
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per priority class: sent/failed/retried and end-to-end latency (queue + rate limit + API call)."""
+        report = {}
+        for name, s in self.stats.items():
+            sent = int(s["sent"])
+            report[name] = {
+                "sent": sent,
+                "failed": int(s["failed"]),
+                "retried": int(s["retried"]),
+                "avg_latency_ms": round(s["latency_total"] / sent * 1000, 1) if sent else 0.0,
+                "max_latency_ms": round(s["latency_max"] * 1000, 1),
+            }
+        report["queued"] = self._queue.qsize() if self._queue is not None else 0
+        return report
+
+    async def stop(self):
+        """Stop dispatching; queued calls are sent directly so nothing is lost on shutdown."""
+        task = self._task
+        if task is None:
+            return
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self._task = None
+        # In-flight calls first: a RetryAfter among them re-queues its item, which the drain below picks up.
+        if self._inflight:
+            await asyncio.gather(*list(self._inflight), return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item.future.done():
+                continue
+            try:
+                item.future.set_result(await item.call())
+            except Exception as e:
+                item.future.set_exception(e)
+
+
+_dispatcher = OutboundDispatcher()
+
+
+def install_outbound_dispatcher(bot, methods=OUTBOUND_METHODS) -> OutboundDispatcher:
+    """Route the bot's send methods through the dispatcher (call once, in post_init, before other wrappers)."""
+    # PTB bots are frozen after construction; instance attributes can only be swapped while unfrozen.
+    with bot._unfrozen():
+        for name in methods:
+            original = getattr(bot, name)
+
+            @functools.wraps(original)
+            async def dispatched(*args, __original=original, **kwargs):
+                # A RetryAfter retry re-sends the same arguments: rewind any stream the
+                # failed attempt already read, or the upload would be empty.
+                files = _file_positions(args, kwargs)
+
+                def call():
+                    for stream, position in files:
+                        stream.seek(position)
+                    return __original(*args, **kwargs)
+
+                return await _dispatcher.submit(call)
+
+            setattr(bot, name, dispatched)
+    _dispatcher.start()
+    return _dispatcher
+
+
+def get_outbound_stats() -> Dict[str, Dict[str, Any]]:
+    return _dispatcher.get_stats()
+
+
+async def stop_outbound_dispatcher():
+    await _dispatcher.stop()
@@ -0,0 +1,69 @@
+"""
+Payment-code index for SePay transaction matching.
+
+A pending deposit / direct order matches a transfer when its code (upper-case,
+whitespace removed) is a substring of the transfer content normalised the same
+way. Instead of testing every pending code against every transaction, the codes
+of one poll cycle go into a dict; each content is then scanned once, trying a
+lookup only at positions whose first characters start some code, for each code
+length present. Cost per transaction depends on the content length, not on the
+number of pending codes.
+
+When several codes occur in one content, candidates come back in the order of
+the rows passed in, so the result is the same as the old nested loop.
+"""
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+_HEAD = 3
+
+
+def normalize_code(value: Any) -> str:
+    return "".join(str(value).upper().split())
+
+
+class PaymentCodeIndex:
+    def __init__(self, rows: Iterable[Any], code_of: Callable[[Any], Any]):
+        self._by_code: Dict[str, Tuple[int, Any]] = {}
+        for pos, row in enumerate(rows):
+            code = normalize_code(code_of(row) or "")
+            if code and code not in self._by_code:
+                self._by_code[code] = (pos, row)
+        lengths = {len(code) for code in self._by_code}
+        self._lengths = sorted(lengths)
+        self._head = min(_HEAD, self._lengths[0]) if self._lengths else _HEAD
+        self._heads = {code[:self._head] for code in self._by_code}
+
+    def __len__(self) -> int:
+        return len(self._by_code)
+
+    def candidates(self, content_norm: str) -> List[Any]:
+        """Rows whose code occurs in `content_norm` (already normalised), in row order."""
+        by_code = self._by_code
+        if not by_code:
+            return []
+        heads = self._heads
+        head = self._head
+        lengths = self._lengths
+        end = len(content_norm)
+        hits = {}
+        for start in range(end - lengths[0] + 1):
+            if content_norm[start:start + head] not in heads:
+                continue
+            for length in lengths:
+                stop = start + length
+                if stop > end:
+                    break
+                hit = by_code.get(content_norm[start:stop])
+                if hit is not None:
+                    hits[hit[0]] = hit[1]
+        return [hits[pos] for pos in sorted(hits)]
+
+    def first(self, content_norm: str, accept: Optional[Callable[[Any], bool]] = None):
+        for row in self.candidates(content_norm):
+            if accept is None or accept(row):
+                return row
+        return None
+
+    def discard(self, code: Any):
+        """Drop a code once its row is settled, so a second transfer in the same cycle cannot reuse it."""
+        self._by_code.pop(normalize_code(code or ""), None)
@@ -0,0 +1,76 @@
+from typing import Any, Dict, Optional
+
+from telegram.ext import CallbackContext, ContextTypes
+
+from database import get_user_language, get_user_profile
+from helpers.ui import get_payment_mode, get_ui_flags
+from keyboards import user_reply_keyboard
+
+
+class BotContext(CallbackContext):
+    """
+    CallbackContext with per-update memoized lookups.
+
+    PTB builds one context per update and hands it to every handler group, so
+    values loaded here are shared by chat_logger and the real handler:
+    - balance()/balance_usdt(): one get_user_profile() query (language + both balances), on first use
+    - user_lang(): from that profile, or the cached get_user_language() if balances are not needed
+    - ui_flags()/feature_enabled()/user_keyboard()/payment_mode(): settings snapshot, once
+    Call refresh_profile() after changing the user's language or balance in the same update.
+    """
+
+    def __init__(self, application, chat_id: Optional[int] = None, user_id: Optional[int] = None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self._profile: Optional[Dict[str, Any]] = None
+        self._profile_loaded = False
+        self._lang: Optional[str] = None
+        self._ui_flags: Optional[Dict[str, bool]] = None
+        self._payment_mode: Optional[str] = None
+
+    async def profile(self) -> Dict[str, Any]:
+        if not self._profile_loaded:
+            profile = await get_user_profile(self._user_id) if self._user_id is not None else None
+            self._profile = profile or {"language": "vi", "balance": 0, "balance_usdt": 0}
+            self._profile_loaded = True
+        return self._profile
+
+    def refresh_profile(self):
+        self._profile = None
+        self._profile_loaded = False
+        self._lang = None
+
+    async def user_lang(self) -> str:
+        # Language alone is served from the backend's language cache; no need to pull balances.
+        if self._lang is None:
+            if self._profile_loaded:
+                self._lang = self._profile.get("language") or "vi"
+            elif self._user_id is not None:
+                self._lang = await get_user_language(self._user_id)
+            else:
+                self._lang = "vi"
+        return self._lang
+
+    async def balance(self) -> int:
+        return (await self.profile()).get("balance") or 0
+
+    async def balance_usdt(self) -> float:
+        return (await self.profile()).get("balance_usdt") or 0
+
+    async def ui_flags(self) -> Dict[str, bool]:
+        if self._ui_flags is None:
+            self._ui_flags = await get_ui_flags()
+        return self._ui_flags
+
+    async def feature_enabled(self, key: str) -> bool:
+        return bool((await self.ui_flags()).get(key, True))
+
+    async def user_keyboard(self, lang: Optional[str] = None):
+        return user_reply_keyboard(lang or await self.user_lang(), await self.ui_flags())
+
+    async def payment_mode(self) -> str:
+        if self._payment_mode is None:
+            self._payment_mode = await get_payment_mode()
+        return self._payment_mode
+
+
+CONTEXT_TYPES = ContextTypes(context=BotContext)
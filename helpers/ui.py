@@ -1,3 +1,4 @@
+from config import PAYMENT_MODE
 from keyboards import user_reply_keyboard
 from database import get_setting, get_ui_flags as _get_ui_flags
 
@@ -33,3 +34,15 @@ async def get_shop_page_size(default: int = 10) -> int:
 async def is_feature_enabled(key: str) -> bool:
     flags = await get_ui_flags()
     return bool(flags.get(key, True))
+
+
+async def get_payment_mode() -> str:
+    mode = PAYMENT_MODE or "hybrid"
+    try:
+        mode = await get_setting("payment_mode", PAYMENT_MODE)
+    except Exception:
+        pass
+    mode = (mode or "hybrid").lower()
+    if mode not in ("direct", "hybrid", "balance"):
+        mode = "hybrid"
+    return mode
@@ -0,0 +1,66 @@
+import asyncio
+from typing import Any, Awaitable, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# BaseUpdateProcessor.process_update is @final and takes its semaphore before
+# do_process_update; give it a bound that never blocks and limit concurrency here.
+_BASE_LIMIT = 2 ** 31 - 1
+
+
+def _chat_key(update: object) -> Optional[int]:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates concurrently (up to `max_concurrent_updates`), but one at a
+    time per chat, in arrival order: a slow DB call only delays that user, and
+    ConversationHandler / user_data never see two updates of one chat at once.
+
+    The per-chat lock is taken before a concurrency slot, so a user spamming
+    buttons queues behind themself without holding slots other chats need.
+    """
+
+    __slots__ = ("_chats", "_slots")
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(_BASE_LIMIT)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # chat key -> [lock, number of updates holding or waiting for it]
+        self._chats: Dict[int, List[Any]] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = _chat_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters FIFO; PTB starts the tasks in update order.
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._chats.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,84 @@
+"""
+Embedded aiohttp server for inbound webhooks.
+
+- Telegram (BOT_TRANSPORT=webhook): Telegram POSTs updates to WEBHOOK_URL +
+  WEBHOOK_PATH; each update is checked against WEBHOOK_SECRET_TOKEN and put on
+  the application's update_queue, where PerChatUpdateProcessor handles it. The
+  request is answered immediately so Telegram never waits on handler work.
+- SePay (SEPAY_WEBHOOK_ENABLED): route mounted by sepay_checker.add_sepay_webhook_route().
+
+A reverse proxy (nginx, Caddy, Cloudflare tunnel) terminates TLS and forwards
+to WEBHOOK_LISTEN:WEBHOOK_PORT. Routes must be added before start().
+"""
+import hmac
+import logging
+from typing import Optional
+
+from aiohttp import web
+from telegram import Update
+
+from config import (
+    DROP_PENDING_UPDATES, WEBHOOK_LISTEN, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET_TOKEN, WEBHOOK_URL,
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(self, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT):
+        self.listen = listen
+        self.port = port
+        self.app = web.Application()
+        self.app.router.add_get("/healthz", self._health)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def router(self) -> web.UrlDispatcher:
+        return self.app.router
+
+    async def _health(self, request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info("🌐 Webhook server listening on %s:%s", self.listen, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def add_telegram_route(server: WebhookServer, bot_app, path: str = WEBHOOK_PATH):
+    async def _handle_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET_TOKEN and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET_TOKEN
+        ):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, bot_app.bot)
+        except Exception:
+            logger.warning("Webhook: invalid update payload")
+            return web.Response(status=400)
+        await bot_app.update_queue.put(update)
+        return web.Response()
+
+    server.router.add_post(path, _handle_update)
+
+
+async def set_telegram_webhook(bot_app, drop_pending_updates: bool = DROP_PENDING_UPDATES):
+    """Point Telegram at WEBHOOK_URL + WEBHOOK_PATH (pending updates are kept unless dropped)."""
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_TRANSPORT=webhook requires WEBHOOK_URL (public https base URL)")
+    await bot_app.bot.set_webhook(
+        url=WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET_TOKEN or None,
+        drop_pending_updates=drop_pending_updates,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=100,
+    )
@@ -1,4 +1,5 @@
 ﻿from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from functools import lru_cache
 import math
 
 
@@ -10,7 +11,13 @@ def _format_vnd_dot(amount) -> str:
     return f"{value:,}".replace(",", ".")
 
 def user_reply_keyboard(lang: str = 'vi', flags: dict | None = None):
-    flags = flags or {}
+    # Markup objects are immutable: the same (language, flag set) reuses one instance.
+    flag_items = frozenset((key, bool(value)) for key, value in (flags or {}).items())
+    return _user_reply_keyboard(lang, flag_items)
+
+@lru_cache(maxsize=64)
+def _user_reply_keyboard(lang: str, flag_items: frozenset):
+    flags = dict(flag_items)
     def enabled(key: str, default: bool = True) -> bool:
         return bool(flags.get(key, default))
 
@@ -107,7 +114,6 @@ def admin_sold_codes_keyboard(products):
     return InlineKeyboardMarkup(keyboard)
 
 def products_keyboard(products, lang: str = 'vi', page: int = 0, page_size: int = 10):
-    keyboard = []
     total_products = len(products or [])
     total_pages = max(1, math.ceil(total_products / max(1, page_size)))
     safe_page = max(0, min(page, total_pages - 1))
@@ -115,22 +121,32 @@ def products_keyboard(products, lang: str = 'vi', page: int = 0, page_size: int
     start = safe_page * page_size
     end = start + page_size
     page_products = (products or [])[start:end]
+    # Key = exactly what is rendered, so edits to products/prices/stock or the page size
+    # produce a new key and unchanged pages reuse the cached markup.
+    rows = tuple(
+        (p['id'], p['name'], p.get('price'), p.get('price_usdt'), p['stock'])
+        for p in page_products
+    )
+    return _products_keyboard(lang, safe_page, total_pages, rows)
 
-    for p in page_products:
+@lru_cache(maxsize=256)
+def _products_keyboard(lang: str, safe_page: int, total_pages: int, rows: tuple):
+    keyboard = []
+    for product_id, name, price, price_usdt, stock in rows:
         if lang == 'en':
             # English: show USDT price only
-            stock_text = f"📦 {p['stock']}" if p['stock'] > 0 else "❌ out"
-            if p.get('price_usdt') and p['price_usdt'] > 0:
-                price_text = f"{p['price_usdt']} USDT"
+            stock_text = f"📦 {stock}" if stock > 0 else "❌ out"
+            if price_usdt and price_usdt > 0:
+                price_text = f"{price_usdt} USDT"
             else:
                 price_text = "N/A"
-            label = f"{p['name']} | {price_text} | {stock_text}"
+            label = f"{name} | {price_text} | {stock_text}"
         else:
             # Vietnamese: show VND price (USDT option available when buying)
-            stock_text = f"📦 {p['stock']}" if p['stock'] > 0 else "❌ Hết"
-            price_text = f"{_format_vnd_dot(p.get('price'))} đ"
-            label = f"{p['name']} | {price_text} | {stock_text}"
-        keyboard.append([InlineKeyboardButton(label, callback_data=f"buy_{p['id']}")])
+            stock_text = f"📦 {stock}" if stock > 0 else "❌ Hết"
+            price_text = f"{_format_vnd_dot(price)} đ"
+            label = f"{name} | {price_text} | {stock_text}"
+        keyboard.append([InlineKeyboardButton(label, callback_data=f"buy_{product_id}")])
 
     if total_pages > 1:
         prev_text = "⬅️ Prev" if lang == "en" else "⬅️ Trước"
@@ -6,9 +6,14 @@ from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     ConversationHandler, MessageHandler, filters
 )
-from config import BOT_TOKEN
-from database import init_db, get_setting, log_telegram_message
+from config import BOT_TOKEN, BOT_TRANSPORT, DROP_PENDING_UPDATES, UPDATE_CONCURRENCY
+from database import init_db, close_db, get_setting, log_telegram_message
 from handlers.chat_logger import log_incoming_message
+from helpers.broadcast import resume_broadcasts, stop_broadcasts
+from helpers.outbound import install_outbound_dispatcher, stop_outbound_dispatcher
+from helpers.request_context import CONTEXT_TYPES
+from helpers.update_processor import PerChatUpdateProcessor
+from helpers.webhook import WebhookServer, add_telegram_route, set_telegram_webhook
 from handlers.start import (
     start_command,
     back_to_main,
@@ -54,7 +59,7 @@ from handlers.admin import (
     admin_binance_deposits, admin_view_binance_deposit,
     admin_confirm_binance_deposit, admin_cancel_binance_deposit
 )
-from sepay_checker import run_checker, init_checker_db
+from sepay_checker import SEPAY_WEBHOOK_ENABLED, add_sepay_webhook_route, close_checker, run_checker, init_checker_db
 
 # Setup logging
 logging.basicConfig(
@@ -72,6 +77,9 @@ logging.getLogger('httpx').setLevel(logging.WARNING)
 logging.getLogger('telegram').setLevel(logging.WARNING)
 
 async def post_init(application):
+    # Every send goes through the priority queue / rate limiter first (helpers/outbound.py).
+    install_outbound_dispatcher(application.bot)
+
     # Wrap Telegram API send methods to capture outgoing messages for admin chat history.
     original_send_message = application.bot.send_message
     original_send_document = application.bot.send_document
@@ -140,15 +148,20 @@ async def post_init(application):
             logger.exception("Failed to log outgoing send_photo")
         return result
 
-    application.bot.send_message = send_message_logged  # type: ignore[assignment]
-    application.bot.send_document = send_document_logged  # type: ignore[assignment]
-    application.bot.send_photo = send_photo_logged  # type: ignore[assignment]
+    with application.bot._unfrozen():
+        application.bot.send_message = send_message_logged  # type: ignore[assignment]
+        application.bot.send_document = send_document_logged  # type: ignore[assignment]
+        application.bot.send_photo = send_photo_logged  # type: ignore[assignment]
 
 def setup_bot():
     app = (
         Application.builder()
         .token(BOT_TOKEN)
         .post_init(post_init)
+        # Per-update context with memoized language/balances/UI flags (helpers/request_context.py)
+        .context_types(CONTEXT_TYPES)
+        # Updates run concurrently; each chat's updates stay in order (helpers/update_processor.py)
+        .concurrent_updates(PerChatUpdateProcessor(UPDATE_CONCURRENCY))
         .connect_timeout(30)
         .read_timeout(30)
         .write_timeout(30)
@@ -378,13 +391,35 @@ async def main():
     
     logger.info("🤖 Bot is starting...")
     await bot_app.initialize()
+    # initialize() does not run post_init (only run_polling() does); call it like run_polling would.
+    if bot_app.post_init:
+        await bot_app.post_init(bot_app)
     await bot_app.start()
-    await bot_app.updater.start_polling(drop_pending_updates=True)
+    telegram_webhook = BOT_TRANSPORT == "webhook"
+    webhook_server = None
+    if telegram_webhook or SEPAY_WEBHOOK_ENABLED:
+        webhook_server = WebhookServer()
+        if telegram_webhook:
+            add_telegram_route(webhook_server, bot_app)
+        if SEPAY_WEBHOOK_ENABLED:
+            add_sepay_webhook_route(webhook_server, bot_app)
+        await webhook_server.start()
+    if telegram_webhook:
+        await set_telegram_webhook(bot_app)
+        logger.info("📡 Receiving updates via webhook")
+    else:
+        await bot_app.updater.start_polling(drop_pending_updates=DROP_PENDING_UPDATES)
+        logger.info("📡 Receiving updates via polling")
     
     # Start SePay checker
     asyncio.create_task(run_checker(bot_app, interval=30))
     logger.info("🔄 SePay auto-checker enabled (30s interval)")
     
+    # Resume /notification broadcasts interrupted by the last shutdown
+    resumed = await resume_broadcasts(bot_app.bot)
+    if resumed:
+        logger.info(f"📢 Resumed {resumed} broadcast job(s)")
+    
     # Keep running
     stop_event = asyncio.Event()
     
@@ -404,9 +439,18 @@ async def main():
         pass
     finally:
         logger.info("🛑 Shutting down...")
-        await bot_app.updater.stop()
+        # Telegram webhook stays registered: Telegram queues updates until we are back.
+        if webhook_server:
+            await webhook_server.stop()
+        if not telegram_webhook:
+            await bot_app.updater.stop()
+        # Broadcast jobs keep their checkpoint and resume on next start
+        await stop_broadcasts()
+        await stop_outbound_dispatcher()
+        await close_checker()
         await bot_app.stop()
         await bot_app.shutdown()
+        await close_db()
         logger.info("👋 Bot stopped!")
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+"""
+Benchmark: SePay payment-code matching, old nested loop (every transaction x
+every pending code, substring tests) vs helpers.payment_match.PaymentCodeIndex.
+
+Offline, synthetic data shaped like the bot's codes (SEVQR NAP<uid><4 digits>,
+SEBUY <uid><4 digits>) inside bank-style transfer notes:
+    python scripts/bench_payment_match.py --transactions 200 --pending 5000
+
+Both matchers must pick the same row for every transaction; the script exits 1 otherwise.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from helpers.payment_match import PaymentCodeIndex, normalize_code
+
+
+def make_pending(count: int, rng: random.Random):
+    rows, seen = [], set()
+    while len(rows) < count:
+        user_id = rng.randint(10 ** 8, 10 ** 10)
+        prefix = "SEVQR NAP" if rng.random() < 0.5 else "SEBUY "
+        code = f"{prefix}{user_id}{rng.randint(1000, 9999)}"
+        if code in seen:
+            continue
+        seen.add(code)
+        # Same shape as pending direct orders: code at index 7
+        rows.append((len(rows) + 1, user_id, 1, 1, 0, 50000, 50000, code, None))
+    return rows
+
+
+def make_transactions(count: int, pending, hit_ratio: float, rng: random.Random):
+    contents = []
+    for i in range(count):
+        noise = f"MBVCB.{rng.randint(10 ** 9, 10 ** 10)}.{rng.randint(100000, 999999)}"
+        if pending and rng.random() < hit_ratio:
+            code = rng.choice(pending)[7]
+            # Banks often drop or move spaces inside the note
+            code = code.replace(" ", "") if rng.random() < 0.5 else code
+            contents.append(f"{noise}.{code} CHUYEN TIEN.CT tu 0123456789 NGUYEN VAN A")
+        else:
+            contents.append(f"{noise}.CHUYEN TIEN AN TRUA {i}.CT tu 0123456789 NGUYEN VAN A")
+    return contents
+
+
+def legacy_match(contents, pending):
+    """The loop process_transactions used before: first pending row whose code occurs in the content."""
+    result = []
+    for content in contents:
+        content_upper = str(content).upper().strip()
+        content_norm = normalize_code(content)
+        found = None
+        for row in pending:
+            code = row[7]
+            if code.upper() in content_upper or normalize_code(code) in content_norm:
+                found = row
+                break
+        result.append(found)
+    return result
+
+
+def indexed_match(contents, pending):
+    index = PaymentCodeIndex(pending, lambda row: row[7])
+    return [index.first(normalize_code(content)) for content in contents]
+
+
+def _timed(fn, *args, repeat: int = 1):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transactions", type=int, default=200)
+    parser.add_argument("--pending", type=int, default=5000)
+    parser.add_argument("--hit-ratio", type=float, default=0.5, help="share of transfers carrying a pending code")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pending = make_pending(args.pending, rng)
+    contents = make_transactions(args.transactions, pending, args.hit_ratio, rng)
+
+    legacy_s, legacy = _timed(legacy_match, contents, pending, repeat=args.repeat)
+    indexed_s, indexed = _timed(indexed_match, contents, pending, repeat=args.repeat)
+
+    mismatches = sum(1 for a, b in zip(legacy, indexed) if a is not b)
+    matched = sum(1 for row in indexed if row is not None)
+    print(f"{args.transactions} transactions x {args.pending} pending codes, {matched} matched")
+    print(f"legacy nested loop : {legacy_s * 1000:10.1f} ms")
+    print(f"PaymentCodeIndex   : {indexed_s * 1000:10.1f} ms  (index build included)")
+    print(f"speedup            : {legacy_s / indexed_s if indexed_s else float('inf'):10.1f}x")
+    if mismatches:
+        print(f"MISMATCH: {mismatches} transactions matched differently")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
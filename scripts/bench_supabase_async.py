@@ -0,0 +1,112 @@
+"""
+Benchmark: concurrent get_balance() via the async Supabase layer vs the old
+asyncio.to_thread + sync client path.
+
+Against a real project (read-only, uses SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY):
+    python scripts/bench_supabase_async.py --user-id 123456789 --requests 500 --concurrency 100
+
+Offline, against a local PostgREST stub that answers after --latency-ms:
+    python scripts/bench_supabase_async.py --fake --latency-ms 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+FAKE_KEY = "bench.fake.key"
+
+
+async def _start_fake_postgrest(latency_ms: float):
+    from aiohttp import web
+
+    async def handle(request):
+        await asyncio.sleep(latency_ms / 1000)
+        return web.json_response([{"balance": 1000}])
+
+    app = web.Application()
+    app.router.add_route("*", "/rest/v1/{tail:.*}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def _run(label: str, call, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+
+    await call()  # warm up connection / client
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+    print(f"{label:<28} {total / elapsed:8.1f} req/s   p50 {p50:7.1f} ms   p95 {p95:7.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--fake", action="store_true", help="use a local PostgREST stub instead of SUPABASE_URL")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="stub response delay (with --fake)")
+    args = parser.parse_args()
+
+    runner = None
+    if args.fake:
+        runner, url = await _start_fake_postgrest(args.latency_ms)
+        os.environ["SUPABASE_URL"] = url
+        os.environ["SUPABASE_SERVICE_ROLE_KEY"] = FAKE_KEY
+        # Plain-HTTP stub: no TLS/ALPN, so HTTP/2 cannot be negotiated anyway.
+        os.environ.setdefault("SUPABASE_HTTP2", "false")
+    elif not os.getenv("SUPABASE_URL"):
+        raise SystemExit("Set SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY or pass --fake.")
+
+    from postgrest import SyncPostgrestClient
+
+    from database import supabase_client
+    from database.supabase_db import close_db, get_balance
+
+    url, key = supabase_client._credentials()
+    sync_client = SyncPostgrestClient(
+        f"{url}/rest/v1", headers={"apikey": key, "Authorization": f"Bearer {key}"}
+    )
+
+    def _sync_get_balance():
+        return sync_client.table("users").select("balance").eq("user_id", args.user_id).limit(1).execute()
+
+    async def thread_offload():
+        await asyncio.to_thread(_sync_get_balance)
+
+    async def native_async():
+        await get_balance(args.user_id)
+
+    print(f"{args.requests} x get_balance, concurrency {args.concurrency}, default executor "
+          f"{min(32, (os.cpu_count() or 1) + 4)} threads")
+    try:
+        await _run("to_thread + sync client", thread_offload, args.requests, args.concurrency)
+        await _run("async shared HTTP client", native_async, args.requests, args.concurrency)
+    finally:
+        sync_client.session.close()
+        await close_db()
+        if runner is not None:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
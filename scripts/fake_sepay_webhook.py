@@ -0,0 +1,148 @@
+"""
+Fake SePay: POST a webhook-shaped transaction to the bot's local receiver
+(SEPAY_WEBHOOK_ENABLED=true), to test deposits / direct orders without a bank transfer.
+
+    python scripts/fake_sepay_webhook.py --amount 50000 --content "SEVQR NAP1234567891234"
+    python scripts/fake_sepay_webhook.py --url https://your-domain.com/webhook/sepay --api-key KEY ...
+
+The API key defaults to SEPAY_WEBHOOK_API_KEY / SEPAY_API_KEY from .env, the URL
+to SEPAY_WEBHOOK_PATH on WEBHOOK_PORT, like the bot.
+
+    python scripts/fake_sepay_webhook.py --check
+
+runs the receiver in-process against a throwaway SQLite database and checks
+401 (bad key) / 400 (bad payload) / 200, that an outgoing transfer carrying a
+deposit code credits nothing, that an incoming one credits once, and that a
+replayed id is ignored. Exits 1 on the first failure.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def build_payload(tx_id: int, amount: int, content: str, transfer_type: str = "in") -> dict:
+    """Same fields SePay sends (https://docs.sepay.vn/tich-hop-webhooks.html)."""
+    return {
+        "id": tx_id,
+        "gateway": os.getenv("SEPAY_BANK_NAME", "MBBank"),
+        "transactionDate": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "accountNumber": os.getenv("SEPAY_ACCOUNT_NUMBER", "0123456789"),
+        "code": None,
+        "content": content,
+        "transferType": transfer_type,
+        "transferAmount": amount,
+        "accumulated": 0,
+        "subAccount": None,
+        "referenceCode": f"FT{tx_id}",
+        "description": content,
+    }
+
+
+def _webhook_path() -> str:
+    # Same env var and normalisation as sepay_checker.SEPAY_WEBHOOK_PATH
+    return "/" + os.getenv("SEPAY_WEBHOOK_PATH", "webhook/sepay").strip().strip("/")
+
+
+async def send(args):
+    from config import SEPAY_API_KEY, WEBHOOK_PORT
+
+    import aiohttp
+
+    url = args.url or f"http://127.0.0.1:{WEBHOOK_PORT}{_webhook_path()}"
+    api_key = args.api_key if args.api_key is not None else (
+        os.getenv("SEPAY_WEBHOOK_API_KEY", "").strip() or SEPAY_API_KEY
+    )
+    tx_id = args.id if args.id is not None else int(time.time() * 1000)
+    payload = build_payload(tx_id, args.amount, args.content, "out" if args.out else "in")
+    headers = {"Authorization": f"Apikey {api_key}"} if api_key else {}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=payload, headers=headers) as resp:
+            body = await resp.text()
+    print(f"tx {tx_id} -> HTTP {resp.status} {body}")
+    return 0 if resp.status == 200 else 1
+
+
+async def self_check():
+    # Never touch a real database: SQLite backend, relative data/shop.db inside a temp dir.
+    os.environ["USE_SUPABASE"] = "false"
+    os.chdir(tempfile.mkdtemp(prefix="fake_sepay_"))
+    import config  # noqa: F401  (loads .env before the key fallback below)
+
+    os.environ["SEPAY_WEBHOOK_API_KEY"] = os.getenv("SEPAY_WEBHOOK_API_KEY", "").strip() or "fake-sepay-check"
+    from aiohttp.test_utils import TestClient, TestServer
+
+    import database
+    import sepay_checker
+    from helpers.webhook import WebhookServer
+
+    user_id, code = 900000001, "SEVQR NAP9000000011234"
+    await database.init_db()
+    await sepay_checker.init_checker_db()
+    await database.get_or_create_user(user_id, "fake_sepay")
+    await database.create_deposit(user_id, 50000, code)
+
+    server = WebhookServer()
+    sepay_checker.add_sepay_webhook_route(server)
+    client = TestClient(TestServer(server.app))
+    await client.start_server()
+    path = sepay_checker.SEPAY_WEBHOOK_PATH
+    good = {"Authorization": f"Apikey {sepay_checker.SEPAY_WEBHOOK_API_KEY}"}
+
+    async def post(payload, headers=good):
+        resp = await client.post(path, json=payload, headers=headers)
+        # The receiver answers first and processes in a task that holds _process_lock: wait for it.
+        async with sepay_checker._process_lock:
+            pass
+        return resp.status
+
+    checks = [
+        ("bad api key -> 401", lambda: post(build_payload(1, 50000, code), {"Authorization": "Apikey wrong"}), 401, 0),
+        ("payload without id -> 400", lambda: post({"content": code}), 400, 0),
+        ("outgoing transfer -> 200, no credit", lambda: post(build_payload(2, 50000, code, "out")), 200, 0),
+        ("incoming transfer -> 200, credited", lambda: post(build_payload(3, 50000, f"CK {code} FT")), 200, 50000),
+        ("replayed id -> 200, not credited twice", lambda: post(build_payload(3, 50000, f"CK {code} FT")), 200, 50000),
+    ]
+    failed = 0
+    try:
+        for name, run, want_status, want_balance in checks:
+            status = await run()
+            balance = await database.get_balance(user_id)
+            ok = status == want_status and balance == want_balance
+            failed += not ok
+            print(f"[{'ok' if ok else 'FAIL'}] {name} (HTTP {status}, balance {balance})")
+            if not ok:
+                break
+    finally:
+        await client.close()
+        await sepay_checker.close_checker()
+        await database.close_db()
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=None, help="default: http://127.0.0.1:WEBHOOK_PORT/SEPAY_WEBHOOK_PATH")
+    parser.add_argument("--api-key", default=None, help="default: SEPAY_WEBHOOK_API_KEY / SEPAY_API_KEY")
+    parser.add_argument("--amount", type=int)
+    parser.add_argument("--content", help="transfer note, e.g. the SEVQR NAP... code")
+    parser.add_argument("--id", type=int, default=None, help="transaction id (default: current time in ms)")
+    parser.add_argument("--out", action="store_true", help="send an outgoing transfer (bot must ignore it)")
+    parser.add_argument("--check", action="store_true", help="run the receiver checks locally instead of sending")
+    args = parser.parse_args()
+    if args.check:
+        return asyncio.run(self_check())
+    if args.amount is None or not args.content:
+        parser.error("--amount and --content are required (or use --check)")
+    return asyncio.run(send(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,24 @@
 """
 Tự động check giao dịch từ SePay API (không cần webhook/domain)
+
+Tuỳ chọn SEPAY_WEBHOOK_ENABLED: nhận webhook SePay qua server aiohttp nội bộ
+(helpers/webhook.py) để giao hàng ngay; polling khi đó chỉ còn là lượt đối soát
+chậm (SEPAY_RECONCILE_SECONDS).
 """
 import asyncio
 import aiohttp
+import hmac
 import os
 import io
 import logging
 from datetime import datetime
-from config import SEPAY_API_TOKEN
+from config import SEPAY_API_KEY, SEPAY_API_TOKEN
+from helpers.outbound import PRIORITY_PAYMENT, set_send_priority
+from helpers.order_expiry import (
+    DIRECT_ORDER_PENDING_EXPIRE_MINUTES, discard_direct_order_expiry, is_direct_order_expiry_scheduled,
+    schedule_direct_orders, start_direct_order_expiry, stop_direct_order_expiry,
+)
+from helpers.payment_match import PaymentCodeIndex, normalize_code
 from helpers.sepay_state import has_latest_vietqr_message, mark_bot_message
 from helpers.formatting import format_stock_items
 
@@ -30,8 +41,19 @@ def _env_positive_int(name: str, default: int) -> int:
 
 
 SEPAY_DEFAULT_LIMIT = _env_positive_int("SEPAY_DEFAULT_LIMIT", 200)
-DIRECT_ORDER_PENDING_EXPIRE_MINUTES = _env_positive_int("DIRECT_ORDER_PENDING_EXPIRE_MINUTES", 10)
-DIRECT_ORDER_PENDING_EXPIRE_SECONDS = DIRECT_ORDER_PENDING_EXPIRE_MINUTES * 60
+SEPAY_WEBHOOK_ENABLED = os.getenv("SEPAY_WEBHOOK_ENABLED", "").lower() in ("1", "true", "yes")
+SEPAY_WEBHOOK_PATH = "/" + os.getenv("SEPAY_WEBHOOK_PATH", "webhook/sepay").strip().strip("/")
+# SePay → Webhook → Kiểu chứng thực "API Key": header `Authorization: Apikey <key>`
+SEPAY_WEBHOOK_API_KEY = os.getenv("SEPAY_WEBHOOK_API_KEY", "").strip() or SEPAY_API_KEY
+# Khi đã có webhook, polling chỉ để đối soát (giao dịch webhook bị lỡ)
+SEPAY_RECONCILE_SECONDS = _env_positive_int("SEPAY_RECONCILE_SECONDS", 300)
+SEPAY_HTTP_TIMEOUT_SECONDS = _env_positive_int("SEPAY_HTTP_TIMEOUT_SECONDS", 20)
+SEPAY_MAX_BACKFILL_PAGES = _env_positive_int("SEPAY_MAX_BACKFILL_PAGES", 10)
+# Số id giao dịch đã xử lý giữ trong RAM (nạp sẵn khi khởi động)
+SEPAY_RECENT_TX_CACHE = _env_positive_int("SEPAY_RECENT_TX_CACHE", 5000)
+# Đơn direct do website tạo (Supabase) không đi qua bot: quét định kỳ để hẹn giờ huỷ,
+# không phụ thuộc chu kỳ poll (có webhook thì poll chỉ chạy mỗi SEPAY_RECONCILE_SECONDS)
+DIRECT_ORDER_EXPIRY_REFRESH_SECONDS = _env_positive_int("DIRECT_ORDER_EXPIRY_REFRESH_SECONDS", 60)
 logger = logging.getLogger(__name__)
 
 if USE_SUPABASE:
@@ -40,12 +62,13 @@ if USE_SUPABASE:
         set_setting,
         get_pending_deposits,
         update_balance,
-        get_balance,
-        is_processed_transaction,
+        get_processed_transaction_ids,
+        get_recent_processed_transaction_ids,
         mark_processed_transaction,
         set_deposit_status,
         get_pending_direct_orders,
         set_direct_order_status,
+        cancel_pending_direct_orders,
         get_available_stock_batch,
         mark_stock_sold_batch,
         create_order_bulk,
@@ -56,10 +79,41 @@ if USE_SUPABASE:
     )
 else:
     import aiosqlite
+    from database.db import init_db as init_sqlite_db
+    from database.db import cancel_pending_direct_orders, get_pending_direct_orders
+    from database.db import get_processed_transaction_ids, get_recent_processed_transaction_ids
 
 DB_PATH = "data/shop.db"
 _SEPAY_TOKEN_WARNED = False
 _SEPAY_TOKEN_OK = False
+_http_session: aiohttp.ClientSession | None = None
+# (checkpoint, transaction_date_max) where an unfinished backfill resumes on the next poll
+_backfill_resume: tuple[int, str] | None = None
+_expiry_refresh_task: asyncio.Task | None = None
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    """Session dùng chung cho SePay API và relay: giữ kết nối keep-alive thay vì bắt tay TCP+TLS mỗi lần poll."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=75, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=SEPAY_HTTP_TIMEOUT_SECONDS, connect=10),
+        )
+    return _http_session
+
+
+async def close_checker():
+    """Dừng hẹn giờ huỷ đơn và đóng HTTP session của checker (gọi khi tắt bot)."""
+    global _http_session, _expiry_refresh_task
+    if _expiry_refresh_task is not None:
+        _expiry_refresh_task.cancel()
+        await asyncio.gather(_expiry_refresh_task, return_exceptions=True)
+        _expiry_refresh_task = None
+    await stop_direct_order_expiry()
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
 
 
 def make_file(items: list, header: str = "") -> io.BytesIO:
@@ -119,21 +173,20 @@ async def send_payment_relay_notification(relay_token: str, relay_chat_id: int |
         "text": str(text or "").strip(),
     }
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(url, json=payload) as resp:
-                if resp.status != 200:
-                    body = await resp.text()
-                    logger.warning("Relay notify failed (HTTP %s): %s", resp.status, body[:200])
-                    return False
-                data = await resp.json()
-                if not data.get("ok"):
-                    logger.warning("Relay notify failed: %s", data)
-                    return False
-                return True
-        except Exception as e:
-            logger.warning("Relay notify exception: %s", e)
-            return False
+    try:
+        async with _get_http_session().post(url, json=payload) as resp:
+            if resp.status != 200:
+                body = await resp.text()
+                logger.warning("Relay notify failed (HTTP %s): %s", resp.status, body[:200])
+                return False
+            data = await resp.json()
+            if not data.get("ok"):
+                logger.warning("Relay notify failed: %s", data)
+                return False
+            return True
+    except Exception as e:
+        logger.warning("Relay notify exception: %s", e)
+        return False
 
 
 def _resolve_product_name(product: dict | None, product_id: int) -> str:
@@ -231,21 +284,50 @@ async def get_sepay_token():
         row = await cursor.fetchone()
         return (row[0] if row else "") or SEPAY_API_TOKEN
 
-async def get_recent_transactions():
-    """Lấy giao dịch gần đây từ SePay"""
+async def _fetch_transactions_page(session, headers: dict, params: dict):
+    """Một trang userapi/transactions/list; None nếu lỗi (khác với trang rỗng)."""
+    url = "https://my.sepay.vn/userapi/transactions/list"
+    try:
+        async with session.get(url, headers=headers, params=params) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                transactions = data.get('transactions', []) or data.get('data', []) or []
+                if SEPAY_DEBUG:
+                    logger.info("SePay payload keys: %s", list(data.keys()))
+                    logger.info("SePay transactions count: %s (params=%s)", len(transactions), params)
+                    logger.info("SePay status: %s | error: %s | messages: %s", data.get("status"), data.get("error"), data.get("messages"))
+                if data.get("status") is False or data.get("error"):
+                    logger.warning("SePay API returned error: %s | messages: %s", data.get("error"), data.get("messages"))
+                return transactions
+            body = await resp.text()
+            logger.warning("SePay API error %s: %s", resp.status, body[:200])
+    except Exception as e:
+        logger.exception("Error fetching SePay transactions: %s", e)
+    return None
+
+
+async def get_recent_transactions(since_tx_id: str = ""):
+    """
+    Lấy giao dịch gần đây từ SePay. Trả về (transactions, complete).
+    Có checkpoint (since_tx_id) → chỉ hỏi giao dịch từ id đó trở đi (since_id), thường chỉ vài dòng mỗi lần poll.
+    Nếu trang trả về đầy mà giao dịch cũ nhất vẫn mới hơn checkpoint thì có thể bị hụt (nhiều giao dịch giữa
+    hai lần poll / bot tắt lâu): lùi thêm trang theo transaction_date_max, tối đa SEPAY_MAX_BACKFILL_PAGES.
+    complete = False khi chưa lùi tới checkpoint (lỗi API / hết số trang): caller không được dời checkpoint,
+    lần poll sau lùi tiếp từ chỗ đã dừng.
+    """
+    global _backfill_resume
     SEPAY_API_TOKEN = await get_sepay_token()
     if not SEPAY_API_TOKEN:
         global _SEPAY_TOKEN_WARNED
         if not _SEPAY_TOKEN_WARNED:
             logger.warning("SePay token missing. Set settings.sepay_token or SEPAY_API_TOKEN in .env.")
             _SEPAY_TOKEN_WARNED = True
-        return []
+        return [], False
     global _SEPAY_TOKEN_OK
     if not _SEPAY_TOKEN_OK:
         logger.info("✅ SePay token loaded.")
         _SEPAY_TOKEN_OK = True
     
-    url = "https://my.sepay.vn/userapi/transactions/list"
     headers = {
         "Authorization": f"Bearer {SEPAY_API_TOKEN}",
         "Content-Type": "application/json"
@@ -258,28 +340,62 @@ async def get_recent_transactions():
         params["from_date"] = SEPAY_FROM_DATE
     if SEPAY_TO_DATE:
         params["to_date"] = SEPAY_TO_DATE
-
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url, headers=headers, params=params or None) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    transactions = data.get('transactions', []) or data.get('data', []) or []
-                    if SEPAY_DEBUG:
-                        logger.info("SePay payload keys: %s", list(data.keys()))
-                        logger.info("SePay transactions count: %s", len(transactions))
-                        logger.info("SePay status: %s | error: %s | messages: %s", data.get("status"), data.get("error"), data.get("messages"))
-                    if data.get("status") is False or data.get("error"):
-                        logger.warning("SePay API returned error: %s | messages: %s", data.get("error"), data.get("messages"))
-                    return transactions
-                body = await resp.text()
-                logger.warning("SePay API error %s: %s", resp.status, body[:200])
-        except Exception as e:
-            logger.exception("Error fetching SePay transactions: %s", e)
-    return []
+    checkpoint = _tx_id_to_int(since_tx_id)
+    if checkpoint is not None:
+        params["since_id"] = str(checkpoint)
+
+    session = _get_http_session()
+    transactions = await _fetch_transactions_page(session, headers, params)
+    if transactions is None:
+        return [], False
+    if not transactions or checkpoint is None:
+        return transactions, True
+
+    # Lần trước lùi chưa tới checkpoint: đoạn giữa trang mới nhất và chỗ dừng đã xử lý rồi, lùi tiếp từ chỗ dừng
+    resume_date = _backfill_resume[1] if _backfill_resume and _backfill_resume[0] == checkpoint else ""
+    seen = {_pick_tx_id(tx) for tx in transactions}
+    page = transactions
+    pages = 0
+    while len(page) >= resolved_limit:
+        page_ids = [(_tx_id_to_int(_pick_tx_id(tx)), tx) for tx in page]
+        page_ids = [(tx_int, tx) for tx_int, tx in page_ids if tx_int is not None]
+        if not page_ids:
+            break
+        oldest_id, oldest = min(page_ids, key=lambda item: item[0])
+        oldest_date = str(oldest.get("transaction_date") or "")
+        if oldest_id <= checkpoint or not oldest_date:
+            break
+        if resume_date and resume_date < oldest_date:
+            oldest_date = resume_date
+        resume_date = oldest_date
+        if pages >= SEPAY_MAX_BACKFILL_PAGES:
+            logger.warning(
+                "SePay backfill stopped after %s pages; checkpoint kept, continuing from %s on the next poll",
+                pages, resume_date,
+            )
+            page = None
+            break
+        pages += 1
+        page = await _fetch_transactions_page(session, headers, dict(params, transaction_date_max=oldest_date))
+        if page is None:
+            logger.warning("SePay backfill after checkpoint %s failed; checkpoint kept, retry on the next poll", checkpoint)
+            break
+        older = [tx for tx in page if _pick_tx_id(tx) not in seen]
+        if not older:
+            page = []
+            break
+        seen.update(_pick_tx_id(tx) for tx in older)
+        transactions.extend(older)
+        logger.info("SePay gap after checkpoint %s: fetched %s older transactions", checkpoint, len(older))
+
+    if page is None:
+        _backfill_resume = (checkpoint, resume_date)
+        return transactions, False
+    _backfill_resume = None
+    return transactions, True
 
 def _normalize_content(value: str) -> str:
-    return "".join(str(value).upper().split())
+    return normalize_code(value)
 
 def _pick_content(tx: dict) -> str:
     for key in ("transaction_content", "content", "description", "note", "memo"):
@@ -320,24 +436,51 @@ def _parse_created_at(value: str | None):
         return None
 
 
-def _is_direct_order_expired(created_at: str | None) -> bool:
-    parsed = _parse_created_at(created_at)
-    if not parsed:
-        return False
-    now_dt = datetime.now(parsed.tzinfo) if parsed.tzinfo else datetime.now()
-    return (now_dt - parsed).total_seconds() >= DIRECT_ORDER_PENDING_EXPIRE_SECONDS
-
-
-async def _auto_cancel_expired_direct_orders(pending_direct_orders, bot_app=None):
-    active_orders = []
+def _direct_order_expiry_entries(pending_direct_orders):
+    """(code, created_at timestamp) của đơn chưa có hẹn giờ; đơn đã có thì không parse lại."""
     for order in pending_direct_orders:
-        order_id, user_id, _product_id, _quantity, _bonus_quantity, _unit_price, _expected_amount, code, created_at = order
-        if not _is_direct_order_expired(created_at):
-            active_orders.append(order)
+        code = str(order[7] or "").strip()
+        if not code or is_direct_order_expiry_scheduled(code):
             continue
+        parsed = _parse_created_at(order[8])
+        if parsed is None:
+            continue  # không rõ thời điểm tạo: không tự huỷ
+        # naive = giờ local (datetime.now() khi tạo đơn)
+        yield code, parsed.timestamp()
+
+
+async def _load_direct_order_expiry():
+    """Nạp hẹn giờ huỷ cho các đơn direct đang chờ chưa có hẹn giờ (khi khởi động và mỗi lượt refresh)."""
+    try:
+        added = schedule_direct_orders(_direct_order_expiry_entries(await get_pending_direct_orders()))
+    except Exception:
+        logger.exception("Cannot load pending direct orders for expiry")
+        return
+    if added:
+        logger.info("⏱️ Direct order expiry: %s pending order(s) scheduled", added)
 
-        await set_direct_order_status(order_id, "cancelled")
-        website_order = _find_website_direct_order(code, _website_orders_by_code_upper, _website_orders_by_code_norm)
+
+async def _refresh_direct_order_expiry():
+    while True:
+        await asyncio.sleep(DIRECT_ORDER_EXPIRY_REFRESH_SECONDS)
+        await _load_direct_order_expiry()
+
+
+async def _expire_direct_orders(codes, bot_app=None):
+    """Callback của helpers.order_expiry: huỷ một lô đơn direct quá hạn bằng một lệnh UPDATE."""
+    # Tuần tự với xử lý giao dịch: đơn vừa được thanh toán (không còn pending) sẽ không bị huỷ.
+    async with _process_lock:
+        cancelled = await cancel_pending_direct_orders(codes)
+        website_by_code_upper, website_by_code_norm = {}, {}
+        if cancelled and USE_SUPABASE:
+            for row in await get_pending_website_direct_orders():
+                code = str(row[8] or "").strip()
+                if code:
+                    website_by_code_upper[code.upper()] = row
+                    website_by_code_norm[_normalize_content(code)] = row
+
+    for order_id, user_id, code in cancelled:
+        website_order = _find_website_direct_order(code, website_by_code_upper, website_by_code_norm)
         if website_order:
             try:
                 await set_website_direct_order_status(website_order[0], "cancelled")
@@ -353,7 +496,6 @@ async def _auto_cancel_expired_direct_orders(pending_direct_orders, bot_app=None
                 )
             except Exception:
                 pass
-    return active_orders
 
 
 _website_orders_by_code_upper = {}
@@ -385,13 +527,115 @@ def _remove_website_direct_order_from_maps(row):
     _website_orders_by_code_upper.pop(code.upper(), None)
     _website_orders_by_code_norm.pop(_normalize_content(code), None)
 
-async def process_transactions(bot_app=None):
-    """Xử lý giao dịch và cộng tiền tự động"""
-    transactions = await get_recent_transactions()
-    last_seen_tx_id = await _load_last_seen_tx_id()
+class _RecentTxIds:
+    """Id giao dịch đã xử lý gần đây, giới hạn `maxlen` (bỏ id cũ nhất trước)."""
+
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self._ids = {}
+
+    def __contains__(self, tx_id) -> bool:
+        return tx_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, tx_id: str):
+        self._ids.pop(tx_id, None)
+        self._ids[tx_id] = None
+        while len(self._ids) > self.maxlen:
+            del self._ids[next(iter(self._ids))]
+
+    def update(self, tx_ids):
+        for tx_id in tx_ids:
+            self.add(tx_id)
+
+
+_recent_processed = _RecentTxIds(SEPAY_RECENT_TX_CACHE)
+
+
+async def _warm_recent_processed():
+    try:
+        tx_ids = await get_recent_processed_transaction_ids(SEPAY_RECENT_TX_CACHE)
+    except Exception:
+        logger.exception("Cannot warm processed transaction ids")
+        return
+    # Rows come newest first; add oldest first so eviction drops the oldest.
+    _recent_processed.update(reversed(tx_ids))
+    logger.info("Loaded %s recent processed transaction ids", len(tx_ids))
+
+
+def _new_incoming_transactions(transactions, last_seen_tx_id: str):
+    """(tx_id, amount, content) của giao dịch tiền vào mới hơn checkpoint, mỗi id một lần."""
+    incoming = []
+    seen = set()
+    for tx in transactions:
+        amount_in = _pick_amount(tx)
+        if float(amount_in) <= 0:
+            continue
+        tx_id = _pick_tx_id(tx)
+        if not tx_id or tx_id in seen:
+            continue
+        if not _is_tx_newer_than_checkpoint(tx_id, last_seen_tx_id):
+            continue
+        seen.add(tx_id)
+        incoming.append((tx_id, int(float(amount_in)), _pick_content(tx)))
+    return incoming
+
+
+async def _processed_among(tx_ids: list) -> set:
+    """
+    Id nào trong tx_ids đã xử lý: hỏi RAM trước, phần còn lại một query cho cả lượt poll
+    (không có giao dịch mới → không query nào).
+    """
+    known = {tx_id for tx_id in tx_ids if tx_id in _recent_processed}
+    unknown = [tx_id for tx_id in tx_ids if tx_id not in known]
+    if not unknown:
+        return known
+    found = await get_processed_transaction_ids(unknown)
+    _recent_processed.update(found)
+    return known | found
+
+
+async def _mark_processed(tx_id: str):
+    await mark_processed_transaction(tx_id)
+    _recent_processed.add(tx_id)
+
+
+# Webhook và polling có thể chạy cùng lúc: xử lý tuần tự để một giao dịch không bị cộng tiền hai lần.
+_process_lock = asyncio.Lock()
+
+
+async def process_transactions(bot_app=None, transactions=None):
+    """
+    Xử lý giao dịch và cộng tiền tự động.
+    `transactions` = None: lấy danh sách từ SePay API (polling, dùng checkpoint sepay_last_seen_tx_id).
+    Truyền sẵn (webhook): bỏ qua checkpoint và không dời nó; chống trùng nhờ processed_transactions.
+    """
+    global _backfill_resume
+    async with _process_lock:
+        try:
+            await _process_transactions(bot_app, transactions)
+        except BaseException:
+            # Giao dịch vừa lấy có thể chưa xử lý hết: lần sau lùi lại từ đầu, không nhảy tới chỗ dừng
+            if transactions is None:
+                _backfill_resume = None
+            raise
+
+
+async def _process_transactions(bot_app=None, transactions=None):
+    from_webhook = transactions is not None
+    # Webhook tx must not move the checkpoint: older tx not yet seen by polling would be skipped.
+    last_seen_tx_id = "" if from_webhook else await _load_last_seen_tx_id()
+    complete = True
+    if transactions is None:
+        transactions, complete = await get_recent_transactions(last_seen_tx_id)
     latest_seen_tx_id = str(last_seen_tx_id or "").strip()
-    for tx in transactions:
-        latest_seen_tx_id = _pick_newer_tx_id(latest_seen_tx_id, _pick_tx_id(tx))
+    # Backfill chưa tới checkpoint cũ: giữ nguyên checkpoint để khoảng hụt không bị bỏ qua
+    # (giao dịch đã xử lý ở lần này được processed_transactions chặn cộng trùng).
+    if complete:
+        for tx in transactions:
+            latest_seen_tx_id = _pick_newer_tx_id(latest_seen_tx_id, _pick_tx_id(tx))
 
     relay_token, relay_chat_id = await get_payment_relay_target()
     if USE_SUPABASE:
@@ -399,7 +643,11 @@ async def process_transactions(bot_app=None):
         pending_direct_orders = await get_pending_direct_orders()
         pending_website_direct_orders = await get_pending_website_direct_orders()
         _build_website_direct_order_maps(pending_website_direct_orders)
-        pending_direct_orders = await _auto_cancel_expired_direct_orders(pending_direct_orders, bot_app)
+        # Đơn do website tạo chưa có hẹn giờ huỷ: thêm vào (đơn đã biết không bị parse lại)
+        schedule_direct_orders(_direct_order_expiry_entries(pending_direct_orders))
+        # Index mã thanh toán một lần mỗi chu kỳ: mỗi giao dịch chỉ quét nội dung, không lặp qua mọi đơn chờ
+        deposit_index = PaymentCodeIndex(pending_deposits, lambda row: row[3])
+        direct_order_index = PaymentCodeIndex(pending_direct_orders, lambda row: row[7])
         if SEPAY_DEBUG:
             logger.info(
                 "Pending deposits: %s | pending direct orders: %s | pending website direct orders: %s",
@@ -407,61 +655,47 @@ async def process_transactions(bot_app=None):
                 len(pending_direct_orders),
                 len(pending_website_direct_orders),
             )
-        for tx in transactions:
-            amount_in = _pick_amount(tx)
-            if float(amount_in) <= 0:
-                continue
-
-            content = _pick_content(tx)
-            content_upper = str(content).upper().strip()
+        incoming = _new_incoming_transactions(transactions, last_seen_tx_id)
+        processed = await _processed_among([tx_id for tx_id, _amount, _content in incoming])
+        for tx_id, amount, content in incoming:
             content_norm = _normalize_content(content)
-            amount = int(float(amount_in))
-            tx_id = _pick_tx_id(tx)
-
-            if not tx_id:
-                continue
-            if not _is_tx_newer_than_checkpoint(tx_id, last_seen_tx_id):
-                continue
             _log_tx_seen(tx_id, amount, content)
-            if await is_processed_transaction(tx_id):
+            if tx_id in processed:
                 continue
 
             matched = False
-            for deposit in pending_deposits:
+            for deposit in deposit_index.candidates(content_norm):
                 deposit_id, user_id, _expected_amount, code, _created_at = deposit
-                code_upper = code.upper()
-                code_norm = _normalize_content(code)
-                if code_upper in content_upper or code_norm in content_norm:
-                    await set_deposit_status(deposit_id, "confirmed")
-                    await update_balance(user_id, amount)
-                    await mark_processed_transaction(tx_id)
+                await set_deposit_status(deposit_id, "confirmed")
+                new_balance = await update_balance(user_id, amount)
+                await _mark_processed(tx_id)
+                deposit_index.discard(code)
 
-                    print(f"✅ Confirmed: User {user_id}, Amount {amount:,}đ")
+                print(f"✅ Confirmed: User {user_id}, Amount {amount:,}đ")
 
-                    if bot_app:
-                        try:
-                            new_balance = await get_balance(user_id)
-                            msg = await bot_app.bot.send_message(
-                                user_id,
-                                f"✅ NẠP TIỀN THÀNH CÔNG!\n\n"
-                                f"💰 Số tiền: {amount:,}đ\n"
-                                f"💳 Số dư hiện tại: {new_balance:,}đ"
-                            )
-                            mark_bot_message(user_id, msg.message_id)
-                        except:
-                            pass
-                    matched = True
-                    break
+                if bot_app:
+                    try:
+                        msg = await bot_app.bot.send_message(
+                            user_id,
+                            f"✅ NẠP TIỀN THÀNH CÔNG!\n\n"
+                            f"💰 Số tiền: {amount:,}đ\n"
+                            f"💳 Số dư hiện tại: {new_balance:,}đ"
+                        )
+                        mark_bot_message(user_id, msg.message_id)
+                    except:
+                        pass
+                matched = True
+                break
 
             if matched:
                 continue
 
-            for order in pending_direct_orders:
+            for order in direct_order_index.candidates(content_norm):
                 order_id, user_id, product_id, quantity, bonus_quantity, unit_price, expected_amount, code, _created_at = order
-                code_upper = code.upper()
-                code_norm = _normalize_content(code)
                 website_direct_order = _find_website_direct_order(code, _website_orders_by_code_upper, _website_orders_by_code_norm)
-                if (code_upper in content_upper or code_norm in content_norm) and amount >= expected_amount:
+                if amount >= expected_amount:
+                    direct_order_index.discard(code)
+                    discard_direct_order_expiry(code)
                     # Fulfill direct order
                     deliver_quantity = max(1, int(quantity) + max(0, int(bonus_quantity or 0)))
                     stocks = await get_available_stock_batch(product_id, deliver_quantity)
@@ -478,7 +712,7 @@ async def process_transactions(bot_app=None):
                                 user_id,
                                 "❌ Thanh toán đã nhận nhưng sản phẩm hiện hết hàng. Vui lòng liên hệ admin."
                             )
-                        await mark_processed_transaction(tx_id)
+                        await _mark_processed(tx_id)
                         matched = True
                         break
 
@@ -515,7 +749,7 @@ async def process_transactions(bot_app=None):
                             fulfilled_order_id=website_order_id,
                         )
                         _remove_website_direct_order_from_maps(website_direct_order)
-                        await mark_processed_transaction(tx_id)
+                        await _mark_processed(tx_id)
                         logger.info(
                             "✅ Website direct order confirmed: code=%s website_direct_order_id=%s website_order_id=%s",
                             code,
@@ -552,7 +786,7 @@ async def process_transactions(bot_app=None):
                             quantity=len(purchased_items),
                         )
                         await set_direct_order_status(order_id, "confirmed")
-                        await mark_processed_transaction(tx_id)
+                        await _mark_processed(tx_id)
                         await send_payment_relay_notification(
                             relay_token,
                             relay_chat_id,
@@ -622,135 +856,171 @@ async def process_transactions(bot_app=None):
                     break
             if matched:
                 continue
-        if latest_seen_tx_id and latest_seen_tx_id != last_seen_tx_id:
+        if not from_webhook and latest_seen_tx_id and latest_seen_tx_id != last_seen_tx_id:
             await _save_last_seen_tx_id(latest_seen_tx_id)
         return
 
     async with aiosqlite.connect(DB_PATH) as db:
-        # Auto-cancel stale direct orders in sqlite mode as well.
+        # Lấy pending deposits
         cursor = await db.execute(
-            "SELECT id, user_id, created_at FROM direct_orders WHERE status = 'pending'"
+            "SELECT id, user_id, amount, code FROM deposits WHERE status = 'pending'"
         )
-        sqlite_pending_direct_orders = await cursor.fetchall()
-        for order_id, user_id, created_at in sqlite_pending_direct_orders:
-            if not _is_direct_order_expired(created_at):
+        pending_deposits = await cursor.fetchall()
+        deposit_index = PaymentCodeIndex(pending_deposits, lambda row: row[3])
+
+        # Giao dịch tiền vào mới hơn checkpoint (API trả về amount_in cho tiền vào)
+        incoming = _new_incoming_transactions(transactions, last_seen_tx_id)
+        # Kiểm tra đã xử lý chưa (RAM + một query cho cả lượt)
+        processed = await _processed_among([tx_id for tx_id, _amount, _content in incoming])
+        confirmed = []
+        for tx_id, amount, content in incoming:
+            content_norm = _normalize_content(content)
+            _log_tx_seen(tx_id, amount, content)
+            if tx_id in processed:
                 continue
-            await db.execute(
-                "UPDATE direct_orders SET status = 'cancelled' WHERE id = ?",
-                (order_id,)
+
+            # Tìm deposit khớp
+            deposit = deposit_index.first(content_norm)
+            if deposit:
+                deposit_id, user_id, expected_amount, code = deposit
+                deposit_index.discard(code)
+                # Cộng tiền
+                await db.execute(
+                    "UPDATE deposits SET status = 'confirmed' WHERE id = ?",
+                    (deposit_id,)
+                )
+                await db.execute(
+                    "UPDATE users SET balance = balance + ? WHERE user_id = ?",
+                    (amount, user_id)
+                )
+                confirmed.append((tx_id, user_id, amount))
+
+        if confirmed:
+            # Đánh dấu đã xử lý: cùng một commit với các lệnh cộng tiền ở trên
+            await db.executemany(
+                "INSERT OR IGNORE INTO processed_transactions (tx_id) VALUES (?)",
+                [(tx_id,) for tx_id, _user_id, _amount in confirmed]
             )
-            logger.info("⏱️ Auto-cancel direct order #%s after %sm pending. (sqlite)", order_id, DIRECT_ORDER_PENDING_EXPIRE_MINUTES)
+            await db.commit()
+            _recent_processed.update(tx_id for tx_id, _user_id, _amount in confirmed)
+
+        for tx_id, user_id, amount in confirmed:
+            print(f"✅ Confirmed: User {user_id}, Amount {amount:,}đ")
+
+            # Thông báo user
             if bot_app:
                 try:
+                    # Lấy số dư mới
+                    cursor = await db.execute(
+                        "SELECT balance FROM users WHERE user_id = ?", (user_id,)
+                    )
+                    new_balance = (await cursor.fetchone())[0]
+
                     await bot_app.bot.send_message(
                         user_id,
-                        f"⌛ Đơn thanh toán #{order_id} đã hết hạn sau {DIRECT_ORDER_PENDING_EXPIRE_MINUTES} phút và đã tự hủy."
+                        f"✅ NẠP TIỀN THÀNH CÔNG!\n\n"
+                        f"💰 Số tiền: {amount:,}đ\n"
+                        f"💳 Số dư hiện tại: {new_balance:,}đ"
                     )
-                except Exception:
+                except:
                     pass
-        await db.commit()
+        if not from_webhook and latest_seen_tx_id and latest_seen_tx_id != last_seen_tx_id:
+            await _save_last_seen_tx_id(latest_seen_tx_id)
 
-        # Lấy pending deposits
-        cursor = await db.execute(
-            "SELECT id, user_id, amount, code FROM deposits WHERE status = 'pending'"
-        )
-        pending_deposits = await cursor.fetchall()
 
-        for tx in transactions:
-            # Lấy thông tin giao dịch (API trả về amount_in cho tiền vào)
-            amount_in = _pick_amount(tx)
-            if float(amount_in) <= 0:
-                continue
+def _webhook_tx_from_payload(payload: dict):
+    """Chuyển payload webhook SePay sang dạng giao dịch của userapi (id, amount_in, transaction_content)."""
+    if not isinstance(payload, dict) or payload.get("id") is None:
+        return None
+    transfer_type = str(payload.get("transferType") or "in").strip().lower()
+    return {
+        "id": str(payload.get("id")),
+        "amount_in": payload.get("transferAmount") if transfer_type == "in" else 0,
+        "transaction_content": payload.get("content") or payload.get("description") or "",
+        "reference_number": payload.get("referenceCode"),
+        "transaction_date": payload.get("transactionDate"),
+        "account_number": payload.get("accountNumber"),
+    }
 
-            content = _pick_content(tx)
-            content_upper = str(content).upper().strip()
-            content_norm = _normalize_content(content)
-            amount = int(float(amount_in))
-            tx_id = _pick_tx_id(tx)
 
-            # Kiểm tra đã xử lý chưa
-            if not tx_id:
-                continue
-            if not _is_tx_newer_than_checkpoint(tx_id, last_seen_tx_id):
-                continue
-            _log_tx_seen(tx_id, amount, content)
-            cursor = await db.execute(
-                "SELECT 1 FROM processed_transactions WHERE tx_id = ?", (tx_id,)
-            )
-            if await cursor.fetchone():
-                continue
+def _is_valid_sepay_auth(header_value: str) -> bool:
+    if not SEPAY_WEBHOOK_API_KEY:
+        return False
+    scheme, _, key = str(header_value or "").strip().partition(" ")
+    return scheme.lower() == "apikey" and hmac.compare_digest(key.strip(), SEPAY_WEBHOOK_API_KEY)
 
-            # Tìm deposit khớp
-            for deposit in pending_deposits:
-                deposit_id, user_id, expected_amount, code = deposit
 
-                code_upper = code.upper()
-                code_norm = _normalize_content(code)
-                if code_upper in content_upper or code_norm in content_norm:
-                    # Cộng tiền
-                    await db.execute(
-                        "UPDATE deposits SET status = 'confirmed' WHERE id = ?",
-                        (deposit_id,)
-                    )
-                    await db.execute(
-                        "UPDATE users SET balance = balance + ? WHERE user_id = ?",
-                        (amount, user_id)
-                    )
-                    # Đánh dấu đã xử lý
-                    await db.execute(
-                        "INSERT INTO processed_transactions (tx_id) VALUES (?)",
-                        (tx_id,)
-                    )
-                    await db.commit()
+def add_sepay_webhook_route(server, bot_app=None, path: str = SEPAY_WEBHOOK_PATH):
+    """Gắn endpoint nhận webhook SePay vào WebhookServer (helpers/webhook.py)."""
+    from aiohttp import web
 
-                    print(f"✅ Confirmed: User {user_id}, Amount {amount:,}đ")
+    if not SEPAY_WEBHOOK_API_KEY:
+        logger.warning("SePay webhook enabled but SEPAY_WEBHOOK_API_KEY/SEPAY_API_KEY is empty: all calls rejected.")
+    pending = set()
 
-                    # Thông báo user
-                    if bot_app:
-                        try:
-                            # Lấy số dư mới
-                            cursor = await db.execute(
-                                "SELECT balance FROM users WHERE user_id = ?", (user_id,)
-                            )
-                            new_balance = (await cursor.fetchone())[0]
+    async def _handle(request):
+        if not _is_valid_sepay_auth(request.headers.get("Authorization", "")):
+            return web.json_response({"success": False}, status=401)
+        try:
+            tx = _webhook_tx_from_payload(await request.json())
+        except Exception:
+            tx = None
+        if tx is None:
+            return web.json_response({"success": False}, status=400)
+        if SEPAY_DEBUG:
+            logger.info("SePay webhook tx: %s", tx)
 
-                            await bot_app.bot.send_message(
-                                user_id,
-                                f"✅ NẠP TIỀN THÀNH CÔNG!\n\n"
-                                f"💰 Số tiền: {amount:,}đ\n"
-                                f"💳 Số dư hiện tại: {new_balance:,}đ"
-                            )
-                        except:
-                            pass
-                    break
-        if latest_seen_tx_id and latest_seen_tx_id != last_seen_tx_id:
-            await _save_last_seen_tx_id(latest_seen_tx_id)
+        # Trả lời SePay ngay; giao dịch lỗi/bỏ lỡ sẽ được lượt polling đối soát xử lý lại.
+        async def _run():
+            set_send_priority(PRIORITY_PAYMENT)
+            try:
+                await process_transactions(bot_app, [tx])
+            except Exception:
+                logger.exception("SePay webhook processing failed (tx %s)", tx.get("id"))
+
+        task = asyncio.create_task(_run())
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        return web.json_response({"success": True})
+
+    server.router.add_post(path, _handle)
+    logger.info("🔔 SePay webhook endpoint: %s", path)
 
 async def init_checker_db():
     """Tạo bảng lưu giao dịch đã xử lý"""
     if USE_SUPABASE:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS processed_transactions (
-                tx_id TEXT PRIMARY KEY,
-                processed_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.commit()
+    # processed_transactions is part of the versioned SQLite schema (database/migrations.py).
+    await init_sqlite_db()
 
 async def run_checker(bot_app=None, interval=30):
     """Chạy checker định kỳ"""
+    global _expiry_refresh_task
     await init_checker_db()
+    await _warm_recent_processed()
+    # Đơn direct quá hạn được huỷ theo hẹn giờ riêng, không phụ thuộc vòng poll
+    await _load_direct_order_expiry()
+    start_direct_order_expiry(lambda codes: _expire_direct_orders(codes, bot_app))
+    if USE_SUPABASE:
+        _expiry_refresh_task = asyncio.get_running_loop().create_task(
+            _refresh_direct_order_expiry(), name="direct-order-expiry-refresh"
+        )
+    # Deliveries / deposit confirmations go ahead of replies and broadcasts in the send queue.
+    set_send_priority(PRIORITY_PAYMENT)
     logger.info("🔄 SePay checker started (interval: %ss, supabase=%s)", interval, USE_SUPABASE)
     last_mode = None
     
+    if SEPAY_WEBHOOK_ENABLED:
+        interval = max(interval, SEPAY_RECONCILE_SECONDS)
+        logger.info("SePay webhook enabled: polling is a reconciliation sweep every %ss", interval)
+
     while True:
         try:
             await process_transactions(bot_app)
         except Exception as e:
             logger.exception("Checker error: %s", e)
-        fast_mode = has_latest_vietqr_message()
+        # Webhook đã giao hàng tức thì, không cần poll nhanh khi có VietQR đang chờ
+        fast_mode = not SEPAY_WEBHOOK_ENABLED and has_latest_vietqr_message()
         mode = "fast" if fast_mode else "normal"
         if mode != last_mode:
             logger.info("SePay checker mode: %s", mode)
@@ -0,0 +1,76 @@
+-- Atomic balance updates (Telegram bot)
+-- NOTE: keep this in a separate SQL file (do not append to old schema files)
+--
+-- increment_user_balance: apply a delta and return the new balance in one
+-- round-trip (replaces get_balance + update). Concurrent deposits/purchases
+-- for the same user no longer lose updates.
+-- debit_user_balance: subtract only if the balance covers the amount;
+-- returns NULL (and changes nothing) when funds are short.
+-- p_currency: 'vnd' -> users.balance, 'usdt' -> users.balance_usdt
+
+CREATE OR REPLACE FUNCTION public.increment_user_balance(
+  p_user_id bigint,
+  p_amount numeric,
+  p_currency text DEFAULT 'vnd'
+)
+RETURNS numeric
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_new_balance numeric;
+BEGIN
+  IF NOT (auth.role() = 'service_role' OR public.is_admin()) THEN
+    RAISE EXCEPTION 'not authorized';
+  END IF;
+
+  IF lower(coalesce(p_currency, 'vnd')) = 'usdt' THEN
+    UPDATE public.users SET balance_usdt = coalesce(balance_usdt, 0) + p_amount
+    WHERE user_id = p_user_id
+    RETURNING balance_usdt INTO v_new_balance;
+  ELSE
+    UPDATE public.users SET balance = coalesce(balance, 0) + p_amount::bigint
+    WHERE user_id = p_user_id
+    RETURNING balance INTO v_new_balance;
+  END IF;
+
+  RETURN coalesce(v_new_balance, 0);
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.debit_user_balance(
+  p_user_id bigint,
+  p_amount numeric,
+  p_currency text DEFAULT 'vnd'
+)
+RETURNS numeric
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_new_balance numeric;
+BEGIN
+  IF NOT (auth.role() = 'service_role' OR public.is_admin()) THEN
+    RAISE EXCEPTION 'not authorized';
+  END IF;
+
+  IF coalesce(p_amount, 0) < 0 THEN
+    RAISE EXCEPTION 'amount must be >= 0';
+  END IF;
+
+  IF lower(coalesce(p_currency, 'vnd')) = 'usdt' THEN
+    UPDATE public.users SET balance_usdt = coalesce(balance_usdt, 0) - p_amount
+    WHERE user_id = p_user_id AND coalesce(balance_usdt, 0) >= p_amount
+    RETURNING balance_usdt INTO v_new_balance;
+  ELSE
+    UPDATE public.users SET balance = coalesce(balance, 0) - p_amount::bigint
+    WHERE user_id = p_user_id AND coalesce(balance, 0) >= p_amount
+    RETURNING balance INTO v_new_balance;
+  END IF;
+
+  -- NULL when the user is missing or cannot cover the amount
+  RETURN v_new_balance;
+END;
+$$;
@@ -0,0 +1,32 @@
+-- Background /notification broadcasts (Telegram bot)
+-- NOTE: keep this in a separate SQL file (do not append to old schema files)
+--
+-- broadcast_jobs stores each broadcast and a keyset checkpoint (last_user_id):
+-- after a restart the bot resumes running jobs from user_id > last_user_id.
+-- users.is_blocked is set when Telegram answers 403 (user blocked the bot);
+-- later broadcasts skip those users until they /start the bot again.
+
+alter table public.users
+  add column if not exists is_blocked boolean not null default false;
+
+create table if not exists public.broadcast_jobs (
+  id bigint generated by default as identity primary key,
+  text text not null,
+  status text not null default 'running' check (status in ('running', 'done', 'cancelled', 'failed')),
+  admin_chat_id bigint,
+  progress_message_id bigint,
+  total integer not null default 0,
+  sent integer not null default 0,
+  failed integer not null default 0,
+  blocked integer not null default 0,
+  last_user_id bigint not null default 0,
+  created_at timestamptz default now(),
+  updated_at timestamptz default now(),
+  finished_at timestamptz
+);
+create index if not exists broadcast_jobs_status_idx on public.broadcast_jobs (status);
+
+alter table public.broadcast_jobs enable row level security;
+drop policy if exists "Admins can access broadcast jobs" on public.broadcast_jobs;
+create policy "Admins can access broadcast jobs" on public.broadcast_jobs
+  for all using (public.is_admin()) with check (public.is_admin());
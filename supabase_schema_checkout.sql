@@ -0,0 +1,165 @@
+-- Atomic balance checkout (Telegram bot)
+-- NOTE: keep this in a separate SQL file (do not append to old schema files)
+--
+-- One round-trip replaces get_product + get_balance + get_available_stock_batch
+-- + mark_stock_sold_batch + create_order_bulk + update_balance + get_balance.
+-- The user row is locked first, then unsold stock rows are claimed with
+-- FOR UPDATE SKIP LOCKED, so concurrent buyers never receive the same item.
+-- Pricing mirrors helpers/pricing.py (quantity tiers + Buy X Get Y bonus).
+
+CREATE OR REPLACE FUNCTION public.checkout_with_balance(
+  p_user_id bigint,
+  p_product_id bigint,
+  p_quantity integer,
+  p_currency text DEFAULT 'vnd',
+  p_usdt_rate numeric DEFAULT 0
+)
+RETURNS jsonb
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_product public.products%ROWTYPE;
+  v_is_usdt boolean := lower(coalesce(p_currency, 'vnd')) = 'usdt';
+  v_unit_price numeric;
+  v_total numeric;
+  v_bonus integer := 0;
+  v_required integer;
+  v_available integer;
+  v_balance numeric;
+  v_new_balance numeric;
+  v_items jsonb;
+  v_claimed integer;
+  v_order_group text;
+  v_result jsonb;
+BEGIN
+  IF NOT (auth.role() = 'service_role' OR public.is_admin()) THEN
+    RAISE EXCEPTION 'not authorized';
+  END IF;
+
+  v_result := jsonb_build_object(
+    'ok', false, 'error', NULL, 'items', '[]'::jsonb, 'quantity', coalesce(p_quantity, 0),
+    'bonus_quantity', 0, 'unit_price', 0, 'total_price', 0, 'balance', 0, 'available', 0,
+    'order_group', NULL
+  );
+
+  IF coalesce(p_quantity, 0) < 1 THEN
+    RETURN v_result || jsonb_build_object('error', 'invalid_quantity');
+  END IF;
+
+  SELECT * INTO v_product
+  FROM public.products
+  WHERE id = p_product_id
+    AND COALESCE(is_deleted, FALSE) = FALSE
+    AND COALESCE(is_hidden, FALSE) = FALSE;
+  IF NOT FOUND THEN
+    RETURN v_result || jsonb_build_object('error', 'product_not_found');
+  END IF;
+
+  -- Bonus: (quantity // promo_buy_quantity) * promo_bonus_quantity
+  IF coalesce(v_product.promo_buy_quantity, 0) >= 1 AND coalesce(v_product.promo_bonus_quantity, 0) >= 1 THEN
+    v_bonus := (p_quantity / v_product.promo_buy_quantity) * v_product.promo_bonus_quantity;
+  END IF;
+  v_required := p_quantity + v_bonus;
+
+  IF v_is_usdt THEN
+    v_unit_price := coalesce(v_product.price_usdt, 0);
+  ELSE
+    -- Highest tier whose min_quantity <= quantity, else base price
+    SELECT t.unit_price INTO v_unit_price
+    FROM (
+      SELECT
+        (coalesce(tier->>'min_quantity', tier->>'quantity'))::integer AS min_quantity,
+        (coalesce(tier->>'unit_price', tier->>'price'))::bigint AS unit_price
+      FROM jsonb_array_elements(
+        CASE WHEN jsonb_typeof(v_product.price_tiers) = 'array' THEN v_product.price_tiers ELSE '[]'::jsonb END
+      ) AS tier
+      WHERE jsonb_typeof(tier) = 'object'
+        AND coalesce(tier->>'min_quantity', tier->>'quantity') ~ '^[0-9]+$'
+        AND coalesce(tier->>'unit_price', tier->>'price') ~ '^[0-9]+$'
+    ) t
+    WHERE t.min_quantity >= 1 AND t.unit_price >= 1 AND t.min_quantity <= p_quantity
+    ORDER BY t.min_quantity DESC
+    LIMIT 1;
+    v_unit_price := coalesce(v_unit_price, v_product.price, 0);
+  END IF;
+  v_total := v_unit_price * p_quantity;
+
+  SELECT count(*) INTO v_available
+  FROM public.stock
+  WHERE product_id = p_product_id AND sold = FALSE;
+
+  v_result := v_result || jsonb_build_object(
+    'bonus_quantity', v_bonus, 'unit_price', v_unit_price, 'total_price', v_total, 'available', v_available
+  );
+
+  -- Lock the buyer first (same order for every checkout => no deadlocks)
+  IF v_is_usdt THEN
+    SELECT coalesce(balance_usdt, 0) INTO v_balance FROM public.users WHERE user_id = p_user_id FOR UPDATE;
+  ELSE
+    SELECT coalesce(balance, 0) INTO v_balance FROM public.users WHERE user_id = p_user_id FOR UPDATE;
+  END IF;
+  v_balance := coalesce(v_balance, 0);
+  IF v_balance < v_total THEN
+    RETURN v_result || jsonb_build_object('error', 'insufficient_balance', 'balance', v_balance);
+  END IF;
+
+  BEGIN
+    WITH picked AS (
+      SELECT id
+      FROM public.stock
+      WHERE product_id = p_product_id AND sold = FALSE
+      ORDER BY id
+      LIMIT v_required
+      FOR UPDATE SKIP LOCKED
+    ), claimed AS (
+      UPDATE public.stock s
+      SET sold = TRUE
+      FROM picked
+      WHERE s.id = picked.id
+      RETURNING s.id, s.content
+    )
+    SELECT coalesce(jsonb_agg(content ORDER BY id), '[]'::jsonb), count(*)
+    INTO v_items, v_claimed
+    FROM claimed;
+
+    IF v_claimed < v_required THEN
+      -- Undo the partial claim (subtransaction) and report what is left
+      RAISE EXCEPTION USING ERRCODE = 'P0002', MESSAGE = 'out_of_stock';
+    END IF;
+  EXCEPTION WHEN no_data_found THEN
+    RETURN v_result || jsonb_build_object('error', 'out_of_stock', 'available', v_claimed, 'balance', v_balance);
+  END;
+
+  IF v_is_usdt THEN
+    UPDATE public.users SET balance_usdt = coalesce(balance_usdt, 0) - v_total
+    WHERE user_id = p_user_id
+    RETURNING balance_usdt INTO v_new_balance;
+  ELSE
+    UPDATE public.users SET balance = coalesce(balance, 0) - v_total
+    WHERE user_id = p_user_id
+    RETURNING balance INTO v_new_balance;
+  END IF;
+
+  v_order_group := 'ORD' || p_user_id::text || to_char(clock_timestamp(), 'YYYYMMDDHH24MISS');
+  INSERT INTO public.orders (user_id, product_id, content, price, quantity, order_group, created_at)
+  VALUES (
+    p_user_id,
+    p_product_id,
+    v_items::text,
+    CASE WHEN v_is_usdt THEN floor(v_total * coalesce(p_usdt_rate, 0))::bigint ELSE v_total::bigint END,
+    v_claimed,
+    v_order_group,
+    now()
+  );
+
+  RETURN v_result || jsonb_build_object(
+    'ok', true,
+    'items', v_items,
+    'balance', v_new_balance,
+    'available', v_available - v_claimed,
+    'order_group', v_order_group
+  );
+END;
+$$;
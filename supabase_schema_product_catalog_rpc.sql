@@ -0,0 +1,134 @@
+-- Product catalog RPCs with manual ordering (Telegram bot)
+-- NOTE: keep this in a separate SQL file (do not append to old schema files)
+-- Run after supabase_schema_product_soft_delete.sql and supabase_schema_product_position.sql.
+--
+-- get_products_with_stock / get_product_with_stock now also return sort_position,
+-- and the catalog is ordered server-side, so the bot renders the shop with a
+-- single RPC (no second products query for positions, no client-side sort).
+
+ALTER TABLE public.products
+  ADD COLUMN IF NOT EXISTS sort_position INTEGER;
+
+DROP FUNCTION IF EXISTS public.get_products_with_stock();
+CREATE OR REPLACE FUNCTION public.get_products_with_stock()
+RETURNS TABLE (
+  id bigint,
+  name text,
+  price bigint,
+  price_usdt numeric,
+  price_tiers jsonb,
+  promo_buy_quantity integer,
+  promo_bonus_quantity integer,
+  website_name text,
+  website_price bigint,
+  website_price_tiers jsonb,
+  website_promo_buy_quantity integer,
+  website_promo_bonus_quantity integer,
+  website_banner_url text,
+  website_logo_url text,
+  website_enabled boolean,
+  description text,
+  format_data text,
+  stock bigint,
+  sort_position integer
+)
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT
+    p.id,
+    p.name,
+    p.price,
+    p.price_usdt,
+    p.price_tiers,
+    p.promo_buy_quantity,
+    p.promo_bonus_quantity,
+    p.website_name,
+    p.website_price,
+    p.website_price_tiers,
+    p.website_promo_buy_quantity,
+    p.website_promo_bonus_quantity,
+    p.website_banner_url,
+    p.website_logo_url,
+    p.website_enabled,
+    p.description,
+    p.format_data,
+    COALESCE(s.stock, 0) AS stock,
+    p.sort_position
+  FROM public.products p
+  LEFT JOIN (
+    SELECT product_id, COUNT(*) AS stock
+    FROM public.stock
+    WHERE sold = FALSE
+    GROUP BY product_id
+  ) s ON s.product_id = p.id
+  WHERE (auth.role() = 'service_role' OR public.is_admin())
+    AND COALESCE(p.is_deleted, FALSE) = FALSE
+    AND COALESCE(p.is_hidden, FALSE) = FALSE
+  -- Same order as the bot menu: manual position first (NULLs last), then id
+  ORDER BY p.sort_position ASC NULLS LAST, p.id;
+$$;
+
+DROP FUNCTION IF EXISTS public.get_product_with_stock(bigint);
+CREATE OR REPLACE FUNCTION public.get_product_with_stock(p_id bigint)
+RETURNS TABLE (
+  id bigint,
+  name text,
+  price bigint,
+  price_usdt numeric,
+  price_tiers jsonb,
+  promo_buy_quantity integer,
+  promo_bonus_quantity integer,
+  website_name text,
+  website_price bigint,
+  website_price_tiers jsonb,
+  website_promo_buy_quantity integer,
+  website_promo_bonus_quantity integer,
+  website_banner_url text,
+  website_logo_url text,
+  website_enabled boolean,
+  description text,
+  format_data text,
+  stock bigint,
+  sort_position integer
+)
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT
+    p.id,
+    p.name,
+    p.price,
+    p.price_usdt,
+    p.price_tiers,
+    p.promo_buy_quantity,
+    p.promo_bonus_quantity,
+    p.website_name,
+    p.website_price,
+    p.website_price_tiers,
+    p.website_promo_buy_quantity,
+    p.website_promo_bonus_quantity,
+    p.website_banner_url,
+    p.website_logo_url,
+    p.website_enabled,
+    p.description,
+    p.format_data,
+    COALESCE(s.stock, 0) AS stock,
+    p.sort_position
+  FROM public.products p
+  LEFT JOIN (
+    SELECT product_id, COUNT(*) AS stock
+    FROM public.stock
+    WHERE sold = FALSE
+    GROUP BY product_id
+  ) s ON s.product_id = p.id
+  WHERE (auth.role() = 'service_role' OR public.is_admin())
+    AND p.id = p_id
+    AND COALESCE(p.is_deleted, FALSE) = FALSE
+    AND COALESCE(p.is_hidden, FALSE) = FALSE
+  LIMIT 1;
+$$;
@@ -0,0 +1,39 @@
+-- Settings change counter (Telegram bot settings snapshot)
+-- NOTE: keep this in a separate SQL file (do not append to old schema files)
+--
+-- Every write to public.settings (bot, website dashboard, SQL editor) bumps the
+-- 'settings_version' row. The bot keeps the whole settings table in memory and
+-- only re-reads that one row every few seconds; it reloads the snapshot when
+-- the value changes (database/settings_snapshot.py).
+
+INSERT INTO public.settings (key, value)
+VALUES ('settings_version', '1')
+ON CONFLICT (key) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION public.bump_settings_version()
+RETURNS trigger
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+  -- The bump itself writes to settings; do not recurse.
+  IF pg_trigger_depth() > 1 THEN
+    RETURN NULL;
+  END IF;
+
+  INSERT INTO public.settings (key, value)
+  VALUES ('settings_version', '1')
+  ON CONFLICT (key) DO UPDATE
+  SET value = (
+    CASE WHEN public.settings.value ~ '^[0-9]+$' THEN public.settings.value::bigint + 1 ELSE 1 END
+  )::text;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_settings_version ON public.settings;
+CREATE TRIGGER trg_settings_version
+AFTER INSERT OR UPDATE OR DELETE ON public.settings
+FOR EACH STATEMENT
+EXECUTE FUNCTION public.bump_settings_version();